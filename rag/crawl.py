@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+w2db.py / p2d.py 共通の並列クローラー。
+接続をプールした非同期 HTTP クライアントで、同時実行数・ホストごとのレート・
+タイムアウト・リトライ (指数バックオフ) を制御しながら URL をまとめて取得する。
+取得結果の書き込みは単一のライターで直列化する。
+"""
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+DEFAULT_CONCURRENCY = 8     # 同時に処理する URL 数
+DEFAULT_HOST_RATE = 2.0     # ホストごとの最大リクエスト数 / 秒
+DEFAULT_TIMEOUT = 30.0      # 1リクエストのタイムアウト (秒)
+DEFAULT_RETRIES = 3         # 失敗時の再試行回数
+DEFAULT_BACKOFF = 1.0       # バックオフの基準秒数 (1, 2, 4, ... 秒 + ゆらぎ)
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+USER_AGENT = "azzl-crawler/1.0"
+
+
+def read_url_list(path: str) -> list:
+    """
+    URL リストファイルを読み込む。空行と # で始まる行は無視し、重複は取り除く。
+    """
+    urls = []
+    seen = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            url = line.strip()
+            if not url or url.startswith("#") or url in seen:
+                continue
+            seen.add(url)
+            urls.append(url)
+    return urls
+
+
+class HostRateLimiter:
+    """
+    ホストごとにリクエストの開始間隔を 1 / rate 秒以上に保つ。
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = {}
+        self._lock = asyncio.Lock()
+
+    async def wait(self, url: str):
+        if self.interval <= 0:
+            return
+        host = urlparse(url).netloc
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def fetch_with_retry(client: httpx.AsyncClient, url: str, limiter: HostRateLimiter,
+                           retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF,
+                           fetch: Optional[Callable[[httpx.AsyncClient, str], Awaitable]] = None,
+                           headers: Optional[dict] = None):
+    """
+    URL を取得する。接続エラー・タイムアウト・429/5xx は指数バックオフで再試行する。
+    headers に条件付き GET のヘッダーを渡した場合、304 Not Modified はそのまま返す。
+    fetch を渡すと、その関数 (client, url) -> 結果 で取得する (ストリーミング保存など)。
+    fetch はステータスが異常なら httpx.HTTPStatusError を送出すること。
+    """
+    attempt = 0
+    while True:
+        await limiter.wait(url)
+        try:
+            if fetch is not None:
+                return await fetch(client, url)
+            response = await client.get(url, headers=headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+            return response
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if status not in RETRY_STATUS or attempt >= retries:
+                raise
+            delay = _retry_after(e.response)
+        except (httpx.TransportError, httpx.TimeoutException):
+            if attempt >= retries:
+                raise
+            delay = None
+
+        if delay is None:
+            delay = backoff * (2 ** attempt) + random.uniform(0, backoff)
+        attempt += 1
+        print(f"🔁 再試行 ({attempt}/{retries}, {delay:.1f}秒後): {url}")
+        await asyncio.sleep(delay)
+
+
+async def crawl(urls: Iterable[str],
+                process: Callable[[httpx.AsyncClient, str, HostRateLimiter], Awaitable],
+                write: Callable[[object], None],
+                concurrency: int = DEFAULT_CONCURRENCY,
+                host_rate: float = DEFAULT_HOST_RATE,
+                timeout: float = DEFAULT_TIMEOUT) -> dict:
+    """
+    URL 群を並列に処理する。
+    process(client, url, limiter) が返した結果 (None 以外) はキューに積まれ、
+    単一のライターが write(result) を順に呼び出してファイルへ書き込む。
+    成功・失敗・スキップの件数を返す。
+    """
+    urls = list(urls)
+    stats = {"ok": 0, "failed": 0, "skipped": 0}
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    limiter = HostRateLimiter(host_rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    done = object()
+
+    async def writer():
+        while True:
+            result = await queue.get()
+            if result is done:
+                return
+            try:
+                write(result)
+                stats["ok"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"❌ 書き込みエラー: {e}")
+
+    async def run(client: httpx.AsyncClient, url: str):
+        async with semaphore:
+            try:
+                result = await process(client, url, limiter)
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"❌ 取得エラー: {url} ({e})")
+                return
+        if result is None:
+            stats["skipped"] += 1
+        else:
+            await queue.put(result)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(
+        timeout=timeout, limits=limits, follow_redirects=True, headers={"User-Agent": USER_AGENT}
+    ) as client:
+        writer_task = asyncio.create_task(writer())
+        await asyncio.gather(*(run(client, url) for url in urls))
+        await queue.put(done)
+        await writer_task
+
+    return stats
+
+
+def add_batch_arguments(parser):
+    """バッチモード共通のコマンドライン引数を追加する。"""
+    parser.add_argument(
+        "-b", "--batch",
+        metavar="FILE",
+        help="URL リストファイル (1行1URL) をまとめて並列に取得"
+    )
+    parser.add_argument(
+        "-c", "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"同時に取得する URL 数 (デフォルト: {DEFAULT_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=DEFAULT_HOST_RATE,
+        help=f"ホストごとの最大リクエスト数/秒 (デフォルト: {DEFAULT_HOST_RATE})"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=f"リクエストのタイムアウト秒数 (デフォルト: {DEFAULT_TIMEOUT})"
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=f"失敗時の再試行回数 (デフォルト: {DEFAULT_RETRIES})"
+    )
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+w2db.py / p2d.py 共通のクロール状態ストア (SQLite)。
+URL ごとに ETag / Last-Modified / 本文のハッシュと本文そのものを保持し、
+テキストデータベース (wiki.db / pdf.db) はこのストアから書き出す。
+"""
+import os
+import re
+import sqlite3
+import hashlib
+import datetime
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    text TEXT,
+    fetched_at TEXT,
+    checked_at TEXT,
+    UNIQUE (kind, url)
+);
+CREATE TABLE IF NOT EXISTS parts (
+    page_id INTEGER NOT NULL REFERENCES pages (id),
+    number INTEGER NOT NULL,
+    chars INTEGER NOT NULL,
+    empty INTEGER NOT NULL,
+    PRIMARY KEY (page_id, number)
+);
+CREATE TABLE IF NOT EXISTS legacy (
+    kind TEXT PRIMARY KEY,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS legacy_pages (
+    kind TEXT NOT NULL,
+    url TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (kind, url)
+);
+"""
+
+# p2d.py の page_marker が書くページ番号の行 (旧 .db の本文には無い)
+PAGE_MARKER = re.compile(r"^<!-- page: \d+ -->$")
+
+
+def _now() -> str:
+    return datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CrawlStore:
+    """
+    kind ("wiki" / "pdf") ごとのクロール状態を管理する。
+    URL の検索は (kind, url) の一意インデックスで O(1)。
+    既存の .log / .db しかない場合は初回に取り込み、旧 .db の内容は legacy として保持する。
+    1 ページ 1 行の .db (legacy_line_per_url=True) は URL ごとに分けて保持し、取り直した URL の分だけ置き換える。
+    分けられない .db は、取り直した本文と同じ行の並びを除いて書き出し、ログの全 URL を -r で取り直すと破棄する。
+    """
+
+    def __init__(self, path: str, kind: str, db_file: str, log_file: Optional[str] = None,
+                 legacy_line_per_url: bool = False):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.kind = kind
+        self.db_file = db_file
+        self.legacy_line_per_url = legacy_line_per_url
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        if log_file:
+            self._migrate_from_log(log_file)
+
+    def close(self):
+        self.conn.close()
+
+    def _migrate_from_log(self, log_file: str):
+        """旧形式のログ ([時刻] URL タイトル) と .db を取り込む。"""
+        if not os.path.exists(log_file) or self.count() > 0:
+            return
+        logged = []  # ログの行順の URL (旧 .db の書き込み順と同じ)
+        with open(log_file, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split(" ", 2)
+                if len(parts) < 2:
+                    continue
+                timestamp = parts[0].strip("[]")
+                title = parts[2] if len(parts) > 2 else None
+                logged.append(parts[1])
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO pages (kind, url, title, fetched_at) VALUES (?, ?, ?, ?)",
+                    (self.kind, parts[1], title, timestamp),
+                )
+        if os.path.exists(self.db_file):
+            with open(self.db_file, "r", encoding="utf-8") as f:
+                legacy_text = f.read()
+            lines = legacy_text.splitlines()
+            if self.legacy_line_per_url and logged and len(lines) == len(logged):
+                # ログの 1 行が .db の 1 行に対応する (-r で取り直した URL は複数行になる)
+                by_url: dict = {}
+                for url, line in zip(logged, lines):
+                    by_url.setdefault(url, []).append(line)
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO legacy_pages (kind, url, text) VALUES (?, ?, ?)",
+                    [(self.kind, url, "\n".join(url_lines)) for url, url_lines in by_url.items()],
+                )
+            elif legacy_text:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO legacy (kind, text) VALUES (?, ?)", (self.kind, legacy_text)
+                )
+        self.conn.commit()
+        print(f"📥 {log_file} からクロール状態を取り込みました ({self.count()} 件)")
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM pages WHERE kind = ?", (self.kind,)).fetchone()[0]
+
+    def get(self, url: str) -> Optional[sqlite3.Row]:
+        return self.conn.execute(
+            "SELECT * FROM pages WHERE kind = ? AND url = ?", (self.kind, url)
+        ).fetchone()
+
+    def is_crawled(self, url: str) -> bool:
+        return self.get(url) is not None
+
+    def urls(self) -> list:
+        rows = self.conn.execute("SELECT url FROM pages WHERE kind = ? ORDER BY id", (self.kind,))
+        return [row["url"] for row in rows]
+
+    def conditional_headers(self, url: str) -> dict:
+        """保存済みの ETag / Last-Modified から条件付き GET のヘッダーを作る。"""
+        row = self.get(url)
+        headers = {}
+        if row is not None and row["text"] is not None:
+            if row["etag"]:
+                headers["If-None-Match"] = row["etag"]
+            if row["last_modified"]:
+                headers["If-Modified-Since"] = row["last_modified"]
+        return headers
+
+    def record(self, url: str, title: str, text: str,
+               etag: Optional[str] = None, last_modified: Optional[str] = None) -> str:
+        """
+        取得結果を保存し、"new" / "changed" / "unchanged" のいずれかを返す。
+        本文のハッシュが同じなら unchanged (検証情報と確認時刻だけ更新する)。
+        """
+        digest = text_hash(text)
+        now = _now()
+        row = self.get(url)
+        if row is None:
+            self.conn.execute(
+                "INSERT INTO pages (kind, url, title, etag, last_modified, content_hash, text, fetched_at, checked_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.kind, url, title, etag, last_modified, digest, text, now, now),
+            )
+            status = "new"
+        elif row["content_hash"] == digest and row["text"] is not None:
+            self.conn.execute(
+                "UPDATE pages SET etag = ?, last_modified = ?, checked_at = ? WHERE id = ?",
+                (etag, last_modified, now, row["id"]),
+            )
+            status = "unchanged"
+        else:
+            self.conn.execute(
+                "UPDATE pages SET title = ?, etag = ?, last_modified = ?, content_hash = ?, text = ?,"
+                " fetched_at = ?, checked_at = ? WHERE id = ?",
+                (title, etag, last_modified, digest, text, now, now, row["id"]),
+            )
+            status = "changed"
+        self.conn.commit()
+        return status
+
+    def record_parts(self, url: str, parts: list):
+        """
+        ページ単位のメタデータ (PDF のページ番号・文字数・テキストの有無) を置き換える。
+        parts は (番号, テキスト or None) のリスト。
+        """
+        row = self.get(url)
+        if row is None:
+            return
+        self.conn.execute("DELETE FROM parts WHERE page_id = ?", (row["id"],))
+        self.conn.executemany(
+            "INSERT INTO parts (page_id, number, chars, empty) VALUES (?, ?, ?, ?)",
+            [(row["id"], number, len(text or ""), int(not text)) for number, text in parts],
+        )
+        self.conn.commit()
+
+    def empty_parts(self, url: str) -> list:
+        """テキストが得られなかったページ番号を返す。"""
+        rows = self.conn.execute(
+            "SELECT parts.number FROM parts JOIN pages ON pages.id = parts.page_id"
+            " WHERE pages.kind = ? AND pages.url = ? AND parts.empty = 1 ORDER BY parts.number",
+            (self.kind, url),
+        )
+        return [row["number"] for row in rows]
+
+    def mark_not_modified(self, url: str):
+        """304 Not Modified を受け取ったときに確認時刻だけ更新する。"""
+        self.conn.execute(
+            "UPDATE pages SET checked_at = ? WHERE kind = ? AND url = ?", (_now(), self.kind, url)
+        )
+        self.conn.commit()
+
+    def append(self, text: str):
+        """新しいページの本文をテキストデータベースに追記する (書き出し順は登録順と一致)。"""
+        os.makedirs(os.path.dirname(self.db_file) or ".", exist_ok=True)
+        with open(self.db_file, "a", encoding="utf-8") as f:
+            f.write(text.rstrip("\n") + "\n")
+
+    def export(self):
+        """
+        テキストデータベースをストアの内容から書き直す (一時ファイル + rename)。
+        更新されたページの本文は追記ではなく置き換えになる。
+        まだ取り直していない URL は旧 .db から取り込んだ本文 (legacy) を書き出す。
+        """
+        os.makedirs(os.path.dirname(self.db_file) or ".", exist_ok=True)
+        tmp_path = f"{self.db_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            legacy = self.conn.execute("SELECT text FROM legacy WHERE kind = ?", (self.kind,)).fetchone()
+            if legacy is not None:
+                for line in self._legacy_lines_not_refetched(legacy["text"]):
+                    f.write(line + "\n")
+            rows = self.conn.execute(
+                "SELECT COALESCE(pages.text, legacy_pages.text) AS text FROM pages"
+                " LEFT JOIN legacy_pages ON legacy_pages.kind = pages.kind AND legacy_pages.url = pages.url"
+                " WHERE pages.kind = ? AND COALESCE(pages.text, legacy_pages.text) IS NOT NULL ORDER BY pages.id",
+                (self.kind,),
+            )
+            for row in rows:
+                f.write(row["text"].rstrip("\n") + "\n")
+        os.replace(tmp_path, self.db_file)
+
+    def _legacy_lines_not_refetched(self, legacy_text: str) -> list:
+        """
+        URL ごとに分けられない legacy から、取り直した本文と同じ行の並びを 1 つずつ除く。
+        内容が変わった URL の旧本文は見分けられないので残る。
+        """
+        lines = legacy_text.splitlines()
+        starts: dict = {}  # 行 -> その行が現れる位置
+        for i, line in enumerate(lines):
+            starts.setdefault(line, []).append(i)
+        removed = [False] * len(lines)
+        rows = self.conn.execute("SELECT text FROM pages WHERE kind = ? AND text IS NOT NULL", (self.kind,))
+        for row in rows:
+            block = [line for line in row["text"].splitlines() if not PAGE_MARKER.match(line)]
+            if not block:
+                continue
+            for i in starts.get(block[0], []):
+                if lines[i:i + len(block)] == block and not any(removed[i:i + len(block)]):
+                    removed[i:i + len(block)] = [True] * len(block)
+                    break
+        return [line for line, drop in zip(lines, removed) if not drop]
+
+    def drop_legacy_if_superseded(self) -> bool:
+        """
+        取り直した URL の legacy を破棄する。URL ごとに分けられない legacy は、
+        旧 .db から取り込んだ全 URL の本文が取り直されたときに破棄する。
+        何か破棄したら True を返す。
+        """
+        dropped = self.conn.execute(
+            "DELETE FROM legacy_pages WHERE kind = ? AND url IN"
+            " (SELECT url FROM pages WHERE kind = ? AND text IS NOT NULL)",
+            (self.kind, self.kind),
+        ).rowcount > 0
+        if self.conn.execute("SELECT 1 FROM legacy WHERE kind = ?", (self.kind,)).fetchone() is not None:
+            pending = self.conn.execute(
+                "SELECT COUNT(*) FROM pages WHERE kind = ? AND text IS NULL", (self.kind,)
+            ).fetchone()[0]
+            if not pending:
+                self.conn.execute("DELETE FROM legacy WHERE kind = ?", (self.kind,))
+                dropped = True
+        self.conn.commit()
+        return dropped
@@ -3,77 +3,126 @@ import requests
 import pdfplumber
 import os
 import sys
-import datetime
+import asyncio
+import tempfile
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from markdownify import markdownify as md
+from crawl import (
+    DEFAULT_TIMEOUT, DEFAULT_RETRIES, add_batch_arguments, crawl, fetch_with_retry, read_url_list,
+)
+from crawl_state import CrawlStore
 
-LOG_FILE = ".pdf2db.log"
+LOG_FILE = ".pdf2db.log"  # 旧形式のログ (クロール状態ストアへの取り込みにのみ使用)
 DATABASE_DIR = "./database"
 DATABASE_FILE = os.path.join(DATABASE_DIR, "pdf.db")
+STATE_FILE = os.path.join(DATABASE_DIR, "crawl.sqlite")
 PDF_SAVE_DIR = os.path.join(DATABASE_DIR, "pdf")  # PDF 保存ディレクトリ
 
+EXTRACT_WORKERS = os.cpu_count() or 1  # ページ抽出のプロセス数
+PAGES_PER_TASK = 16                    # 1タスクで抽出するページ数
+DOWNLOAD_CHUNK_SIZE = 1 << 16          # ダウンロード時の書き込み単位 (バイト)
 
-def already_crawled(url: str, log_file: str) -> bool:
+# 単一 URL 取得用のセッション (接続を使い回す)
+session = requests.Session()
+
+
+def open_store() -> CrawlStore:
+    return CrawlStore(STATE_FILE, "pdf", DATABASE_FILE, LOG_FILE)
+
+
+def temp_pdf_file():
     """
-    ログファイルを読み込み、指定したURLが既に処理済みか確認する。
+    ダウンロード先の一意な一時ファイルを作成し、(ファイルディスクリプタ, パス) を返す。
+    同時に複数のプロセスが動いても上書きし合わない。
     """
-    if not os.path.exists(log_file):
-        return False
-    with open(log_file, "r", encoding="utf-8") as f:
-        for line in f:
-            if url in line:
-                return True
-    return False
+    os.makedirs(DATABASE_DIR, exist_ok=True)
+    return tempfile.mkstemp(dir=DATABASE_DIR, prefix="download-", suffix=".pdf")
 
 
-def download_pdf(url):
+def download_pdf(url, timeout: float = DEFAULT_TIMEOUT, headers: dict = None):
     """
-    指定されたURLからPDFをダウンロードし、一時ファイルに保存する。
+    指定されたURLからPDFをストリーミングでダウンロードし、一時ファイルに保存する。
+    (一時ファイルのパス, ファイル名, ETag, Last-Modified) を返す。
+    条件付き GET で 304 Not Modified が返った場合は None を返す。
     """
     print(f"📥 ダウンロード中: {url}")
-    response = requests.get(url)
-    response.raise_for_status()  # エラーチェック
+    with session.get(url, timeout=timeout, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()  # エラーチェック
 
-    pdf_filename = url.split("/")[-1]  # URL からファイル名を取得
-    temp_pdf_path = os.path.join(DATABASE_DIR, "temp.pdf")
+        pdf_filename = url.split("/")[-1]  # URL からファイル名を取得
+        fd, temp_pdf_path = temp_pdf_file()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        except BaseException:
+            os.remove(temp_pdf_path)
+            raise
 
-    with open(temp_pdf_path, "wb") as f:
-        f.write(response.content)
+    return temp_pdf_path, pdf_filename, response.headers.get("ETag"), response.headers.get("Last-Modified")
 
-    return temp_pdf_path, pdf_filename
 
+def extract_page_range(pdf_path: str, start: int, end: int) -> list:
+    """
+    start 〜 end-1 ページ目 (0 始まり) のテキストを抽出し、Markdown に変換する。
+    ワーカープロセスで実行される。(ページ番号 (1 始まり), テキスト or None) のリストを返す。
+    """
+    pages = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for i in range(start, end):
+            extracted_text = pdf.pages[i].extract_text()
+            text = md(extracted_text).strip() if extracted_text and extracted_text.strip() else None
+            pages.append((i + 1, text))
+    return pages
 
-def extract_text_from_pdf(pdf_path):
+
+def extract_pages(pdf_path: str, pool: ProcessPoolExecutor = None, workers: int = EXTRACT_WORKERS) -> list:
     """
-    PDFファイルからテキストを抽出する。
+    PDFファイルからページごとのテキストを抽出する。
+    PAGES_PER_TASK ページずつプロセスプールで並列に処理し、ページ順に並べて返す。
+    テキストが得られなかったページは (番号, None) になる (store_pdf が記録して報告する)。
+    pool を渡すとそれを使い (バッチ処理で共有する)、なければ必要に応じて作成する。
     """
     print("🔍 PDF からテキストを抽出中...")
-    text = ""
     with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            extracted_text = page.extract_text()
-            if extracted_text:
-                text += extracted_text + "\n"
-    return text.strip()
+        page_count = len(pdf.pages)
+
+    ranges = [(start, min(start + PAGES_PER_TASK, page_count)) for start in range(0, page_count, PAGES_PER_TASK)]
+    if len(ranges) <= 1 or (pool is None and workers <= 1):
+        pages = [page for start, end in ranges for page in extract_page_range(pdf_path, start, end)]
+    elif pool is not None:
+        futures = [pool.submit(extract_page_range, pdf_path, start, end) for start, end in ranges]
+        pages = [page for future in futures for page in future.result()]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as own_pool:
+            futures = [own_pool.submit(extract_page_range, pdf_path, start, end) for start, end in ranges]
+            pages = [page for future in futures for page in future.result()]
+    return pages
 
 
-def save_to_database(text):
+def page_marker(number: int) -> str:
     """
-    抽出したテキストをデータベースファイルに1行ずつ保存する。
+    ページの先頭に書く行。pull.py / 取り込みデーモンはこの行をドキュメントとして数えず、
+    後続の行のメタデータ (page) にする (src/gen/database.py の page_marker と同じ形式)。
     """
-    os.makedirs(DATABASE_DIR, exist_ok=True)
-    with open(DATABASE_FILE, "a", encoding="utf-8") as db_file:
-        for line in text.splitlines():
-            db_file.write(line.strip() + "\n")
+    return f"<!-- page: {number} -->"
+
+
+def join_pages(pages: list) -> str:
+    """
+    テキストのあるページだけを、ページ番号の行を付けてページ順に連結する。
+    """
+    return "\n".join(f"{page_marker(number)}\n{text}" for number, text in pages if text)
 
 
-def log_url(url, pdf_filename):
+def normalize_lines(text: str) -> str:
     """
-    処理したURLをログファイルに記録する。
+    データベースの形式 (1行ずつ前後の空白を除去) にそろえる。
     """
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-        log_file.write(f"[{timestamp}] {url} {pdf_filename}\n")
+    return "\n".join(line.strip() for line in text.splitlines())
 
 
 def save_pdf(pdf_path, pdf_filename):
@@ -87,62 +136,197 @@ def save_pdf(pdf_path, pdf_filename):
     return save_path
 
 
-def fetch_and_store(url: str, save_pdf_flag: bool = False, force_update: bool = False):
+def report_empty_pages(store: CrawlStore, url: str, page_count: int):
     """
-    URL から PDF を取得し、テキストを Markdown 形式でデータベースに保存する。
+    テキストが得られなかったページ (クロール状態ストアに記録した分) を表示する。
     """
-    # 既に処理済みのURLならスキップ（-r時は強制実行）
-    if not force_update and already_crawled(url, LOG_FILE):
-        print(f"✅ {url} は既に処理済みです。")
-        return
-
-    # PDFをダウンロード
-    try:
-        pdf_path, pdf_filename = download_pdf(url)
-    except Exception as e:
-        print(f"❌ PDFのダウンロードエラー: {e}")
-        return
-
-    # PDFからテキストを抽出
-    text = extract_text_from_pdf(pdf_path)
-    if not text:
-        print("⚠️ 抽出されたテキストがありません。")
-        return
-
-    # テキストを Markdown に変換
-    markdown_text = md(text)
+    empty = store.empty_parts(url)
+    if empty:
+        shown = ", ".join(str(number) for number in empty[:20]) + (" ..." if len(empty) > 20 else "")
+        print(f"⚠️ テキストのないページ ({len(empty)}/{page_count}): {shown}")
 
-    # データベースに保存
-    save_to_database(markdown_text)
-    print(f"✅ データ保存完了: {DATABASE_FILE}")
 
-    # ログに記録
-    log_url(url, pdf_filename)
-    print(f"📝 ログ記録完了: {LOG_FILE}")
+def store_pdf(store: CrawlStore, url: str, pdf_path: str, pdf_filename: str, pages: list,
+              save_pdf_flag: bool = False, etag=None, last_modified=None, export: bool = True) -> str:
+    """
+    ページごとの変換済みテキストをクロール状態ストアに記録して pdf.db に反映し、PDF を保存または削除する。
+    本文には各ページの先頭にページ番号の行を入れる (インデックスでは各行のメタデータ page になる)。
+    ページ番号・文字数・テキストの有無はページ単位でも記録し、テキストのないページを報告する。
+    新しい PDF は追記し、内容が変わった PDF は pdf.db を書き直して置き換える
+    (export=False の場合は書き直しを呼び出し側に任せる)。
+    "new" / "changed" / "unchanged" を返す。
+    """
+    text = normalize_lines(join_pages(pages))
+    try:
+        status = store.record(url, pdf_filename, text, etag=etag, last_modified=last_modified)
+        store.record_parts(url, pages)
+        report_empty_pages(store, url, len(pages))
+        if status == "new":
+            store.append(text)
+            print(f"✅ データ保存完了: {DATABASE_FILE} ({pdf_filename})")
+        elif status == "changed":
+            if export:
+                store.export()
+            print(f"♻️ 更新された PDF を置き換えました: {url}")
+        else:
+            print(f"⏭ 変更なし: {url}")
+    except BaseException:
+        os.remove(pdf_path)
+        raise
 
     # PDF を保存するオプションが有効なら保存
     if save_pdf_flag:
         save_pdf(pdf_path, pdf_filename)
     else:
         os.remove(pdf_path)  # 一時ファイル削除
+    return status
 
 
-def reprocess_logged_urls(save_pdf_flag: bool = False):
+def fetch_and_store(url: str, save_pdf_flag: bool = False, force_update: bool = False,
+                    timeout: float = DEFAULT_TIMEOUT, workers: int = EXTRACT_WORKERS):
     """
-    .pdf2db.log に記録されているURLをすべて再取得する。
+    URL から PDF を取得し、テキストを Markdown 形式でデータベースに保存する。
+    -r 時は ETag / Last-Modified による条件付き GET で、変更のない PDF を取得しない。
+    """
+    store = open_store()
+    try:
+        # 既に処理済みのURLならスキップ（-r時は強制実行）
+        if not force_update and store.is_crawled(url):
+            print(f"✅ {url} は既に処理済みです。")
+            return
+
+        # PDFをダウンロード
+        try:
+            downloaded = download_pdf(url, timeout=timeout, headers=store.conditional_headers(url))
+        except Exception as e:
+            print(f"❌ PDFのダウンロードエラー: {e}")
+            return
+        if downloaded is None:
+            store.mark_not_modified(url)
+            print(f"⏭ 変更なし (304): {url}")
+            return
+        pdf_path, pdf_filename, etag, last_modified = downloaded
+
+        # PDFからページごとにテキストを抽出し、Markdown に変換
+        try:
+            pages = extract_pages(pdf_path, workers=workers)
+        except BaseException:
+            os.remove(pdf_path)
+            raise
+        if not any(text for _, text in pages):
+            print("⚠️ 抽出されたテキストがありません。")
+            os.remove(pdf_path)
+            return
+
+        # データベースに保存
+        store_pdf(store, url, pdf_path, pdf_filename, pages, save_pdf_flag,
+                  etag=etag, last_modified=last_modified)
+    finally:
+        store.close()
+
+
+async def download_pdf_async(client, url: str, limiter, retries: int = DEFAULT_RETRIES, headers: dict = None):
+    """
+    PDF をストリーミングで一意な一時ファイルにダウンロードし、
+    (一時ファイルのパス, ファイル名, ETag, Last-Modified) を返す。
+    条件付き GET で 304 Not Modified が返った場合は None を返す。
     """
-    if not os.path.exists(LOG_FILE):
-        print("❌ ログファイルが存在しません。")
-        sys.exit(1)
 
-    print("🔄 過去に取得したPDFを再処理中...")
-    with open(LOG_FILE, "r", encoding="utf-8") as log_f:
-        lines = log_f.readlines()
+    async def fetch(client, url):
+        fd, tmp_path = temp_pdf_file()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with client.stream("GET", url, headers=headers) as response:
+                    if response.status_code == 304:
+                        os.remove(tmp_path)
+                        return None
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes():
+                        f.write(chunk)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return tmp_path, response.headers.get("ETag"), response.headers.get("Last-Modified")
 
-    urls = [line.split(" ")[1] for line in lines if len(line.split(" ")) > 1]
+    print(f"📥 ダウンロード中: {url}")
+    result = await fetch_with_retry(client, url, limiter, retries=retries, fetch=fetch)
+    if result is None:
+        return None
+    tmp_path, etag, last_modified = result
+    return tmp_path, url.split("/")[-1], etag, last_modified
 
-    for url in urls:
-        fetch_and_store(url, save_pdf_flag, force_update=True)
+
+def crawl_batch(urls: list, save_pdf_flag: bool = False, force_update: bool = False, concurrency: int = 8,
+                rate: float = 2.0, timeout: float = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES,
+                workers: int = EXTRACT_WORKERS):
+    """
+    複数の PDF を並列にダウンロード・変換する。書き込みは単一のライターで直列化される。
+    ページ抽出は全 PDF で共有するプロセスプールで行う。
+    変更のあった PDF があれば、最後に pdf.db を一度だけ書き直す。
+    """
+    store = open_store()
+    counts = {"new": 0, "changed": 0, "unchanged": 0}
+
+    async def process(client, url, limiter):
+        if not force_update and store.is_crawled(url):
+            print(f"✅ {url} は既に処理済みです。")
+            return None
+        downloaded = await download_pdf_async(client, url, limiter, retries=retries,
+                                              headers=store.conditional_headers(url))
+        if downloaded is None:
+            return (url, None)
+        pdf_path, pdf_filename, etag, last_modified = downloaded
+        try:
+            pages = await asyncio.to_thread(extract_pages, pdf_path, pool)
+        except BaseException:
+            os.remove(pdf_path)
+            raise
+        if not any(text for _, text in pages):
+            print(f"⚠️ 抽出されたテキストがありません: {url}")
+            os.remove(pdf_path)
+            return None
+        return (url, pdf_path, pdf_filename, pages, etag, last_modified)
+
+    def write(result):
+        if result[1] is None:
+            store.mark_not_modified(result[0])
+            print(f"⏭ 変更なし (304): {result[0]}")
+            counts["unchanged"] += 1
+            return
+        url, pdf_path, pdf_filename, pages, etag, last_modified = result
+        status = store_pdf(store, url, pdf_path, pdf_filename, pages, save_pdf_flag,
+                           etag=etag, last_modified=last_modified, export=False)
+        counts[status] += 1
+
+    pool = ProcessPoolExecutor(max_workers=max(1, workers))
+    try:
+        print(f"🚀 {len(urls)} 件を並列取得します (同時 {concurrency} 件, ホストごと {rate} 件/秒)")
+        stats = asyncio.run(crawl(urls, process, write, concurrency=concurrency, host_rate=rate, timeout=timeout))
+        legacy_dropped = store.drop_legacy_if_superseded()
+        if counts["changed"] or legacy_dropped:
+            store.export()
+            print(f"📝 {DATABASE_FILE} を書き直しました")
+    finally:
+        pool.shutdown()
+        store.close()
+    print(f"📊 完了: 新規 {counts['new']} 件 / 更新 {counts['changed']} 件 / 変更なし {counts['unchanged']} 件"
+          f" / 失敗 {stats['failed']} 件 / スキップ {stats['skipped']} 件")
+
+
+def logged_urls() -> list:
+    """
+    クロール状態ストアに記録されているURLを返す。
+    """
+    store = open_store()
+    try:
+        urls = store.urls()
+    finally:
+        store.close()
+    if not urls:
+        print("❌ 取得済みのURLがありません。")
+        sys.exit(1)
+    return urls
 
 
 def main():
@@ -165,15 +349,27 @@ def main():
         action="store_true",
         help="PDF ファイルを保存"
     )
+    parser.add_argument(
+        "-j", "--workers",
+        type=int,
+        default=EXTRACT_WORKERS,
+        help=f"ページ抽出に使うプロセス数 (デフォルト: {EXTRACT_WORKERS})"
+    )
+    add_batch_arguments(parser)
 
     args = parser.parse_args()
+    options = dict(concurrency=args.concurrency, rate=args.rate, timeout=args.timeout, retries=args.retries,
+                   workers=args.workers)
 
     if args.reprocess:
-        reprocess_logged_urls(args.save)
+        print("🔄 過去に取得したPDFを再処理中...")
+        crawl_batch(logged_urls(), args.save, force_update=True, **options)
+    elif args.batch:
+        crawl_batch(read_url_list(args.batch), args.save, **options)
     elif args.url:
-        fetch_and_store(args.url, args.save)
+        fetch_and_store(args.url, args.save, timeout=args.timeout, workers=args.workers)
     else:
-        print("Usage: python p2d.py <PDF_URL> | -r [-s]")
+        print("Usage: python p2d.py <PDF_URL> | -r [-s] | -b URL_LIST [-s]")
         sys.exit(1)
 
 
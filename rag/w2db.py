@@ -4,52 +4,37 @@ from bs4 import BeautifulSoup
 import re
 import sys
 import os
-import datetime
-
-LOG_FILE = ".wiki2db.log"
+import asyncio
+import argparse
+from crawl import (
+    DEFAULT_TIMEOUT, DEFAULT_RETRIES, add_batch_arguments, crawl, fetch_with_retry, read_url_list,
+)
+from crawl_state import CrawlStore
+
+LOG_FILE = ".wiki2db.log"  # 旧形式のログ (クロール状態ストアへの取り込みにのみ使用)
 DATABASE_DIR = "./database"
 DATABASE_FILE = os.path.join(DATABASE_DIR, "wiki.db")
+STATE_FILE = os.path.join(DATABASE_DIR, "crawl.sqlite")
 
+# 単一 URL 取得用のセッション (接続を使い回す)
+session = requests.Session()
 
-def already_crawled(url: str, log_file: str) -> bool:
-    """
-    ログファイルを読み込み、指定したURLが既に処理済みか確認する。
-    """
-    if not os.path.exists(log_file):
-        return False
-    with open(log_file, "r", encoding="utf-8") as f:
-        for line in f:
-            if url in line:
-                return True
-    return False
+
+def open_store() -> CrawlStore:
+    return CrawlStore(STATE_FILE, "wiki", DATABASE_FILE, LOG_FILE, legacy_line_per_url=True)
 
 
-def fetch_and_store(url: str, force_update: bool = False):
+def extract_page(html: str):
     """
-    URL から HTML を取得し、不要な要素を削除した後、テキストをデータベースに保存する。
+    HTML から不要な要素を削除し、(タイトル, 1行に整形した本文) を返す。
+    本文が見つからなければ None を返す。
     """
-    # 既に処理済みのURLならスキップ（-r時は強制実行）
-    if not force_update and already_crawled(url, LOG_FILE):
-        print(f"✅ {url} は既に処理済みです。")
-        return
-
-    print(f"🌍 URL取得中: {url}")
-
-    # URLからHTMLを取得
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-    except Exception as e:
-        print(f"❌ URLの取得エラー: {e}")
-        return
-
     # BeautifulSoupでHTMLをパース
-    soup = BeautifulSoup(response.text, "html.parser")
+    soup = BeautifulSoup(html, "html.parser")
     content_div = soup.find(id="content")
 
     if content_div is None:
-        print("❌ ID 'content' が見つかりませんでした。")
-        return
+        return None
 
     # 不要な要素を削除
     for elem in content_div.find_all(attrs={"role": "presentation"}):
@@ -66,57 +51,162 @@ def fetch_and_store(url: str, force_update: bool = False):
     # テキストを抽出し、余分な空白をまとめて1行に整形
     raw_text = content_div.get_text(separator=" ", strip=True)
     one_line_text = re.sub(r'\s+', ' ', raw_text)
+    return page_title, one_line_text
 
-    # データベース保存先ディレクトリの作成（存在しなければ）
-    os.makedirs(DATABASE_DIR, exist_ok=True)
-
-    # wiki.dbに追記
-    try:
-        with open(DATABASE_FILE, "a", encoding="utf-8") as f:
-            f.write(one_line_text + "\n")
-    except Exception as e:
-        print(f"❌ データベースファイル書き込みエラー: {e}")
-        return
 
-    # ログファイルにタイムスタンプ付きでURLとタイトルを記録
-    try:
-        with open(LOG_FILE, "a", encoding="utf-8") as log_f:
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-            log_f.write(f"[{timestamp}] {url} {page_title}\n")
-    except Exception as e:
-        print(f"❌ ログファイル書き込みエラー: {e}")
-        return
+def store_page(store: CrawlStore, url: str, page_title: str, text: str,
+               etag=None, last_modified=None, export: bool = True) -> str:
+    """
+    取得したページをクロール状態ストアに記録し、wiki.db に反映する。
+    新しいページは追記し、内容が変わったページは wiki.db を書き直して置き換える
+    (export=False の場合は書き直しを呼び出し側に任せる)。
+    "new" / "changed" / "unchanged" を返す。
+    """
+    status = store.record(url, page_title, text, etag=etag, last_modified=last_modified)
+    if status == "new":
+        store.append(text)
+        print(f"✅ データ保存完了: {url} ({page_title})")
+    elif status == "changed":
+        if export:
+            store.export()
+        print(f"♻️ 更新されたページを置き換えました: {url} ({page_title})")
+    else:
+        print(f"⏭ 変更なし: {url}")
+    return status
 
-    print(f"✅ データ保存完了: {url} ({page_title})")
 
+def fetch_and_store(url: str, force_update: bool = False, timeout: float = DEFAULT_TIMEOUT):
+    """
+    URL から HTML を取得し、不要な要素を削除した後、テキストをデータベースに保存する。
+    -r 時は ETag / Last-Modified による条件付き GET で、変更のないページを取得しない。
+    """
+    store = open_store()
+    try:
+        # 既に処理済みのURLならスキップ（-r時は強制実行）
+        if not force_update and store.is_crawled(url):
+            print(f"✅ {url} は既に処理済みです。")
+            return
+
+        print(f"🌍 URL取得中: {url}")
+
+        # URLからHTMLを取得
+        try:
+            response = session.get(url, timeout=timeout, headers=store.conditional_headers(url))
+            if response.status_code == 304:
+                store.mark_not_modified(url)
+                print(f"⏭ 変更なし (304): {url}")
+                return
+            response.raise_for_status()
+        except Exception as e:
+            print(f"❌ URLの取得エラー: {e}")
+            return
+
+        page = extract_page(response.text)
+        if page is None:
+            print("❌ ID 'content' が見つかりませんでした。")
+            return
+
+        try:
+            store_page(store, url, *page, etag=response.headers.get("ETag"),
+                       last_modified=response.headers.get("Last-Modified"))
+        except Exception as e:
+            print(f"❌ データベースファイル書き込みエラー: {e}")
+    finally:
+        store.close()
+
+
+def crawl_batch(urls: list, force_update: bool = False, concurrency: int = 8, rate: float = 2.0,
+                timeout: float = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES):
+    """
+    複数の URL を並列に取得する。書き込みは単一のライターで直列化される。
+    変更のあったページがあれば、最後に wiki.db を一度だけ書き直す。
+    """
+    store = open_store()
+    counts = {"new": 0, "changed": 0, "unchanged": 0}
+
+    async def process(client, url, limiter):
+        if not force_update and store.is_crawled(url):
+            print(f"✅ {url} は既に処理済みです。")
+            return None
+        print(f"🌍 URL取得中: {url}")
+        response = await fetch_with_retry(client, url, limiter, retries=retries,
+                                          headers=store.conditional_headers(url))
+        if response.status_code == 304:
+            return (url, None)
+        page = await asyncio.to_thread(extract_page, response.text)
+        if page is None:
+            print(f"❌ ID 'content' が見つかりませんでした: {url}")
+            return None
+        return (url, page, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+    def write(result):
+        if result[1] is None:
+            store.mark_not_modified(result[0])
+            print(f"⏭ 変更なし (304): {result[0]}")
+            counts["unchanged"] += 1
+            return
+        url, page, etag, last_modified = result
+        status = store_page(store, url, *page, etag=etag, last_modified=last_modified, export=False)
+        counts[status] += 1
 
-def reprocess_logged_urls():
+    try:
+        print(f"🚀 {len(urls)} 件を並列取得します (同時 {concurrency} 件, ホストごと {rate} 件/秒)")
+        stats = asyncio.run(crawl(urls, process, write, concurrency=concurrency, host_rate=rate, timeout=timeout))
+        legacy_dropped = store.drop_legacy_if_superseded()
+        if counts["changed"] or legacy_dropped:
+            store.export()
+            print(f"📝 {DATABASE_FILE} を書き直しました")
+    finally:
+        store.close()
+    print(f"📊 完了: 新規 {counts['new']} 件 / 更新 {counts['changed']} 件 / 変更なし {counts['unchanged']} 件"
+          f" / 失敗 {stats['failed']} 件 / スキップ {stats['skipped']} 件")
+
+
+def logged_urls() -> list:
     """
-    .wiki2db.log に記録されているURLをすべて再取得する。
+    クロール状態ストアに記録されているURLを返す。
     """
-    if not os.path.exists(LOG_FILE):
-        print("❌ ログファイルが存在しません。")
+    store = open_store()
+    try:
+        urls = store.urls()
+    finally:
+        store.close()
+    if not urls:
+        print("❌ 取得済みのURLがありません。")
         sys.exit(1)
-
-    print("🔄 過去に取得したURLを再処理中...")
-    with open(LOG_FILE, "r", encoding="utf-8") as log_f:
-        lines = log_f.readlines()
-
-    urls = [line.split(" ")[1] for line in lines if len(line.split(" ")) > 1]
-
-    for url in urls:
-        fetch_and_store(url, force_update=True)
+    return urls
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python w2db.py URL | -r")
-        sys.exit(1)
-
-    if sys.argv[1] == "-r":
-        reprocess_logged_urls()
+    parser = argparse.ArgumentParser(
+        description="Wikipedia のページからテキストデータベースを作成するスクリプト",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "url",
+        nargs="?",
+        help="取得するページの URL"
+    )
+    parser.add_argument(
+        "-r", "--reprocess",
+        action="store_true",
+        help="過去に取得した URL をすべて再取得 (並列)"
+    )
+    add_batch_arguments(parser)
+
+    args = parser.parse_args()
+    options = dict(concurrency=args.concurrency, rate=args.rate, timeout=args.timeout, retries=args.retries)
+
+    if args.reprocess:
+        print("🔄 過去に取得したURLを再処理中...")
+        crawl_batch(logged_urls(), force_update=True, **options)
+    elif args.batch:
+        crawl_batch(read_url_list(args.batch), **options)
+    elif args.url:
+        fetch_and_store(args.url, timeout=args.timeout)
     else:
-        fetch_and_store(sys.argv[1])
+        print("Usage: python w2db.py URL | -r | -b URL_LIST")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
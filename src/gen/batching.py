@@ -0,0 +1,101 @@
+# gen/batching.py
+"""
+複数のリクエスト (スレッド) から来た小さな処理をまとめて 1 回で実行するマイクロバッチャー。
+クエリの埋め込み (Ollama /api/embed) と Cross Encoder の再ランキングで使う。
+
+最初の要素が届いてから window_ms 待つか max_batch 件たまった時点で、専用スレッドが
+まとめて fn(items) を呼び、結果をそれぞれの呼び出し元に返す。
+"""
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+_batchers: List["MicroBatcher"] = []
+
+
+class MicroBatcher:
+    """
+    fn は要素のリストを受け取り、同じ順序・同じ件数の結果のリストを返す関数。
+    fn が例外を送出した場合は、そのバッチに含まれる呼び出し元すべてに同じ例外を送出する。
+    """
+
+    def __init__(self, name: str, fn: Callable[[list], list], window_ms: float, max_batch: int):
+        self.name = name
+        self.fn = fn
+        self.window_ms = window_ms
+        self.max_batch = max(1, max_batch)
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats = {"batches": 0, "items": 0, "max_batch": 0}
+        _batchers.append(self)
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f"batcher-{self.name}", daemon=True)
+                    self._thread.start()
+
+    def submit_many(self, items: list) -> list:
+        """items をキューに入れ、他のリクエストの分とまとめて処理された結果を返す (ブロックする)。"""
+        if not items:
+            return []
+        self._ensure_worker()
+        futures = []
+        for item in items:
+            future: Future = Future()
+            self._queue.put((item, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def submit(self, item):
+        return self.submit_many([item])[0]
+
+    def _collect(self) -> list:
+        """最初の要素を待ち、window_ms の間 (max_batch 件まで) 後続の要素を集める。"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window_ms / 1000
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            try:
+                results = self.fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"{self.name}: {len(results)} results for {len(items)} items")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+            self._stats["batches"] += 1
+            self._stats["items"] += len(items)
+            self._stats["max_batch"] = max(self._stats["max_batch"], len(items))
+
+    def stats(self) -> Dict[str, float]:
+        stats = dict(self._stats)
+        stats["average_batch"] = round(stats["items"] / stats["batches"], 2) if stats["batches"] else 0
+        return stats
+
+
+def batcher_stats() -> Dict[str, float]:
+    """すべてのバッチャーの統計を "batch.<名前>.<項目>" の形で返す (/metrics 用)。"""
+    return {
+        f"batch.{batcher.name}.{key}": value
+        for batcher in _batchers for key, value in batcher.stats().items()
+    }
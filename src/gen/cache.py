@@ -0,0 +1,175 @@
+# gen/cache.py
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# アップロード変換結果のキャッシュ設定
+UPLOAD_CACHE_ENTRIES = int(os.getenv("UPLOAD_CACHE_ENTRIES", 128))
+UPLOAD_CACHE_DIR = os.getenv("UPLOAD_CACHE_DIR", "")  # 空ならディスクキャッシュ無効
+UPLOAD_CACHE_MAX_MB = float(os.getenv("UPLOAD_CACHE_MAX_MB", 512))
+
+# 埋め込みベクトルのキャッシュ設定
+EMBEDDING_CACHE_ENTRIES = int(os.getenv("EMBEDDING_CACHE_ENTRIES", 4096))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "")
+EMBEDDING_CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", 1024))
+
+
+def content_hash(data: bytes, salt: str = "") -> str:
+    """
+    データの SHA-256 ハッシュを返す。
+    salt を指定すると (拡張子やモデル名など) 同じ内容でも別キーとして扱う。
+    """
+    h = hashlib.sha256()
+    if salt:
+        h.update(salt.encode("utf-8"))
+        h.update(b"\0")
+    h.update(data)
+    return h.hexdigest()
+
+
+class ContentCache:
+    """
+    コンテンツハッシュをキーとする LRU キャッシュ。
+    メモリ上に max_entries 件まで保持し、disk_dir を指定した場合は
+    JSON としてディスクにも保存する (合計 max_disk_bytes を超えたら古い順に削除)。
+    """
+
+    def __init__(self, name: str, max_entries: int, disk_dir: str = "", max_disk_bytes: int = 0):
+        self.name = name
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _disk_entries(self) -> list:
+        """ディスク上のエントリを (最終アクセス時刻, パス, サイズ) のリストで返す。"""
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+        return entries
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    value = json.load(f)
+                os.utime(path)  # LRU 判定用にアクセス時刻を更新
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self._remember(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Any):
+        self._remember(key, value)
+        if self.disk_dir:
+            self._write_disk(key, value)
+
+    def _remember(self, key: str, value: Any):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _write_disk(self, key: str, value: Any):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += os.path.getsize(path) - old_size
+        except OSError as e:
+            logger.warning(f"[{self.name}] Failed to write disk cache: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        if self.max_disk_bytes and self._disk_bytes > self.max_disk_bytes:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """ディスク使用量が上限を下回るまで、最も古くアクセスされたエントリから削除する。"""
+        with self._lock:
+            entries = sorted(self._disk_entries())
+            total = sum(size for _, _, size in entries)
+            for _, path, size in entries:
+                if total <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._disk_bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._memory),
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_bytes": self._disk_bytes,
+            }
+
+
+# 変換済みアップロードテキスト (key: ファイル内容 + 拡張子)
+upload_cache = ContentCache(
+    "upload",
+    UPLOAD_CACHE_ENTRIES,
+    disk_dir=UPLOAD_CACHE_DIR,
+    max_disk_bytes=int(UPLOAD_CACHE_MAX_MB * 1024 * 1024),
+)
+
+# 埋め込みベクトル (key: テキスト + 埋め込みモデル名)
+embedding_cache = ContentCache(
+    "embedding",
+    EMBEDDING_CACHE_ENTRIES,
+    disk_dir=EMBEDDING_CACHE_DIR,
+    max_disk_bytes=int(EMBEDDING_CACHE_MAX_MB * 1024 * 1024),
+)
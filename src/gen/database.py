@@ -1,6 +1,11 @@
 # gen/database.py
 import os
+import re
 import json
+import shutil
+from datetime import datetime
+from typing import Optional
+import numpy as np
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -19,19 +24,236 @@ def load_documents() -> list:
     with open(DATABASE_PATH, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def load_vector_db() -> list:
+def load_vector_db(path: str = VECTOR_DB_PATH) -> list:
     """
     ベクトルデータベースを読み込む。
     ファイルが存在しなければ空のリストを返す。
     """
-    if not os.path.exists(VECTOR_DB_PATH):
+    if not os.path.exists(path):
         return []
-    with open(VECTOR_DB_PATH, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def save_vector_db(vector_db: list):
+def save_vector_db(vector_db: list, path: str = VECTOR_DB_PATH):
     """
     ベクトルデータベースをファイルに保存する。
+    一時ファイルに書いてから rename するので、読み込み側が書きかけの JSON を見ることはない。
     """
-    with open(VECTOR_DB_PATH, "w", encoding="utf-8") as f:
-        json.dump(vector_db, f, ensure_ascii=False, indent=4)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(vector_db, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# p2d.py が各ページの先頭に書く行。ドキュメントとしては数えず、後続の行のメタデータ (page) にする
+_PAGE_MARKER = re.compile(r"^<!-- page: (\d+) -->$")
+
+
+def page_marker(line: str) -> Optional[int]:
+    """strip() 済みの行がページ番号の行ならその番号を返す。"""
+    match = _PAGE_MARKER.match(line)
+    return int(match.group(1)) if match else None
+
+
+def load_text_documents(input_paths: list) -> list:
+    """
+    複数のTXTファイルからデータを読み込む。各行が1ドキュメントとなり、空行は無視する。
+    (ドキュメント, 読み込み元ファイル名, ファイル内の通し番号, 追加のメタデータ) のリストを返す。
+    追加のメタデータは直前のページ番号の行から取った {"page": 番号} (なければ空)。
+    ファイルが存在しなければ例外を発生させる。
+    """
+    documents = []
+    for path in input_paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"データベースファイル '{path}' が見つかりません。")
+        with open(path, "r", encoding="utf-8") as f:
+            n = 0
+            extra = {}
+            for line in f:
+                line = line.strip()
+                page = page_marker(line)
+                if page is not None:
+                    extra = {"page": page}
+                elif line:
+                    documents.append((line, os.path.basename(path), n, extra))
+                    n += 1
+    return documents
+
+
+# ==========================
+# インデックススナップショット
+# ==========================
+# 複数ワーカーで共有できるよう、ベクトルDBを mmap 可能な形式で書き出す。
+#   {INDEX_DIR}/CURRENT              ... 現在有効なバージョン名
+#   {INDEX_DIR}/<version>/embeddings.npy         ... float32 (量子化時は再スコアリング用)
+#   {INDEX_DIR}/<version>/embeddings.q.npy       ... 量子化した行列 (任意, int8 は .scale.npy も)
+#   {INDEX_DIR}/<version>/documents.bin, documents.offsets.npy
+#   {INDEX_DIR}/<version>/ids.bin, ids.offsets.npy
+#   {INDEX_DIR}/<version>/metadatas.bin, metadatas.offsets.npy (JSON 文字列)
+#   {INDEX_DIR}/<version>/faiss.index (任意)
+#   {INDEX_DIR}/<version>/meta.json
+# シャード (ソースファイルごとの独立したインデックス) は {INDEX_DIR}/<shard>/ 以下に上記の構成で置く。
+INDEX_DIR = os.getenv("INDEX_DIR", "../db/index")
+INDEX_KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", 3))
+# シャードの分け方: "source" (読み込み元ファイルごと) / "none" (1つのシャードにまとめる)
+INDEX_SHARD_BY = os.getenv("INDEX_SHARD_BY", "source")
+DEFAULT_SHARD = "default"
+
+
+def shard_name(metadata: Optional[dict]) -> str:
+    """
+    ドキュメントのメタデータから所属するシャード名を決める。
+    "shard" があればそれを、なければ "source" のファイル名 (拡張子なし) を使う。
+    """
+    if INDEX_SHARD_BY == "none" or not metadata:
+        return DEFAULT_SHARD
+    if metadata.get("shard"):
+        return metadata["shard"]
+    source = metadata.get("source")
+    if not source:
+        return DEFAULT_SHARD
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return re.sub(r"[^0-9A-Za-z_-]", "_", stem) or DEFAULT_SHARD
+
+
+def shard_dir(shard: str, index_dir: str = INDEX_DIR) -> str:
+    return os.path.join(index_dir, shard)
+
+
+def list_shards(index_dir: str = INDEX_DIR) -> list:
+    """CURRENT を持つシャード名の一覧を返す。"""
+    if not os.path.isdir(index_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(index_dir)
+        if not name.startswith(".") and os.path.exists(os.path.join(index_dir, name, "CURRENT"))
+    )
+
+
+class StringTable:
+    """
+    UTF-8 で連結した文字列 (<name>.bin) とオフセット (<name>.offsets.npy) を mmap し、
+    i 番目の文字列をアクセス時にデコードする。ページキャッシュはプロセス間で共有される。
+    """
+
+    def __init__(self, directory: str, name: str):
+        self._offsets = np.load(os.path.join(directory, f"{name}.offsets.npy"), mmap_mode="r")
+        blob_path = os.path.join(directory, f"{name}.bin")
+        if os.path.getsize(blob_path) > 0:
+            self._blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self._blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._blob[start:end].tobytes().decode("utf-8")
+
+    @staticmethod
+    def write(directory: str, name: str, values: list):
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        with open(os.path.join(directory, f"{name}.bin"), "wb") as f:
+            for i, value in enumerate(values):
+                data = value.encode("utf-8")
+                f.write(data)
+                offsets[i + 1] = offsets[i] + len(data)
+        np.save(os.path.join(directory, f"{name}.offsets.npy"), offsets)
+
+
+def read_current_version(index_dir: str = INDEX_DIR) -> Optional[str]:
+    """
+    CURRENT が指すバージョン名を返す。スナップショットがなければ None。
+    """
+    try:
+        with open(os.path.join(index_dir, "CURRENT"), "r", encoding="utf-8") as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    if version and os.path.isdir(os.path.join(index_dir, version)):
+        return version
+    return None
+
+
+def set_current_version(version: str, index_dir: str = INDEX_DIR):
+    """
+    CURRENT を一時ファイル + rename で原子的に書き換える。
+    各ワーカーはこのファイルの変化を見てインデックスを読み直す。
+    """
+    tmp_path = os.path.join(index_dir, f"CURRENT.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(index_dir, "CURRENT"))
+
+
+def read_snapshot_meta(version: str, index_dir: str = INDEX_DIR) -> dict:
+    with open(os.path.join(index_dir, version, "meta.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_index_snapshot(vector_db: list, index_dir: str = INDEX_DIR, extra_files=None, meta=None) -> str:
+    """
+    ベクトルDBをスナップショットとして新しいバージョンディレクトリに書き出し、バージョン名を返す。
+    一時ディレクトリに書いてから rename するので、読み込み側が書きかけのデータを見ることはない。
+    extra_files は (ファイル名, 書き込み関数(path)) のリストで、FAISS インデックスなどの保存に使う。
+    CURRENT の切り替えは呼び出し側が set_current_version で行う。
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    version = datetime.now().strftime("v%Y%m%d-%H%M%S-%f")
+    tmp_dir = os.path.join(index_dir, f".{version}.tmp")
+    os.makedirs(tmp_dir)
+
+    embeddings = np.asarray([entry["embedding"] for entry in vector_db], dtype=np.float32)
+    np.save(os.path.join(tmp_dir, "embeddings.npy"), embeddings)
+    StringTable.write(tmp_dir, "documents", [entry["document"] for entry in vector_db])
+    StringTable.write(tmp_dir, "ids", [str(entry.get("id", i)) for i, entry in enumerate(vector_db)])
+    StringTable.write(tmp_dir, "metadatas", [
+        json.dumps(entry.get("metadata") or {}, ensure_ascii=False) for entry in vector_db
+    ])
+
+    for filename, writer in extra_files or []:
+        writer(os.path.join(tmp_dir, filename))
+
+    files = {name: os.path.getsize(os.path.join(tmp_dir, name)) for name in sorted(os.listdir(tmp_dir))}
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": version,
+            "count": len(vector_db),
+            "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "files": files,  # ファイルごとのサイズ (バイト)
+            **(meta or {}),
+        }, f, ensure_ascii=False, indent=4)
+
+    os.rename(tmp_dir, os.path.join(index_dir, version))
+    return version
+
+
+def discard_index_version(version: str, index_dir: str = INDEX_DIR):
+    """検証に失敗したなど、CURRENT にしないバージョンを削除する。"""
+    if version != read_current_version(index_dir):
+        shutil.rmtree(os.path.join(index_dir, version), ignore_errors=True)
+
+
+def prune_index_versions(index_dir: str = INDEX_DIR, keep: int = INDEX_KEEP_VERSIONS):
+    """
+    CURRENT 以外の古いバージョンを keep 件だけ残して削除する。
+    削除済みのファイルを mmap 中のワーカーは、そのまま読み続けられる (inode が残るため)。
+    """
+    current = read_current_version(index_dir)
+    versions = sorted(
+        name for name in os.listdir(index_dir)
+        if name.startswith("v") and os.path.isdir(os.path.join(index_dir, name))
+    )
+    for name in versions[:-keep] if keep > 0 else versions:
+        if name != current:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
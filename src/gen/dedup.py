@@ -0,0 +1,154 @@
+# gen/dedup.py
+"""
+MinHash + LSH による近似重複ドキュメントの除去。
+Wikipedia のクロールや PDF の抽出結果に含まれる定型文・繰り返しのヘッダー・
+再クロールされたページなど、ほぼ同じ行を埋め込み前にまとめる。
+
+  1. 正規化したテキストの文字 n-gram (DEDUP_SHINGLE 文字) の集合を MinHash 署名にする
+  2. 署名を DEDUP_BANDS 個のバンドに分け、どれかのバンドが一致したものを候補にする
+  3. 署名から推定した Jaccard 類似度が DEDUP_THRESHOLD 以上なら同じクラスタにする
+
+各クラスタは入力順で最初のドキュメントを代表として残し、残りの読み込み元と ID を
+代表のメタデータ (sources / duplicates) にまとめる。
+"""
+import os
+import re
+import zlib
+import unicodedata
+from typing import Dict, List, Tuple
+import numpy as np
+from dotenv import load_dotenv
+
+from gen.database import shard_name
+
+load_dotenv()
+
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))  # 0 なら重複除去しない
+DEDUP_SHINGLE = int(os.getenv("DEDUP_SHINGLE", 5))          # n-gram の文字数
+# 重複とみなす範囲: "shard" (同じシャード内だけ。シャード指定の検索結果が変わらない) / "all"
+DEDUP_SCOPE = os.getenv("DEDUP_SCOPE", "shard")
+DEDUP_NUM_PERM = 128  # MinHash 署名の長さ
+DEDUP_BANDS = 16      # LSH のバンド数 (1 バンド 8 行。類似度 0.8 のペアは約 95% が候補になる)
+
+_MASK32 = np.uint64(0xFFFFFFFF)
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角、大文字・小文字、空白の違いを無視する。"""
+    return _SPACES.sub(" ", unicodedata.normalize("NFKC", text).lower()).strip()
+
+
+def shingle_hashes(text: str, size: int = DEDUP_SHINGLE) -> np.ndarray:
+    """文字 n-gram の 32bit ハッシュの集合を返す (n-gram より短いテキストは全体を 1 つとする)。"""
+    if len(text) <= size:
+        grams = {text}
+    else:
+        grams = {text[i:i + size] for i in range(len(text) - size + 1)}
+    return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+class MinHasher:
+    """h(x) = (a * x + b) mod 2^32 を num_perm 個使った MinHash。"""
+
+    def __init__(self, num_perm: int = DEDUP_NUM_PERM, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.a = (rng.integers(1, 1 << 32, num_perm, dtype=np.uint64) | np.uint64(1))[:, None]
+        self.b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)[:, None]
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        return ((self.a * hashes[None, :] + self.b) & _MASK32).min(axis=1).astype(np.uint32)
+
+
+def find_near_duplicates(texts: List[str], groups: List[str], threshold: float = DEDUP_THRESHOLD,
+                         shingle: int = DEDUP_SHINGLE, num_perm: int = DEDUP_NUM_PERM,
+                         bands: int = DEDUP_BANDS) -> List[List[int]]:
+    """
+    近似重複のクラスタ (2 件以上) を、入力順に並んだインデックスのリストとして返す。
+    groups が異なるテキスト同士は比較しない。
+    """
+    if not texts:
+        return []
+    hasher = MinHasher(num_perm)
+    signatures = np.vstack([hasher.signature(shingle_hashes(normalize_text(text), shingle)) for text in texts])
+    rows = num_perm // bands
+    parent = list(range(len(texts)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        buckets: Dict[tuple, List[int]] = {}
+        block = signatures[:, band * rows:(band + 1) * rows]
+        for i, group in enumerate(groups):
+            buckets.setdefault((group, block[i].tobytes()), []).append(i)
+        for members in buckets.values():
+            # バケット内は先頭とだけ比べる (同じバケットが大きくなっても二乗にならない)
+            head = members[0]
+            for j in members[1:]:
+                root_head, root_j = find(head), find(j)
+                if root_head == root_j:
+                    continue
+                if np.mean(signatures[head] == signatures[j]) >= threshold:
+                    parent[max(root_head, root_j)] = min(root_head, root_j)  # 根は入力順で最初のもの
+
+    clusters: Dict[int, List[int]] = {}
+    for i in range(len(texts)):
+        clusters.setdefault(find(i), []).append(i)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def deduplicate(documents: List[tuple], threshold: float = DEDUP_THRESHOLD,
+                scope: str = DEDUP_SCOPE) -> Tuple[List[tuple], Dict[int, List[tuple]]]:
+    """
+    load_text_documents の (ドキュメント, 読み込み元ファイル名, 通し番号, 追加のメタデータ) のリストから
+    近似重複を除く。
+    (残したドキュメントのリスト, 残したリスト内の位置 -> まとめたドキュメントのリスト) を返す。
+    """
+    if threshold <= 0 or len(documents) < 2:
+        return list(documents), {}
+    groups = [shard_name({"source": source}) if scope == "shard" else "" for _, source, _, _ in documents]
+    clusters = find_near_duplicates([doc for doc, _, _, _ in documents], groups, threshold)
+    removed = {}
+    for members in clusters:
+        removed.update({i: members[0] for i in members[1:]})
+
+    kept, positions, duplicates = [], {}, {}
+    for i, document in enumerate(documents):
+        if i in removed:
+            duplicates.setdefault(positions[removed[i]], []).append(document)
+        else:
+            positions[i] = len(kept)
+            kept.append(document)
+    return kept, duplicates
+
+
+def merge_duplicate_metadata(metadata: dict, duplicates: List[tuple]) -> dict:
+    """
+    代表のメタデータに、まとめたドキュメントの読み込み元 (sources) と ID (duplicates) を加える。
+    duplicates の各要素にはページ番号などの追加のメタデータも含める。
+    """
+    sources = {metadata.get("source")} | {source for _, source, _, _ in duplicates}
+    return {
+        **metadata,
+        "sources": sorted(source for source in sources if source),
+        "duplicates": [
+            {"id": f"{shard_name({'source': source})}:{n}", "source": source, **extra}
+            for _, source, n, extra in duplicates
+        ],
+    }
+
+
+def dedup_report(total: int, duplicates: Dict[int, List[tuple]]) -> dict:
+    removed = sum(len(group) for group in duplicates.values())
+    return {
+        "documents": total,
+        "kept": total - removed,
+        "removed": removed,
+        "clusters": len(duplicates),
+        "largest_cluster": max((len(group) + 1 for group in duplicates.values()), default=0),
+        "removed_ratio": round(removed / total, 4) if total else 0.0,
+    }
@@ -0,0 +1,279 @@
+# gen/ingest.py
+"""
+w2db.py / p2d.py が書き出すテキストデータベース (rag/database/*.db) を監視し、
+追記された行をバッチで埋め込んで「ライブログ」に書き出す。
+サーバーの各ワーカーはライブログを追いかけ、使用中のインデックスへそのまま追加する
+(スナップショットの作り直しは不要)。
+
+  {INDEX_DIR}/.live/<shard>.jsonl  ... 埋め込み済みのレコード (1行1件, 追記のみ)
+  {INDEX_DIR}/.live/state.json     ... 監視中のファイルごとの読み込み位置
+
+ID は pull.py と同じ "<シャード>:<ファイル内の通し番号>" なので、後から pull.py で
+作り直したスナップショットとも重複しない。
+"""
+import os
+import glob
+import json
+import time
+import logging
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+
+from gen.database import (
+    INDEX_DIR, StringTable, list_shards, page_marker, read_current_version, shard_dir, shard_name,
+)
+from gen.search import VECTOR_STORE, ChromaStore, generate_embeddings
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+INGEST_DIR = os.getenv("INGEST_DIR", "../rag/database")
+INGEST_PATTERN = os.getenv("INGEST_PATTERN", "*.db")
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", 2))  # ファイルの変化を確認する間隔 (秒)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 64))         # 1 回の埋め込みリクエストの件数
+INGEST_RETRY_INTERVAL = 10                                          # 埋め込み失敗時の待ち時間 (秒)
+
+LIVE_DIR = os.path.join(INDEX_DIR, ".live")
+STATE_FILE = os.path.join(LIVE_DIR, "state.json")
+
+
+def live_log_path(shard: str) -> str:
+    return os.path.join(LIVE_DIR, f"{shard}.jsonl")
+
+
+def live_log_sizes() -> Dict[str, int]:
+    """各シャードのライブログの現在のサイズ (バイト) を返す。"""
+    if not os.path.isdir(LIVE_DIR):
+        return {}
+    return {
+        name[:-len(".jsonl")]: os.path.getsize(os.path.join(LIVE_DIR, name))
+        for name in os.listdir(LIVE_DIR) if name.endswith(".jsonl")
+    }
+
+
+def read_live_log(shard: str, offset: int) -> tuple:
+    """
+    ライブログを offset から読み、(レコードのリスト, 次の offset) を返す。
+    書き込み途中の最終行 (改行で終わっていない行) は次回に回す。
+    """
+    path = live_log_path(shard)
+    if not os.path.exists(path):
+        return [], 0
+    if os.path.getsize(path) < offset:
+        offset = 0  # ライブログが作り直された
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    records = []
+    for line in data[:end].splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            logger.warning(f"Skipping broken live log record in {path}")
+    return records, offset + end
+
+
+def _decode_line(raw: bytes) -> str:
+    """
+    load_text_documents と同じく、デコードしてから str.strip() する。
+    bytes.strip() は全角スペース (U+3000) などを除かないため、行番号 (ID) がずれる。
+    """
+    return raw.decode("utf-8", errors="replace").strip()
+
+
+def _scan_line(line: str, extra: dict) -> tuple:
+    """
+    load_text_documents と同じ規則で 1 行を分類し、(ドキュメントか, 後続の行の追加のメタデータ) を返す。
+    ページ番号の行はドキュメントとして数えない。
+    """
+    page = page_marker(line)
+    if page is not None:
+        return False, {"page": page}
+    return bool(line), extra
+
+
+def indexed_counts() -> Dict[str, int]:
+    """
+    現在のスナップショットに含まれるドキュメント数を読み込み元ファイル (source) ごとに数える。
+    近似重複として代表にまとめられた行 (metadata の duplicates) も数に含める。
+    初めて見るファイルは、この件数分の行をインデックス済みとして読み飛ばす。
+    """
+    counts: Dict[str, int] = {}
+    for shard in list_shards():
+        version = read_current_version(shard_dir(shard))
+        path = os.path.join(shard_dir(shard), version or "")
+        if version is None or not os.path.exists(os.path.join(path, "metadatas.bin")):
+            continue
+        metadatas = StringTable(path, "metadatas")
+        for i in range(len(metadatas)):
+            metadata = json.loads(metadatas[i] or "{}") or {}
+            for source in [metadata.get("source")] + [d.get("source") for d in metadata.get("duplicates", [])]:
+                if source:
+                    counts[source] = counts.get(source, 0) + 1
+    return counts
+
+
+class Ingester:
+    """
+    ディレクトリ内のテキストファイルを tail し、新しい行を埋め込んでライブログへ追記する。
+    ファイルごとの読み込み位置 (バイト位置・行番号・直前のページ番号・inode) は state.json に保存し、
+    再起動しても続きから処理する。バックエンドが ChromaDB の場合は直接 upsert する。
+    """
+
+    def __init__(self, directory: str = INGEST_DIR, pattern: str = INGEST_PATTERN,
+                 batch_size: int = INGEST_BATCH_SIZE):
+        self.directory = directory
+        self.pattern = pattern
+        self.batch_size = batch_size
+        self.state: Dict[str, dict] = self._load_state()
+        self._indexed_counts: Optional[Dict[str, int]] = None
+        self._chroma = ChromaStore() if VECTOR_STORE == "chroma" else None
+        self.ingested = 0
+        self.last_lag_seconds = 0.0
+
+    @staticmethod
+    def _load_state() -> Dict[str, dict]:
+        try:
+            with open(STATE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        os.makedirs(LIVE_DIR, exist_ok=True)
+        tmp_path = f"{STATE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, STATE_FILE)
+
+    def _start_position(self, path: str, source: str) -> dict:
+        """
+        初めて見るファイルの読み込み開始位置を決める。
+        スナップショットに含まれている行数 (空行を除く) の分だけ読み飛ばす。
+        """
+        if self._indexed_counts is None:
+            self._indexed_counts = indexed_counts()
+        skip = self._indexed_counts.get(source, 0)
+        offset = lines = 0
+        extra = {}
+        if skip:
+            with open(path, "rb") as f:
+                for raw in f:
+                    if lines >= skip:
+                        break
+                    offset += len(raw)
+                    is_document, extra = _scan_line(_decode_line(raw), extra)
+                    lines += is_document
+        logger.info(f"Watching {path} from line {lines} (byte {offset})")
+        return {"offset": offset, "lines": lines, "extra": extra}
+
+    def _read_new_lines(self, path: str) -> List[dict]:
+        """前回の位置から追記された完全な行を読み、ドキュメントのリストを返す (位置はまだ進めない)。"""
+        source = os.path.basename(path)
+        st = os.stat(path)
+        position = self.state.get(path)
+        if position is None:
+            position = self._start_position(path, source)
+            position["inode"] = st.st_ino
+            self.state[path] = position
+            self._save_state()
+        elif position.get("inode") != st.st_ino or st.st_size < position["offset"]:
+            # 追記ではなく書き直された (crawl_state の export など)。行番号がずれるので
+            # 差分は取り込まず末尾から監視を続ける。取り込むには pull.py で作り直す。
+            logger.warning(f"{path} was rewritten; skipping to the end (rebuild with pull.py to re-index).")
+            lines = 0
+            extra = {}
+            with open(path, "rb") as f:
+                for raw in f:
+                    is_document, extra = _scan_line(_decode_line(raw), extra)
+                    lines += is_document
+            self.state[path] = {"offset": st.st_size, "lines": lines, "extra": extra, "inode": st.st_ino}
+            self._save_state()
+            return []
+        if st.st_size == position["offset"]:
+            return []
+
+        with open(path, "rb") as f:
+            f.seek(position["offset"])
+            data = f.read()
+        now = time.time()
+        shard = shard_name({"source": source})
+        docs = []
+        offset, n = position["offset"], position["lines"]
+        extra = position.get("extra", {})
+        for raw in data.splitlines(keepends=True):
+            if not raw.endswith(b"\n"):
+                break  # 書き込み途中の行は次回
+            offset += len(raw)
+            line = _decode_line(raw)
+            is_document, extra = _scan_line(line, extra)
+            if not is_document:
+                continue
+            docs.append({
+                "id": f"{shard}:{n}", "document": line,
+                "metadata": {"source": source, "shard": shard, **extra},
+                "seen": now, "path": path, "offset": offset, "lines": n + 1, "extra": extra,
+            })
+            n += 1
+        if not docs and offset != position["offset"]:
+            position["offset"] = offset  # 空行・ページ番号の行だけが追記された
+            position["extra"] = extra
+            self._save_state()
+        return docs
+
+    def _write_batch(self, docs: List[dict]):
+        """1バッチ分を埋め込み、ライブログ (または ChromaDB) に書き込んで読み込み位置を進める。"""
+        embeddings = generate_embeddings([doc["document"] for doc in docs])
+        if self._chroma is not None:
+            self._chroma.upsert(
+                ids=[doc["id"] for doc in docs], embeddings=embeddings,
+                documents=[doc["document"] for doc in docs], metadatas=[doc["metadata"] for doc in docs],
+            )
+        else:
+            os.makedirs(LIVE_DIR, exist_ok=True)
+            by_shard: Dict[str, list] = {}
+            for doc, embedding in zip(docs, embeddings):
+                record = {
+                    "id": doc["id"], "document": doc["document"], "metadata": doc["metadata"],
+                    "embedding": embedding, "seen": doc["seen"],
+                }
+                by_shard.setdefault(doc["metadata"]["shard"], []).append(json.dumps(record, ensure_ascii=False))
+            for shard, lines in by_shard.items():
+                # 1回の write でまとめて追記する (読み手は改行で終わる行だけを読む)
+                with open(live_log_path(shard), "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+
+        # ライブログへの書き込み後に位置を保存する (途中で落ちても取りこぼさない。重複は読み手が除く)
+        for doc in docs:
+            position = self.state[doc["path"]]
+            position["offset"], position["lines"], position["extra"] = doc["offset"], doc["lines"], doc["extra"]
+        self._save_state()
+        self.ingested += len(docs)
+        self.last_lag_seconds = time.time() - min(doc["seen"] for doc in docs)
+
+    def poll(self) -> int:
+        """監視対象のファイルを1回確認し、取り込んだ件数を返す。"""
+        docs = []
+        for path in sorted(glob.glob(os.path.join(self.directory, self.pattern))):
+            try:
+                docs.extend(self._read_new_lines(path))
+            except OSError as e:
+                logger.warning(f"Failed to read {path}: {e}")
+        for start in range(0, len(docs), self.batch_size):
+            batch = docs[start:start + self.batch_size]
+            self._write_batch(batch)
+            logger.info(f"Ingested {len(batch)} lines (lag {self.last_lag_seconds:.1f}s, total {self.ingested})")
+        return len(docs)
+
+    def run(self, interval: float = INGEST_POLL_INTERVAL):
+        """Ctrl+C まで監視を続ける。埋め込みに失敗したら待ってから同じ位置から再試行する。"""
+        logger.info(f"Ingest daemon started: {os.path.join(self.directory, self.pattern)}")
+        while True:
+            try:
+                if self.poll() == 0:
+                    time.sleep(interval)
+            except RuntimeError as e:
+                logger.error(f"{e}; retrying in {INGEST_RETRY_INTERVAL}s")
+                time.sleep(INGEST_RETRY_INTERVAL)
@@ -1,5 +1,6 @@
 # gen/prompting.py
 import logging
+from typing import List, Optional
 from fastapi import HTTPException
 from server.reader import read_uploaded_files
 from gen.retriever import retrieve_context
@@ -7,7 +8,16 @@ from config import TOP_N
 
 logger = logging.getLogger(__name__)
 
-def generate_prompt(question: str, language: str, mode: str, file_content: str, reason: bool) -> str:
+def needs_context(mode: str, has_files: bool) -> bool:
+    """
+    generate_prompt が関連情報の検索 (retrieve_context) を行うモードかどうか。
+    ファイルが添付されていれば ask / docs はファイルの内容だけを使う。
+    """
+    return mode == "deep" or (mode in ("ask", "docs") and not has_files)
+
+
+def generate_prompt(question: str, language: str, mode: str, file_content: str, reason: bool,
+                    shards: Optional[List[str]] = None, context: Optional[str] = None) -> str:
     """
     質問、使用言語、モード、ファイル内容に応じてプロンプトを生成する関数。
     各モードに適した文脈や技術要件を含めたプロンプトを返す。
@@ -17,6 +27,8 @@ def generate_prompt(question: str, language: str, mode: str, file_content: str,
         language (str): 使用言語。
         mode (str): プロンプト生成モード（"ask", "code", "docs", "deep")
         file_content (str): アップロードされたファイルの内容。
+        shards (list): 関連情報の検索対象とするシャード名 (省略時は全シャード)。
+        context (str): 先に (ファイルの変換と並行して) 取得した関連情報。省略時はここで検索する。
 
     Returns:
         str: 生成されたプロンプト文字列。
@@ -25,7 +37,8 @@ def generate_prompt(question: str, language: str, mode: str, file_content: str,
     prompt = ""
     if mode == "ask":
         if not file_content.strip():
-            context = retrieve_context(question, top_n=TOP_N)
+            if context is None:
+                context = retrieve_context(question, top_n=TOP_N, shards=shards)
             if context:
                 prompt = (
                     "以下の関連情報をもとに、**日本語で**質問に対する詳細な回答を作成してください。\n\n"
@@ -67,7 +80,8 @@ def generate_prompt(question: str, language: str, mode: str, file_content: str,
                 f"### 【ファイル概要】\n```\n{file_content}\n```"
             )
         else:
-            context = retrieve_context(question, top_n=TOP_N)
+            if context is None:
+                context = retrieve_context(question, top_n=TOP_N, shards=shards)
             if context:
                 prompt = (
                     "以下の関連情報と質問に基づき、詳細で分かりやすいMarkdown形式のドキュメントを作成してください。\n\n"
@@ -93,7 +107,8 @@ def generate_prompt(question: str, language: str, mode: str, file_content: str,
                 )
 
     elif mode == "deep":
-        context = retrieve_context(question, top_n=TOP_N)
+        if context is None:
+            context = retrieve_context(question, top_n=TOP_N, shards=shards)
         if context:
             prompt = (
                 "以下の関連情報をもとに、**日本語で**質問に対する詳細な回答を作成してください。\n\n"
@@ -1,76 +1,666 @@
 # gen/retriever.py
 
+import fcntl
+import json
 import logging
 import os
-import sys
-from typing import List, Dict, Any
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional
 
-import torch
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
-from gen.database import load_vector_db
-from gen.search import generate_embedding, search_vector_db
+import numpy as np
+from gen.database import (
+    INDEX_DIR, VECTOR_DB_PATH, StringTable, load_vector_db, save_vector_db, load_text_documents,
+    prune_index_versions, discard_index_version, read_current_version, read_snapshot_meta,
+    set_current_version, write_index_snapshot, shard_name, shard_dir, list_shards,
+)
+from gen.search import (
+    VECTOR_STORE, EMBEDDING_DTYPE, FAISS_INDEX_TYPE, RESCORE_CANDIDATES,
+    VectorStore, NumpyStore, FaissStore, ChromaStore, ShardedStore, LayeredStore, EmbeddingMatrix,
+    embed_query, generate_embeddings, search_vector_db, search_vector_db_batch, build_faiss_index, save_faiss_index,
+    load_faiss_index, evaluate_recall, faiss_index_type,
+)
+from gen.ingest import INGEST_BATCH_SIZE, live_log_sizes, read_live_log
+from gen.batching import MicroBatcher
+from gen.dedup import deduplicate, dedup_report, merge_duplicate_metadata
+from gen.tracing import add_timing, stage
 from config import TOP_N, THRESHOLD
 
 logger = logging.getLogger(__name__)
 
 OLLAMA_ENDPOINT = os.getenv("OLLAMA_ENDPOINT", "http://127.0.0.1:11434")
 CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# CURRENT の変化を確認する間隔 (秒)。ワーカー間でインデックスの切り替えを揃えるために使う
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", 5))
+# 作り直したインデックスを有効にする前の検証: 自分自身のベクトルで検索して自分が1位になる割合の下限
+REINDEX_MIN_SELF_RECALL = float(os.getenv("REINDEX_MIN_SELF_RECALL", 0.9))
+REINDEX_VALIDATION_SAMPLES = 50
+# 再構築 (/api/admin/reindex) でも recall@10 のレポートを測るか (1 で測る)。全行に対する厳密検索が必要なので既定では省く
+REINDEX_REPORT = int(os.getenv("REINDEX_REPORT", 0))
+# 同時に来たリクエストの (質問, 文書) ペアをまとめる待ち時間 (ミリ秒) と 1 回の推論の最大ペア数
+RERANK_BATCH_WINDOW_MS = float(os.getenv("RERANK_BATCH_WINDOW_MS", 5))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 64))
+# retrieve_batch で 1 回の /api/embed に渡す質問数
+RETRIEVE_EMBED_CHUNK = int(os.getenv("RETRIEVE_EMBED_CHUNK", 256))
+# ワーカープロセス数 (main.py が --workers の値を設定する)。複数なら FAISS インデックスは共有できる場合だけ使う
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", 1))
 
 # グローバル変数としてモデル・トークナイザをキャッシュ
 _tokenizer = None
 _model = None
 
+# 検索に使用中のインデックスと状態
+_active: Optional[VectorStore] = None
+_ready = False
+_warmup_status: Dict[str, Any] = {"state": "pending"}
+_reload_lock = threading.Lock()
+_last_reload_check = 0.0
+# ライブログ (gen/ingest.py) から追加したドキュメントの件数と遅延 (行の検出から検索可能になるまで)
+_ingest_stats: Dict[str, Any] = {"applied": 0, "last_lag_seconds": None, "max_lag_seconds": None}
+
 
 def init_retriever() -> None:
     """
-    アプリケーション起動時に一度だけ呼び出し、
     Cross Encoder のトークナイザとモデルをグローバルにロードする。
+    torch / transformers はここで初めてインポートする。
     """
     global _tokenizer, _model
     if _tokenizer is None or _model is None:
         logger.info("Initializing Cross Encoder model...")
         try:
+            from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
             _tokenizer = AutoTokenizer.from_pretrained(CROSS_ENCODER_MODEL)
             _model = AutoModelForSequenceClassification.from_pretrained(CROSS_ENCODER_MODEL)
             _model.eval()
             logger.info(f"Cross Encoder model loaded successfully: {CROSS_ENCODER_MODEL}")
         except Exception as e:
             logger.error(f"😣 Failed to load Cross Encoder model: {e}")
-            sys.exit(1)
+            raise RuntimeError(f"Failed to load Cross Encoder model: {e}") from e
     else:
         logger.info("Cross Encoder model is already initialized.")
 
 
+def _index_report(embeddings: np.ndarray, matrix: EmbeddingMatrix, faiss_index,
+                  measure_recall: bool = True) -> Dict[str, Any]:
+    """
+    量子化した埋め込みと FAISS インデックスのメモリ量・recall@10 を測る。
+    recall は float32 による厳密検索の上位 10 件をどれだけ再現できたか (measure_recall=False なら省く)。
+    """
+    report: Dict[str, Any] = {
+        "documents": len(embeddings),
+        "embedding_dtype": matrix.dtype,
+        "embeddings_float32_mb": round(embeddings.nbytes / 1024 / 1024, 2),
+        "embeddings_stored_mb": round(matrix.nbytes / 1024 / 1024, 2),
+    }
+    if not measure_recall:
+        return report
+    norms = np.linalg.norm(embeddings, axis=1)
+    safe = np.where(norms == 0, 1, norms)
+    if matrix.dtype != "float32":
+        quantized_norms = matrix.norms()
+        safe_quantized = np.where(quantized_norms == 0, 1, quantized_norms)
+
+        def quantized_search(queries, k):
+            results = []
+            for q in queries:
+                scores = matrix.scores(q) / safe_quantized
+                results.append(np.argpartition(-scores, k - 1)[:k])  # recall は順序を見ないので並べ替えない
+            return results
+
+        report["recall@10_embeddings"] = round(evaluate_recall(embeddings, quantized_search, norms=norms), 4)
+
+    if faiss_index is not None:
+        def faiss_search(queries, k):
+            return faiss_index.search(np.ascontiguousarray(queries), k)[1]
+
+        report["recall@10_faiss"] = round(evaluate_recall(embeddings, faiss_search, norms=norms), 4)
+
+        if RESCORE_CANDIDATES:
+            def rescored_search(queries, k):
+                found = faiss_index.search(np.ascontiguousarray(queries), max(k, RESCORE_CANDIDATES))[1]
+                results = []
+                for q, rows in zip(queries, found):
+                    rows = rows[rows >= 0]
+                    scores = embeddings[rows] @ q / safe[rows]
+                    results.append(rows[np.argsort(-scores)][:k])
+                return results
+
+            report["recall@10_faiss_rescored"] = round(evaluate_recall(embeddings, rescored_search, norms=norms), 4)
+    return report
+
+
+def _build_shard_snapshot(shard: str, entries: list, dtype: str, index_type: str,
+                          source_mtime: Optional[float], live_offset: int = 0, activate: bool = True,
+                          measure_recall: bool = True) -> str:
+    """
+    1つのシャードのスナップショットを作成し、そのシャードの CURRENT を切り替える
+    (activate=False なら書き出すだけで、切り替えは呼び出し側が検証後に行う)。
+    live_offset はスナップショットに含まれているライブログの位置 (読み込み時にそこから追いかける)。
+    measure_recall=False ならレポートに recall@10 を含めない (メモリ量だけを記録する)。
+    """
+    embeddings = np.asarray([entry["embedding"] for entry in entries], dtype=np.float32)
+    matrix = EmbeddingMatrix.quantize(embeddings, dtype)
+    faiss_index = build_faiss_index(embeddings, index_type) if VECTOR_STORE != "numpy" else None
+    extra_files = []
+    if matrix.dtype != "float32":
+        extra_files.append(("embeddings.q.npy", matrix.save))
+    if faiss_index is not None:
+        extra_files.append(("faiss.index", lambda path: save_faiss_index(faiss_index, path)))
+
+    report = _index_report(embeddings, matrix, faiss_index, measure_recall)
+    logger.info(f"Index report [{shard}]: {report}")
+
+    directory = shard_dir(shard)
+    version = write_index_snapshot(
+        entries, directory, extra_files=extra_files,
+        meta={
+            "shard": shard, "source": VECTOR_DB_PATH, "source_mtime": source_mtime, "live_offset": live_offset,
+            "embedding_dtype": matrix.dtype,
+            "index_type": faiss_index_type(faiss_index, index_type) if faiss_index is not None else None,
+            "report": report,
+        },
+    )
+    logger.info(f"Index snapshot created: {shard}/{version} ({len(entries)} documents)")
+    if activate:
+        set_current_version(version, directory)
+        prune_index_versions(directory)
+    return version
+
+
+def build_index_snapshot(vector_db: Optional[list] = None, dtype: str = EMBEDDING_DTYPE,
+                         index_type: str = FAISS_INDEX_TYPE,
+                         live_offsets: Optional[Dict[str, int]] = None) -> Dict[str, str]:
+    """
+    ベクトルDBから mmap 用のスナップショットと FAISS インデックスをシャードごとに作成し、
+    各シャードの CURRENT を切り替える。ベクトルDBに含まれないシャードはそのまま残る。
+    dtype が float32 以外なら量子化した行列 (embeddings.q.npy) を検索に使い、
+    float32 の embeddings.npy は再スコアリング用としてディスク上に残す。
+    live_offsets には入力ファイルを読み込む前のライブログのサイズを渡す (pull.py)。
+    それ以降のライブログのレコードは読み込み時に追加される (ID が重複するものは除く)。
+    {シャード名: バージョン名} を返す (ベクトルDBが空なら空の辞書)。
+    """
+    source_mtime = os.path.getmtime(VECTOR_DB_PATH) if os.path.exists(VECTOR_DB_PATH) else None
+    if vector_db is None:
+        vector_db = load_vector_db()
+    if not vector_db:
+        logger.warning("Vector DB is empty, skipping index snapshot.")
+        return {}
+
+    groups: Dict[str, list] = {}
+    for entry in vector_db:
+        groups.setdefault(shard_name(entry.get("metadata")), []).append(entry)
+
+    return {
+        shard: _build_shard_snapshot(shard, entries, dtype, index_type, source_mtime,
+                                     live_offset=(live_offsets or {}).get(shard, 0))
+        for shard, entries in sorted(groups.items())
+    }
+
+
+@contextmanager
+def _build_lock():
+    """スナップショットの作成をプロセス間で直列化するファイルロック。"""
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    with open(os.path.join(INDEX_DIR, ".build.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# /api/admin/reindex のジョブの状態。ワーカー間で共有するため INDEX_DIR に置く。
+# 実行中のワーカーは .reindex.lock を flock で持ち続け、プロセスが落ちればロックは自動で外れる。
+REINDEX_STATE_FILE = os.path.join(INDEX_DIR, ".reindex.json")
+REINDEX_LOCK_FILE = os.path.join(INDEX_DIR, ".reindex.lock")
+
+
+def acquire_reindex_lock():
+    """再構築ジョブのロックを取れればロックファイルを返す (閉じると解放)。他で実行中なら None。"""
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    lock_file = open(REINDEX_LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def write_reindex_job(job: Dict[str, Any]):
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    tmp_path = f"{REINDEX_STATE_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, REINDEX_STATE_FILE)
+
+
+def read_reindex_job() -> Dict[str, Any]:
+    """
+    直近の再構築ジョブの状態 (idle / running / done / failed / interrupted) を返す。
+    running のままロックが外れていれば、実行していたプロセスが途中で終了している。
+    """
+    try:
+        with open(REINDEX_STATE_FILE, "r", encoding="utf-8") as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return {"state": "idle"}
+    if job.get("state") == "running":
+        lock_file = acquire_reindex_lock()
+        if lock_file is not None:
+            lock_file.close()
+            job["state"] = "interrupted"
+    return job
+
+
+def ensure_index_snapshot() -> Dict[str, str]:
+    """
+    スナップショットが無い、または VECTOR_DB の方が新しければ作り直す。
+    複数プロセスが同時に呼んでも作成は1回で済むよう、ファイルロックで直列化する。
+    {シャード名: バージョン名} を返す。
+    """
+    with _build_lock():
+        versions = {shard: read_current_version(shard_dir(shard)) for shard in list_shards()}
+        if not os.path.exists(VECTOR_DB_PATH):
+            return versions
+        if versions:
+            source_mtimes = [
+                read_snapshot_meta(version, shard_dir(shard)).get("source_mtime") or 0
+                for shard, version in versions.items()
+            ]
+            if max(source_mtimes) >= os.path.getmtime(VECTOR_DB_PATH):
+                return versions
+        versions.update(build_index_snapshot())
+        return versions
+
+
+def validate_index_snapshot(shard: str, version: str, expected_count: int) -> Dict[str, Any]:
+    """
+    有効にする前のスナップショットを実際に読み込んで検証する。
+    件数が一致し、サンプルした行の埋め込みで検索すると (ほぼ) 自分自身が1位になることを確認する。
+    問題があれば ValueError を送出する。
+    """
+    directory = shard_dir(shard)
+    meta = read_snapshot_meta(version, directory)
+    store = load_index_snapshot(shard, version)
+    if len(store) != expected_count:
+        raise ValueError(f"[{shard}] document count mismatch: {len(store)} != {expected_count}")
+
+    full = np.load(os.path.join(directory, version, "embeddings.npy"), mmap_mode="r")
+    ids = StringTable(os.path.join(directory, version), "ids")
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(full), size=min(REINDEX_VALIDATION_SAMPLES, len(full)), replace=False)
+    hits = 0
+    for row in rows:
+        top = store.search(np.asarray(full[row], dtype=np.float32), 1)
+        # 同じ内容のドキュメントが複数あれば、別の ID でも類似度がほぼ 1 なら正解とみなす
+        if top and (top[0]["id"] == ids[int(row)] or top[0]["similarity"] >= 0.999):
+            hits += 1
+    self_recall = hits / len(rows) if len(rows) else 1.0
+    if self_recall < REINDEX_MIN_SELF_RECALL:
+        raise ValueError(f"[{shard}] self-retrieval check failed: {self_recall:.2f} < {REINDEX_MIN_SELF_RECALL}")
+    return {"documents": len(store), "dim": meta.get("dim"), "self_recall": round(self_recall, 4)}
+
+
+def rebuild_index(input_files: Optional[List[str]] = None, dtype: str = EMBEDDING_DTYPE,
+                  index_type: str = FAISS_INDEX_TYPE) -> Dict[str, Any]:
+    """
+    インデックスを作り直し、検証してから切り替える (サーバーを止めずに実行できる)。
+    input_files を渡すとテキストファイルを埋め込み直し、そのシャードの分を VECTOR_DB に
+    マージする (マージ結果は一時ファイルに書き、検証が通ってから rename で置き換える)。
+    省略時は VECTOR_DB 全体から作る。
+    新しいバージョンはすべてのシャードの検証が通った後でまとめて CURRENT に切り替え、
+    このプロセスではすぐに差し替える (他のワーカーは CURRENT の変化で追従する)。
+    検索中のリクエストは古いインデックスを使い終えるまで参照し続ける。
+    """
+    if VECTOR_STORE == "chroma":
+        raise ValueError("Rebuild is not supported for the chroma backend (the collection is updated in place).")
+
+    start = time.perf_counter()
+    staged_db = f"{VECTOR_DB_PATH}.rebuild.tmp"
+    with _build_lock():
+        live_offsets: Dict[str, int] = {}
+        dedup = None
+        source_path = VECTOR_DB_PATH
+        if input_files:
+            live_offsets = live_log_sizes()  # 入力を読む前の位置 (pull.py と同じ)
+            documents = load_text_documents(input_files)
+            total = len(documents)
+            documents, duplicates = deduplicate(documents)  # pull.py と同じ近似重複の除去
+            dedup = dedup_report(total, duplicates)
+            logger.info(f"Near-duplicate removal: {dedup}")
+            embeddings = []
+            for i in range(0, len(documents), INGEST_BATCH_SIZE):
+                embeddings += generate_embeddings([doc for doc, _, _, _ in documents[i:i + INGEST_BATCH_SIZE]])
+            entries = []
+            for i, ((doc, source, n, extra), embedding) in enumerate(zip(documents, embeddings)):
+                shard = shard_name({"source": source})
+                metadata = {"source": source, "shard": shard, **extra}
+                if i in duplicates:
+                    metadata = merge_duplicate_metadata(metadata, duplicates[i])
+                entries.append({"id": f"{shard}:{n}", "embedding": embedding, "document": doc, "metadata": metadata})
+            rebuilt = {entry["metadata"]["shard"] for entry in entries}
+            kept = [entry for entry in load_vector_db() if shard_name(entry.get("metadata")) not in rebuilt]
+            save_vector_db(kept + entries, staged_db)
+            source_path = staged_db  # rename しても mtime は変わらない
+        else:
+            entries = load_vector_db()
+        if not entries:
+            raise ValueError("Vector DB is empty.")
+
+        source_mtime = os.path.getmtime(source_path)
+        groups: Dict[str, list] = {}
+        for entry in entries:
+            groups.setdefault(shard_name(entry.get("metadata")), []).append(entry)
+
+        versions: Dict[str, str] = {}
+        try:
+            for shard, group in sorted(groups.items()):
+                versions[shard] = _build_shard_snapshot(
+                    shard, group, dtype, index_type, source_mtime,
+                    live_offset=live_offsets.get(shard, 0), activate=False,
+                    measure_recall=bool(REINDEX_REPORT),
+                )
+            validation = {
+                shard: validate_index_snapshot(shard, version, len(groups[shard]))
+                for shard, version in versions.items()
+            }
+            # 作り直さないシャードも含めて、埋め込みの次元がそろっていること
+            dims = {report["dim"] for report in validation.values()}
+            for shard in list_shards():
+                current = read_current_version(shard_dir(shard))
+                if shard not in versions and current is not None:
+                    dims.add(read_snapshot_meta(current, shard_dir(shard)).get("dim"))
+            if len(dims) > 1:
+                raise ValueError(f"Embedding dimensions differ between shards: {sorted(dims)}")
+        except Exception:
+            for shard, version in versions.items():
+                discard_index_version(version, shard_dir(shard))
+            if os.path.exists(staged_db):
+                os.remove(staged_db)
+            raise
+
+        if source_path == staged_db:
+            os.replace(staged_db, VECTOR_DB_PATH)
+        for shard, version in versions.items():
+            set_current_version(version, shard_dir(shard))
+            prune_index_versions(shard_dir(shard))
+
+    swap_index(versions)
+    elapsed = round(time.perf_counter() - start, 3)
+    logger.info(f"Index rebuilt and activated: {versions} ({elapsed}s)")
+    result = {"versions": versions, "validation": validation, "seconds": elapsed}
+    if dedup is not None:
+        result["dedup"] = dedup
+    return result
+
+
+def load_index_snapshot(shard: str, version: str) -> VectorStore:
+    """
+    シャードのスナップショットを mmap で読み込む。埋め込み行列・文書・FAISS インデックスは
+    OS のページキャッシュを介して全ワーカーで共有され、プロセスごとにコピーされない。
+    VECTOR_STORE が "numpy" の場合は FAISS インデックスを使わず厳密検索する。
+    複数ワーカーで FAISS インデックスを mmap できない (各ワーカーにコピーされる) 場合も同じ。
+    """
+    directory = shard_dir(shard)
+    path = os.path.join(directory, version)
+    meta = read_snapshot_meta(version, directory)
+    full = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+    quantized_path = os.path.join(path, "embeddings.q.npy")
+    if os.path.exists(quantized_path):
+        # 量子化行列で検索し、float32 はディスク上で再スコアリングにだけ使う
+        embeddings, full_embeddings = EmbeddingMatrix.load(quantized_path), full
+    else:
+        embeddings, full_embeddings = EmbeddingMatrix(full), None
+    ids = StringTable(path, "ids")
+    documents = StringTable(path, "documents")
+    metadatas = StringTable(path, "metadatas") if os.path.exists(os.path.join(path, "metadatas.bin")) else None
+    faiss_path = os.path.join(path, "faiss.index")
+    faiss_index = None
+    if VECTOR_STORE != "numpy" and os.path.exists(faiss_path):
+        faiss_index = load_faiss_index(faiss_path, require_shared=SERVE_WORKERS > 1)
+    if faiss_index is None:
+        store = NumpyStore(version, ids, documents, embeddings, metadatas, full_embeddings=full_embeddings)
+    else:
+        store = FaissStore(
+            version, ids, documents, embeddings, metadatas,
+            faiss_index=faiss_index,
+            index_type=meta.get("index_type") or FAISS_INDEX_TYPE,
+            full_embeddings=full_embeddings,
+        )
+    store.live_offset = meta.get("live_offset", 0)
+    return store
+
+
+def load_sharded_index(versions: Dict[str, str]) -> ShardedStore:
+    return ShardedStore({shard: load_index_snapshot(shard, version) for shard, version in versions.items()})
+
+
+def maybe_reload_index() -> None:
+    """
+    各シャードの CURRENT が指すバージョンが変わっていれば (新しいシャードが増えた場合も)、
+    バックグラウンドで読み直して差し替える。全ワーカーが同じ CURRENT を見るので、
+    切り替えはワーカー間で揃う。ライブログが伸びていれば、その分も同じスレッドで追加する。
+    """
+    global _last_reload_check
+    if not isinstance(_active, ShardedStore):
+        return  # ChromaDB はコレクション自体が更新される
+    now = time.monotonic()
+    if now - _last_reload_check < INDEX_RELOAD_INTERVAL:
+        return
+    _last_reload_check = now
+
+    changed = {}
+    for shard in list_shards():
+        version = read_current_version(shard_dir(shard))
+        current = _active.shards.get(shard)
+        if version is not None and (current is None or current.version != version):
+            changed[shard] = version
+    live_pending = any(
+        size != getattr(_active.shards.get(shard), "live_offset", 0) for shard, size in live_log_sizes().items()
+    )
+    if not changed and not live_pending:
+        return
+    if not _reload_lock.acquire(blocking=False):
+        return  # 別スレッドで読み込み中
+    threading.Thread(target=_reload_index, args=(changed,), daemon=True).start()
+
+
+def _reload_index(changed: Dict[str, str]) -> None:
+    try:
+        _swap_shards(changed)
+    except Exception as e:
+        logger.error(f"Failed to reload index {changed}: {e}")
+    finally:
+        _reload_lock.release()
+
+
+def _swap_shards(changed: Dict[str, str]) -> None:
+    """
+    指定したシャードを新しいバージョンで読み込み、_active の参照を1回の代入で差し替える
+    (_reload_lock を持った状態で呼ぶ)。
+    """
+    global _active
+    active = _active
+    if changed:
+        start = time.perf_counter()
+        for shard, version in changed.items():
+            active = active.with_shard(shard, load_index_snapshot(shard, version))
+        logger.info(f"Index reloaded: {changed} ({len(active)} documents, {time.perf_counter() - start:.2f}s, "
+                    f"memory {process_memory()})")
+    _active = _apply_live_updates(active)
+
+
+def swap_index(versions: Dict[str, str]) -> None:
+    """
+    このプロセスの検索インデックスを指定したバージョンにすぐ切り替える。
+    ウォームアップ前なら何もしない (ウォームアップ時に CURRENT から読み込まれる)。
+    """
+    if not isinstance(_active, ShardedStore):
+        return
+    with _reload_lock:
+        _swap_shards(versions)
+
+
+def _apply_live_updates(active: ShardedStore) -> ShardedStore:
+    """
+    ライブログの未反映分を各シャードに追加する。スナップショットに既にある ID は除く。
+    追加分はシャードごとの小さな delta (LayeredStore) に入れ、mmap のスナップショットと
+    FAISS インデックスには触れない。ライブログにしかないシャードは delta だけで作る。
+    """
+    for shard, size in live_log_sizes().items():
+        store = active.shards.get(shard)
+        offset = getattr(store, "live_offset", 0)
+        if size == offset:
+            continue
+        records, next_offset = read_live_log(shard, offset if store is not None else 0)
+        # 同じ ID が複数あれば (取り込み側の再試行など) 最後のものを使う
+        records = list({record["id"]: record for record in records}.values())
+        if store is not None and records:
+            missing = set(store.missing_ids([record["id"] for record in records]))
+            records = [record for record in records if record["id"] in missing]
+
+        if records:
+            start = time.perf_counter()
+            if not isinstance(store, LayeredStore):
+                store = LayeredStore(store)
+                active = active.with_shard(shard, store)
+            store.upsert(
+                ids=[record["id"] for record in records],
+                embeddings=[record["embedding"] for record in records],
+                documents=[record["document"] for record in records],
+                metadatas=[record["metadata"] for record in records],
+            )
+            now = time.time()
+            lag = max(now - record.get("seen", now) for record in records)
+            _ingest_stats["applied"] += len(records)
+            _ingest_stats["last_lag_seconds"] = round(lag, 3)
+            _ingest_stats["max_lag_seconds"] = round(max(lag, _ingest_stats["max_lag_seconds"] or 0.0), 3)
+            logger.info(f"Live update [{shard}]: +{len(records)} documents "
+                        f"(lag {lag:.1f}s, {time.perf_counter() - start:.2f}s)")
+        if store is not None:
+            store.live_offset = next_offset
+    return active
+
+
+def warm_up() -> None:
+    """
+    サーバー起動後にバックグラウンドで呼び出し、Cross Encoder・ベクトルDB・
+    FAISS インデックスを読み込む。完了するまで retrieve_context は RAG なしで応答する。
+    """
+    global _active, _ready, _warmup_status
+    _warmup_status = {"state": "loading"}
+    timings = {}
+    try:
+        start = time.perf_counter()
+        init_retriever()
+        timings["cross_encoder_seconds"] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        if VECTOR_STORE == "chroma":
+            active = ChromaStore()
+        else:
+            active = load_sharded_index(ensure_index_snapshot())
+        timings["index_seconds"] = round(time.perf_counter() - start, 3)
+    except Exception as e:
+        logger.error(f"Retriever warm-up failed: {e}")
+        _warmup_status = {"state": "failed", "error": str(e), **timings}
+        return
+
+    _active = active
+    _ready = True
+    _warmup_status = {
+        "state": "ready", "backend": active.backend, "version": active.version, "documents": len(active), **timings
+    }
+    logger.info(f"Retriever warm-up complete: {_warmup_status} (pid {os.getpid()}, memory {process_memory()})")
+
+
+def is_ready() -> bool:
+    return _ready
+
+
+def process_memory() -> Dict[str, float]:
+    """
+    このプロセスのメモリ使用量 (MB) を /proc/self/smaps_rollup から読む (Linux 以外では空)。
+      rss: 常駐量 / pss: 共有ページをプロセス数で割った量 /
+      anonymous: プロセス固有のヒープ (mmap したインデックスが共有されていればワーカー数に比例して増えない)
+    """
+    fields = {"Rss": "rss_mb", "Pss": "pss_mb", "Anonymous": "anonymous_mb"}
+    memory = {}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in fields:
+                    memory[fields[key]] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+    return memory
+
+
+def warmup_status() -> Dict[str, Any]:
+    status = dict(_warmup_status)
+    status["pid"] = os.getpid()
+    status["memory"] = process_memory()
+    if _active is not None:
+        status["version"] = _active.version
+        status["documents"] = len(_active)
+        if isinstance(_active, ShardedStore):
+            status["shards"] = {name: len(store) for name, store in _active.shards.items()}
+            status["ingest"] = {
+                **_ingest_stats,
+                "delta_rows": {
+                    name: store.delta_rows for name, store in _active.shards.items() if isinstance(store, LayeredStore)
+                },
+            }
+    return status
+
+
+def score_pairs(pairs: List[tuple]) -> List[float]:
+    """
+    (質問, 文書) のペアのリストを 1 回の推論でまとめてスコアリングする。
+    """
+    import torch
+
+    inputs = _tokenizer(
+        [query for query, _ in pairs], [document for _, document in pairs],
+        return_tensors="pt",
+        truncation=True,
+        padding=True
+    )
+    with torch.no_grad():
+        outputs = _model(**inputs)
+    # cross-encoder/ms-marco-MiniLM-L-6-v2 は [batch_size, 1] の出力になる
+    return outputs.logits[:, 0].tolist()
+
+
+# 推論は専用スレッドでまとめて実行する (リクエストのスレッドはペアを渡して待つだけ)
+_rerank_batcher = MicroBatcher("rerank", score_pairs, RERANK_BATCH_WINDOW_MS, RERANK_BATCH_SIZE)
+
+
 def rerank_candidates(query: str, candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     Cross Encoder による再ランキングを行う。
     candidates は、各候補が "document" キーを持つ辞書のリストとする。
+    同時に処理中の他のリクエストのペアとまとめて推論する。
     """
     global _tokenizer, _model
     if _model is None or _tokenizer is None:
         logger.warning("Cross Encoder model is not initialized. Skipping rerank.")
         return candidates
 
-    for candidate in candidates:
-        pair = (query, candidate["document"])
-        inputs = _tokenizer(
-            pair[0], pair[1],
-            return_tensors="pt",
-            truncation=True,
-            padding=True
-        )
-        with torch.no_grad():
-            outputs = _model(**inputs)
-            # cross-encoder/ms-marco-MiniLM-L-6-v2 は [batch_size, 1] 的な出力になる。
-            # logits.item() でスコアをスカラーとして取得
-            score = outputs.logits.item()
+    scores = _rerank_batcher.submit_many([(query, candidate["document"]) for candidate in candidates])
+    for candidate, score in zip(candidates, scores):
         candidate["rerank_score"] = score
 
     # rerank_score に基づいて降順ソート
     return sorted(candidates, key=lambda x: x.get("rerank_score", 0.0), reverse=True)
 
 
-def retrieve_context(question: str, top_n: int = TOP_N, threshold: float = THRESHOLD) -> str:
+def retrieve_context(question: str, top_n: int = TOP_N, threshold: float = THRESHOLD, where: Optional[dict] = None,
+                     shards: Optional[List[str]] = None) -> str:
     """
     質問テキストから埋め込みを生成し、Dense 検索と Cross Encoder による再ランキングで
     上位 N 件の関連文書を取得する。
@@ -79,23 +669,34 @@ def retrieve_context(question: str, top_n: int = TOP_N, threshold: float = THRES
         question (str): ユーザーの質問文
         top_n (int): 上位何件を取り出すか (config.py で管理)
         threshold (float): スコアしきい値
+        where (dict): メタデータによる絞り込み条件 (例: {"source": "wiki.db"})
+        shards (list): 検索対象のシャード名 (省略時は全シャード)
 
     Returns:
         str: 取得した文書を改行区切りでまとめた文字列
     """
+    if not _ready:
+        logger.warning("Retriever is still warming up. Answering without RAG.")
+        return ""
+
+    maybe_reload_index()
+
     try:
-        vector_db = load_vector_db()
-        if not vector_db:
+        vector_db = _active
+        if vector_db is None or len(vector_db) == 0:
             logger.warning("Vector DB is empty.")
             return ""
 
         # Dense Retrieval
-        query_embedding = generate_embedding(question)
-        dense_candidates = search_vector_db(query_embedding, vector_db)
+        with stage("embed"):
+            query_embedding = embed_query(question)
+        with stage("search"):
+            dense_candidates = search_vector_db(query_embedding, vector_db, where=where, shards=shards)
         logger.info(f"Dense Retrieval: {len(dense_candidates)} candidates obtained.")
 
         # Cross Encoder による再ランキング
-        reranked_candidates = rerank_candidates(question, dense_candidates)
+        with stage("rerank"):
+            reranked_candidates = rerank_candidates(question, dense_candidates)
         logger.info("Reranking completed.")
 
         # 上位 top_n 件を採用 (threshold で除外するならここで判定)
@@ -108,3 +709,62 @@ def retrieve_context(question: str, top_n: int = TOP_N, threshold: float = THRES
     except Exception as e:
         logger.error(f"Error in retrieve_context: {e}")
         return ""
+
+
+def retrieve_batch(questions: List[str], top_n: int = TOP_N, where: Optional[dict] = None,
+                   shards: Optional[List[str]] = None) -> List[List[Dict[str, Any]]]:
+    """
+    複数の質問をまとめて検索し、質問ごとに再ランキング済みの上位 N 件を返す (回答は生成しない)。
+    埋め込みは RETRIEVE_EMBED_CHUNK 件ずつの /api/embed、検索はクエリ行列による一括検索、
+    再ランキングは RERANK_BATCH_SIZE ペアずつの推論で行う。
+    各候補は {"id", "document", "metadata", "shard", "similarity", "rerank_score"} の辞書。
+
+    Raises:
+        RuntimeError: ウォームアップ中、または埋め込みの生成に失敗した場合
+    """
+    if not _ready:
+        raise RuntimeError("Retriever is still warming up")
+    maybe_reload_index()
+    vector_db = _active
+    if vector_db is None or len(vector_db) == 0 or not questions:
+        return [[] for _ in questions]
+
+    timings = {}
+    start = time.perf_counter()
+    embeddings = []
+    for i in range(0, len(questions), RETRIEVE_EMBED_CHUNK):
+        embeddings.extend(generate_embeddings(questions[i:i + RETRIEVE_EMBED_CHUNK]))
+    timings["embed"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    candidate_lists = search_vector_db_batch(embeddings, vector_db, top_n, where=where, shards=shards)
+    timings["search"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if _model is not None and _tokenizer is not None:
+        pairs = [(question, candidate["document"])
+                 for question, candidates in zip(questions, candidate_lists) for candidate in candidates]
+        scores = []
+        # バッチ 1 つ分ずつ渡し、/api/ask の再ランキングが間に入れるようにする
+        for i in range(0, len(pairs), RERANK_BATCH_SIZE):
+            scores.extend(_rerank_batcher.submit_many(pairs[i:i + RERANK_BATCH_SIZE]))
+        it = iter(scores)
+        for candidates in candidate_lists:
+            for candidate in candidates:
+                candidate["rerank_score"] = next(it)
+            candidates.sort(key=lambda x: x["rerank_score"], reverse=True)
+    timings["rerank"] = time.perf_counter() - start
+
+    logger.info(
+        f"Batch retrieval: {len(questions)} questions "
+        + ", ".join(f"{name}={seconds:.3f}s" for name, seconds in timings.items())
+    )
+    for name, seconds in timings.items():
+        add_timing(name, seconds)
+    results = []
+    for candidates in candidate_lists:
+        results.append([
+            {key: value for key, value in candidate.items() if key != "embedding"}
+            for candidate in candidates[:top_n]
+        ])
+    return results
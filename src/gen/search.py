@@ -2,14 +2,17 @@
 import os
 import sys
 import logging
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from dotenv import load_dotenv
-import ollama
-import chromadb
 import json
 import numpy as np
 import requests
-import faiss
 from config import THRESHOLD, TOP_N
+from gen.cache import embedding_cache, content_hash
+from gen.batching import MicroBatcher
 
 load_dotenv()
 
@@ -20,32 +23,815 @@ OLLAMA_ENDPOINT = os.getenv("OLLAMA_ENDPOINT", "http://127.0.0.1:11434").rstrip(
 os.environ["OLLAMA_HOST"] = OLLAMA_ENDPOINT
 
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "mxbai-embed-large")
+# 同時に来たクエリの埋め込みをまとめる待ち時間 (ミリ秒) と 1 回の /api/embed の最大件数
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", 5))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+
+# ベクトルストアのバックエンド: "faiss" / "numpy" (厳密検索) / "chroma" (永続 ChromaDB)
+VECTOR_STORE = os.getenv("VECTOR_STORE", "faiss")
+CHROMA_DIR = os.getenv("CHROMA_DIR", "../db/chroma")
+CHROMA_COLLECTION = os.getenv("CHROMA_COLLECTION", "docs")
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 512))
+# シャードを並列検索するスレッド数 (numpy / FAISS は検索中に GIL を解放する)
+SHARD_SEARCH_THREADS = int(os.getenv("SHARD_SEARCH_THREADS", min(8, os.cpu_count() or 1)))
 
 s = 3  # 検索候補の倍率
 
-# FAISS インデックスの作成（HNSW 使用）
-faiss_index = None
-def build_faiss_index(vector_db: list, d: int):
+# 埋め込みの保存形式: "float32" / "float16" / "int8" (次元ごとのスケールによる対称量子化)
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float32")
+# FAISS インデックスの種類: "hnsw" (HNSW + 非圧縮) / "hnsw_sq" (HNSW + 8bit SQ) / "ivf_pq" (IVF + PQ)
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "hnsw")
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", 64))         # PQ のサブベクトル数 (次元数の約数)
+FAISS_NLIST = int(os.getenv("FAISS_NLIST", 0))        # IVF のクラスタ数 (0 なら件数から決める)
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", 16))     # IVF の検索時に見るクラスタ数
+# 量子化・近似検索の上位候補を、ディスク上の float32 ベクトルで再スコアリングする件数 (0 で無効)
+RESCORE_CANDIDATES = int(os.getenv("RESCORE_CANDIDATES", 0))
+SCORE_CHUNK_ROWS = 65536  # float32 以外の行列を float32 に戻して計算するときの行数単位
+SCORE_BLOCK_ELEMENTS = 1 << 26  # 複数クエリの一括検索で一度に作るスコア行列の最大要素数 (float32 で 256MB)
+LAYERED_OVERFETCH = 64  # LayeredStore で delta に置き換えられた行を除くため、base から余分に取る件数の上限
+
+
+# FAISS インデックスの作成
+def build_faiss_index(embeddings: np.ndarray, index_type: str = FAISS_INDEX_TYPE):
     """
-    ベクトルデータベースに基づいて FAISS インデックスを構築する。
+    埋め込み行列に基づいて FAISS インデックスを構築して返す。
+    ivf_pq は学習に十分な件数がない場合 HNSW にフォールバックする。
     """
-    global faiss_index
-    if not vector_db:
+    if len(embeddings) == 0:
         logger.warning("Vector DB is empty, skipping FAISS index build.")
-        return
+        return None
+
+    import faiss  # 起動を速くするため遅延インポート
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    n, d = embeddings.shape
+
+    if index_type == "ivf_pq":
+        nlist = FAISS_NLIST or max(1, int(4 * np.sqrt(n)))
+        m = FAISS_PQ_M if d % FAISS_PQ_M == 0 else 8
+        # PQ (8bit) は 256 件以上、IVF はクラスタあたり 39 件程度の学習データが必要
+        if n >= max(256, nlist * 39):
+            quantizer = faiss.IndexFlatL2(d)
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, m, 8)
+            index.train(embeddings)
+            index.add(embeddings)
+            index.nprobe = FAISS_NPROBE
+            logger.info(f"FAISS IVF-PQ index built (nlist={nlist}, m={m}).")
+            return index
+        logger.warning(f"Too few vectors ({n}) to train IVF-PQ; falling back to HNSW.")
+        index_type = "hnsw"
 
-    index = faiss.IndexHNSWFlat(d, 32)  # HNSW 構造を使用（32 は近傍数）
-    embeddings = np.array([entry["embedding"] for entry in vector_db], dtype=np.float32)
+    if index_type == "hnsw_sq":
+        index = faiss.IndexHNSWSQ(d, faiss.ScalarQuantizer.QT_8bit, 32)
+        index.train(embeddings)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, 32)  # HNSW 構造を使用（32 は近傍数）
+    else:
+        raise ValueError(f"Unknown FAISS index type: {index_type}")
 
     index.add(embeddings)
-    faiss_index = index
-    logger.info("FAISS index built successfully.")
+    logger.info(f"FAISS index built successfully ({index_type}).")
+    return index
+
+
+_FAISS_INDEX_TYPES = {"IndexIVFPQ": "ivf_pq", "IndexHNSWSQ": "hnsw_sq", "IndexHNSWFlat": "hnsw"}
+
+
+def faiss_index_type(index, default: str = FAISS_INDEX_TYPE) -> str:
+    """実際に作られたインデックスの種類を返す (ivf_pq の学習データが足りず HNSW になった場合など)。"""
+    return _FAISS_INDEX_TYPES.get(type(index).__name__, default)
+
+
+def save_faiss_index(index, path: str):
+    import faiss
+
+    faiss.write_index(index, path)
+
+
+def load_faiss_index(path: str, require_shared: bool = False):
+    """
+    FAISS インデックスを読み込む。可能なら mmap で読み込み、ワーカー間でページを共有する。
+    IO_FLAG_MMAP が mmap するのは IVF の転置リストだけで、HNSW はプロセスごとにコピーされる。
+    HNSW のグラフ・ベクトルも含めてファイルから直接使う IO_FLAG_MMAP_IFC を優先する。
+    共有できない読み込み方しかできず require_shared が真なら None を返す。
+    """
+    import faiss
+
+    index, shared = None, False
+    if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        try:
+            index = faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+            shared = True
+        except RuntimeError as e:
+            logger.info(f"FAISS IO_FLAG_MMAP_IFC load not supported for {path} ({e}).")
+    if index is None:
+        try:
+            index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            shared = _ivf(index) is not None
+        except (RuntimeError, AttributeError) as e:
+            # インデックスの種類によっては mmap 非対応
+            logger.info(f"FAISS mmap load not supported for {path} ({e}); loading into memory.")
+            index = faiss.read_index(path)
+    if not shared and require_shared:
+        logger.warning(f"FAISS index {path} cannot be shared between workers; using exact search on the mmapped embeddings.")
+        return None
+
+    ivf = _ivf(index)
+    if ivf is not None:
+        ivf.nprobe = FAISS_NPROBE
+    return index
+
+
+def _ivf(index):
+    import faiss
+
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None  # IVF 系ではない
+
+
+class EmbeddingMatrix:
+    """
+    埋め込み行列を保存形式 (float32 / float16 / int8) によらず同じ操作で扱う。
+    int8 は次元ごとのスケール (最大絶対値 / 127) による対称スカラー量子化。
+    float32 以外は内積計算時にチャンク単位で float32 に戻し、行列全体のコピーは作らない。
+    """
+
+    def __init__(self, data: np.ndarray, scale: Optional[np.ndarray] = None):
+        self.data = data
+        self.scale = scale
+
+    @classmethod
+    def quantize(cls, embeddings, dtype: str = EMBEDDING_DTYPE) -> "EmbeddingMatrix":
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if dtype == "float32":
+            return cls(embeddings)
+        if dtype == "float16":
+            return cls(embeddings.astype(np.float16))
+        if dtype == "int8":
+            max_abs = np.abs(embeddings).max(axis=0) if len(embeddings) else np.ones(embeddings.shape[1:])
+            scale = np.where(max_abs == 0, 1.0, max_abs / 127.0).astype(np.float32)
+            codes = np.clip(np.rint(embeddings / scale), -127, 127).astype(np.int8)
+            return cls(codes, scale)
+        raise ValueError(f"Unknown embedding dtype: {dtype}")
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "EmbeddingMatrix":
+        """<path> (.npy) と、int8 の場合は <path> の .scale.npy を読み込む。"""
+        data = np.load(path, mmap_mode="r" if mmap else None)
+        scale_path = path[:-len(".npy")] + ".scale.npy"
+        scale = np.load(scale_path) if os.path.exists(scale_path) else None
+        return cls(data, scale)
+
+    def save(self, path: str):
+        np.save(path, self.data)
+        if self.scale is not None:
+            np.save(path[:-len(".npy")] + ".scale.npy", self.scale)
+
+    @property
+    def dtype(self) -> str:
+        return "int8" if self.scale is not None else str(self.data.dtype)
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def _chunks(self, rows: Optional[np.ndarray] = None):
+        data = self.data if rows is None else self.data[rows]
+        for start in range(0, len(data), SCORE_CHUNK_ROWS):
+            chunk = np.asarray(data[start:start + SCORE_CHUNK_ROWS], dtype=np.float32)
+            yield start, chunk
+
+    def dequantize(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        data = self.data if rows is None else self.data[rows]
+        out = np.asarray(data, dtype=np.float32)
+        return out * self.scale if self.scale is not None else out
+
+    def scores(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        各行と query の内積を返す。
+        query は (次元,) か、複数クエリをまとめた (次元, クエリ数) の行列 (結果は (行数, クエリ数))。
+        """
+        if self.scale is not None:
+            # codes @ (q * scale) == dequantize() @ q
+            query = query * (self.scale if query.ndim == 1 else self.scale[:, None])
+        if self.data.dtype == np.float32:
+            data = self.data if rows is None else self.data[rows]
+            return data @ query
+        out = np.empty((len(self.data) if rows is None else len(rows),) + query.shape[1:], dtype=np.float32)
+        for start, chunk in self._chunks(rows):
+            out[start:start + len(chunk)] = chunk @ query
+        return out
+
+    def norms(self) -> np.ndarray:
+        out = np.empty(len(self.data), dtype=np.float32)
+        for start, chunk in self._chunks():
+            if self.scale is not None:
+                chunk = chunk * self.scale
+            out[start:start + len(chunk)] = np.linalg.norm(chunk, axis=1)
+        return out
+
+
+def exact_top_k(embeddings: np.ndarray, queries: np.ndarray, k: int, norms: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    各クエリについてコサイン類似度の上位 k 件の行番号 (順不同) を返す。
+    埋め込み行列は SCORE_CHUNK_ROWS 行ずつ float32 にして計算し、行列全体のコピーや全件のソートはしない。
+    norms に各行のノルムを渡すと計算し直さない。
+    """
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(embeddings), SCORE_CHUNK_ROWS):
+        chunk = np.asarray(embeddings[start:start + SCORE_CHUNK_ROWS], dtype=np.float32)
+        chunk_norms = np.linalg.norm(chunk, axis=1) if norms is None else norms[start:start + len(chunk)]
+        scores = (queries @ chunk.T) / np.where(chunk_norms == 0, 1, chunk_norms)
+        rows = np.broadcast_to(np.arange(start, start + len(chunk)), scores.shape)
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        best_rows = np.concatenate([best_rows, rows], axis=1)
+        if best_scores.shape[1] > k:
+            top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(best_scores, top, axis=1)
+            best_rows = np.take_along_axis(best_rows, top, axis=1)
+    return best_rows
+
+
+def evaluate_recall(embeddings: np.ndarray, search_fn, k: int = 10, samples: int = 100,
+                    norms: Optional[np.ndarray] = None) -> float:
+    """
+    データセット内のベクトルをクエリにして、厳密なコサイン類似度検索の上位 k 件を
+    search_fn(queries, k) -> 行番号の配列 がどれだけ再現できるか (recall@k) を返す。
+    embeddings は mmap した行列のままでよい (exact_top_k で行単位に計算する)。
+    """
+    if not isinstance(embeddings, np.ndarray):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+    n = len(embeddings)
+    if n == 0:
+        return 1.0
+    k = min(k, n)
+    rng = np.random.default_rng(0)
+    sample_rows = rng.choice(n, size=min(samples, n), replace=False)
+    queries = np.asarray(embeddings[sample_rows], dtype=np.float32)
+
+    exact = exact_top_k(embeddings, queries, k, norms)
+    found = search_fn(queries, k)
+    hits = sum(len(set(exact[i].tolist()) & set(int(x) for x in found[i])) for i in range(len(queries)))
+    return hits / (len(queries) * k)
+
+
+class VectorStore:
+    """
+    ベクトルストアの共通インターフェース。
+    search は各候補を {"id", "document", "metadata", "similarity"} の辞書で返す。
+    where はメタデータの絞り込み条件で、{"source": "wiki.db"} のような一致条件か
+    {"source": {"$in": [...]}} を指定する (複数キーは AND)。
+    """
+
+    backend = ""
+    version = ""
+    live_offset = 0  # 反映済みのライブログの位置 (gen/ingest.py)
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def upsert(self, ids: list, embeddings, documents: list, metadatas: Optional[list] = None):
+        raise NotImplementedError
+
+    def search(self, query_embedding, k: int, where: Optional[dict] = None) -> list:
+        raise NotImplementedError
+
+    def search_batch(self, query_embeddings, k: int, where: Optional[dict] = None) -> list:
+        """複数のクエリをまとめて検索し、クエリごとの候補リストのリストを返す。"""
+        return [self.search(query_embedding, k, where) for query_embedding in query_embeddings]
+
+
+def match_metadata(metadata: dict, where: Optional[dict]) -> bool:
+    if not where:
+        return True
+    for key, cond in where.items():
+        value = metadata.get(key)
+        if isinstance(cond, dict) and "$in" in cond:
+            if value not in cond["$in"]:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+
+class _StoreState:
+    """NumpyStore のデータ一式。更新時は新しいインスタンスに付け替える。"""
+
+    __slots__ = ("ids", "documents", "metadatas", "matrix", "full", "norms")
+
+    def __init__(self, ids, documents, metadatas, matrix: EmbeddingMatrix, full=None, norms=None):
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.matrix = matrix
+        self.full = full      # 再スコアリング用の float32 ベクトル (mmap)
+        self.norms = norms
+
+
+class NumpyStore(VectorStore):
+    """
+    埋め込み行列に対する厳密なコサイン類似度検索。
+    ids / documents / metadatas はリストかスナップショットの StringTable (mmap) を受け付ける。
+    embeddings は float32 配列か EmbeddingMatrix (量子化済み)。full_embeddings を渡すと
+    上位候補をその float32 ベクトルで再スコアリングする (RESCORE_CANDIDATES 件)。
+    データは1つの状態オブジェクトにまとめ、更新時は付け替える (検索中の読み取りと競合しない)。
+    """
+
+    backend = "numpy"
+
+    def __init__(self, version: str, ids, documents, embeddings, metadatas=None,
+                 full_embeddings: Optional[np.ndarray] = None, rescore: int = RESCORE_CANDIDATES):
+        self.version = version
+        self.rescore = rescore
+        self._lock = threading.Lock()
+        self._id_rows = None
+        self._metadata_cache = None
+        matrix = embeddings if isinstance(embeddings, EmbeddingMatrix) else EmbeddingMatrix(embeddings)
+        self._state = _StoreState(ids, documents, metadatas, matrix, full_embeddings)
+
+    @classmethod
+    def from_vector_db(cls, vector_db: list, version: str = "json", dtype: str = "float32", **kwargs):
+        ids = [str(entry.get("id", i)) for i, entry in enumerate(vector_db)]
+        documents = [entry["document"] for entry in vector_db]
+        metadatas = [entry.get("metadata") or {} for entry in vector_db]
+        embeddings = np.asarray([entry["embedding"] for entry in vector_db], dtype=np.float32)
+        if embeddings.ndim != 2:
+            embeddings = embeddings.reshape(0, 0)
+        return cls(version, ids, documents, EmbeddingMatrix.quantize(embeddings, dtype), metadatas, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self._state.documents)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._state.matrix.nbytes
+
+    def _norms(self, state: _StoreState) -> np.ndarray:
+        if state.norms is None:
+            state.norms = state.matrix.norms()
+        return state.norms
+
+    def metadata(self, i: int, state: Optional[_StoreState] = None) -> dict:
+        metadatas = (state or self._state).metadatas
+        if metadatas is None:
+            return {}
+        value = metadatas[i]
+        if isinstance(value, str):
+            return json.loads(value) if value else {}
+        return value or {}
+
+    def entry(self, i: int, state: Optional[_StoreState] = None) -> dict:
+        state = state or self._state
+        return {"id": state.ids[i], "document": state.documents[i], "metadata": self.metadata(i, state)}
+
+    def missing_ids(self, ids: list) -> list:
+        """ids のうち、まだストアに無いものを返す。"""
+        with self._lock:
+            if self._id_rows is None:
+                state = self._state
+                self._id_rows = {str(state.ids[i]): i for i in range(len(state.ids))}
+            return [row_id for row_id in ids if str(row_id) not in self._id_rows]
+
+    def _filter_rows(self, where: dict, state: _StoreState) -> np.ndarray:
+        """where に一致する行番号を返す。メタデータは初回の絞り込み時にデコードしてキャッシュする。"""
+        cache = self._metadata_cache
+        if cache is None or len(cache) != len(state.documents):
+            cache = [self.metadata(i, state) for i in range(len(state.documents))]
+            self._metadata_cache = cache
+        return np.array([i for i, meta in enumerate(cache) if match_metadata(meta, where)], dtype=np.int64)
+
+    def _candidate_rows(self, query_vec: np.ndarray, k: int, state: _StoreState,
+                        where: Optional[dict] = None) -> list:
+        """(行番号, 類似度) のリストを類似度の降順で返す。"""
+        return self._candidate_rows_batch(query_vec.reshape(1, -1), k, state, where)[0]
+
+    def _candidate_rows_batch(self, queries: np.ndarray, k: int, state: _StoreState,
+                              where: Optional[dict] = None) -> list:
+        """
+        queries (クエリ数, 次元) の各行について _candidate_rows と同じリストを返す。
+        スコア行列が SCORE_BLOCK_ELEMENTS を超えないよう、クエリを区切って行列積で計算する。
+        """
+        rows = self._filter_rows(where, state) if where else None
+        if rows is not None and len(rows) == 0:
+            return [[] for _ in range(len(queries))]
+        norms = self._norms(state)
+        if rows is not None:
+            norms = norms[rows]
+        norms = np.where(norms == 0, 1, norms)[:, None]
+        query_norms = np.linalg.norm(queries, axis=1)
+        n_rows = len(norms)
+        k = min(k, n_rows)
+        block = max(1, SCORE_BLOCK_ELEMENTS // max(1, n_rows))
+        results = []
+        for start in range(0, len(queries), block):
+            chunk_norms = query_norms[start:start + block]
+            scores = state.matrix.scores(np.ascontiguousarray(queries[start:start + block].T), rows)
+            scores = scores / norms / np.where(chunk_norms == 0, 1, chunk_norms)
+            for j, query_norm in enumerate(chunk_norms):
+                if query_norm == 0:
+                    results.append([])
+                    continue
+                column = scores[:, j]
+                top = np.argpartition(-column, k - 1)[:k]
+                top = top[np.argsort(-column[top])]
+                results.append([(int(rows[pos]) if rows is not None else int(pos), float(column[pos])) for pos in top])
+        return results
+
+    def _rescore(self, query_vec: np.ndarray, scored: list, state: _StoreState) -> list:
+        """量子化・近似検索で得た候補を float32 ベクトルで厳密にスコアリングし直す。"""
+        full = state.full
+        if full is None and state.matrix.dtype == "float32":
+            full = state.matrix.data
+        if full is None or not scored:
+            return scored
+        rows = np.array(sorted(row for row, _ in scored), dtype=np.int64)
+        vectors = np.asarray(full[rows], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1)
+        query_norm = np.linalg.norm(query_vec) or 1.0
+        scores = (vectors @ query_vec) / np.where(norms == 0, 1, norms) / query_norm
+        return sorted(zip(rows.tolist(), scores.tolist()), key=lambda x: x[1], reverse=True)
+
+    def search(self, query_embedding, k: int, where: Optional[dict] = None) -> list:
+        return self.search_batch([query_embedding], k, where)[0]
+
+    def search_batch(self, query_embeddings, k: int, where: Optional[dict] = None) -> list:
+        state = self._state
+        if len(state.documents) == 0 or k <= 0:
+            return [[] for _ in query_embeddings]
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        fetch = max(k, self.rescore) if self.rescore else k
+        results = []
+        for query_vec, scored in zip(queries, self._candidate_rows_batch(queries, fetch, state, where)):
+            if self.rescore:
+                scored = self._rescore(query_vec, scored, state)
+            candidates = []
+            for row, score in scored[:k]:
+                candidate = self.entry(row, state)
+                candidate["similarity"] = score
+                candidates.append(candidate)
+            results.append(candidates)
+        return results
+
+    def upsert(self, ids: list, embeddings, documents: list, metadatas: Optional[list] = None):
+        """
+        既存 ID は置き換え、新しい ID は末尾に追加する。
+        mmap のスナップショットから読み込んだ場合は、ここで初めてメモリ上にコピーする。
+        量子化形式は維持し、再スコアリング用の float32 ベクトルもメモリ上で更新する。
+        置き換えた行番号のリストを返す。
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        metadatas = metadatas or [{} for _ in ids]
+        with self._lock:
+            old = self._state
+            if self._id_rows is None:
+                self._id_rows = {str(old.ids[i]): i for i in range(len(old.ids))}
+            new_ids = [old.ids[i] for i in range(len(old.ids))]
+            new_docs = [old.documents[i] for i in range(len(old.documents))]
+            new_metas = [self.metadata(i, old) for i in range(len(old.documents))]
+            dim = embeddings.shape[1] if embeddings.ndim == 2 else old.matrix.data.shape[-1]
+            source = old.full if old.full is not None else old.matrix.dequantize()
+            new_emb = np.array(source, dtype=np.float32).reshape(-1, dim)
+
+            replaced, appended = [], []
+            for row_id, embedding, document, metadata in zip(ids, embeddings, documents, metadatas):
+                row_id = str(row_id)
+                row = self._id_rows.get(row_id)
+                if row is None:
+                    self._id_rows[row_id] = len(new_ids) + len(appended)
+                    appended.append((row_id, embedding, document, metadata))
+                else:
+                    new_emb[row] = embedding
+                    new_docs[row] = document
+                    new_metas[row] = metadata
+                    replaced.append(row)
+
+            if appended:
+                new_ids += [a[0] for a in appended]
+                new_docs += [a[2] for a in appended]
+                new_metas += [a[3] for a in appended]
+                new_emb = np.vstack([new_emb, np.asarray([a[1] for a in appended], dtype=np.float32)])
+
+            matrix = EmbeddingMatrix.quantize(new_emb, old.matrix.dtype)
+            full = new_emb if (old.full is not None and matrix.dtype != "float32") else None
+            self._metadata_cache = None
+            self._state = _StoreState(new_ids, new_docs, new_metas, matrix, full)
+        return replaced
+
+
+class FaissStore(NumpyStore):
+    """
+    NumpyStore に FAISS インデックスによる近似最近傍検索を加えたもの。
+    メタデータで絞り込む場合は、一致した行だけを対象に厳密検索する。
+    """
+
+    backend = "faiss"
+
+    def __init__(self, version: str, ids, documents, embeddings, metadatas=None, faiss_index=None,
+                 index_type: str = FAISS_INDEX_TYPE, **kwargs):
+        super().__init__(version, ids, documents, embeddings, metadatas, **kwargs)
+        if faiss_index is None and len(documents) > 0:
+            faiss_index = build_faiss_index(self._float32_embeddings(), index_type)
+        self.faiss_index = faiss_index
+        self.index_type = faiss_index_type(faiss_index, index_type) if faiss_index is not None else index_type
+
+    def _float32_embeddings(self) -> np.ndarray:
+        state = self._state
+        return state.full if state.full is not None else state.matrix.dequantize()
+
+    def _candidate_rows_batch(self, queries: np.ndarray, k: int, state: _StoreState,
+                              where: Optional[dict] = None) -> list:
+        index = self.faiss_index
+        if where or index is None:
+            return super()._candidate_rows_batch(queries, k, state, where)
+
+        # クエリ行列をまとめて 1 回の search に渡す
+        _, indices = index.search(np.ascontiguousarray(queries), min(k, len(state.documents)))
+        # FAISS の L2 距離は NumpyStore のコサイン類似度と尺度が違う (シャードや delta とマージできない) ので、
+        # 候補の行だけ埋め込み行列からコサイン類似度を計算し直す
+        norms = self._norms(state)
+        results = []
+        for query_vec, row_indices in zip(queries, indices):
+            rows = row_indices[(row_indices >= 0) & (row_indices < len(state.documents))].astype(np.int64)
+            query_norm = np.linalg.norm(query_vec)
+            if len(rows) == 0 or query_norm == 0:
+                results.append([])
+                continue
+            scores = state.matrix.scores(query_vec, rows) / np.where(norms[rows] == 0, 1, norms[rows]) / query_norm
+            order = np.argsort(-scores, kind="stable")
+            results.append([(int(rows[i]), float(scores[i])) for i in order])
+        return results
+
+    def upsert(self, ids: list, embeddings, documents: list, metadatas: Optional[list] = None):
+        before = len(self)
+        replaced = super().upsert(ids, embeddings, documents, metadatas)
+        if replaced or self.faiss_index is None:
+            # HNSW は行の置き換えができないので作り直す
+            self.faiss_index = build_faiss_index(self._float32_embeddings(), self.index_type)
+            self.index_type = faiss_index_type(self.faiss_index, self.index_type)
+        elif len(self) > before:
+            # 検索中のインデックスには触れず、複製に追加してから差し替える
+            # (HNSW はグラフの作り直し不要、IVF は学習済みのクラスタにそのまま追加する)
+            import faiss
+
+            added = np.ascontiguousarray(self._float32_embeddings()[before:])
+            index = faiss.clone_index(self.faiss_index)
+            index.add(added)
+            self.faiss_index = index
+        return replaced
+
+
+class LayeredStore(VectorStore):
+    """
+    読み取り専用のスナップショット (base, mmap で全ワーカーが共有) に、ライブ更新で追加した行だけを
+    持つ小さなメモリ上のストア (delta, 厳密検索) を重ねたもの。検索は両方の結果を類似度でマージする。
+    ライブ更新のたびに base をメモリにコピーしたりインデックスを作り直したりしない。
+    delta はスナップショットの作り直し (pull.py / --build-index / /api/admin/reindex) で base に取り込まれる。
+    base にある ID を upsert した場合は delta の行を使い、base の行は検索結果から除く。
+    除く分は base から最大 LAYERED_OVERFETCH 件だけ余分に取って補う (置き換えた行の数によらず一定)。
+    """
+
+    def __init__(self, base: Optional[VectorStore] = None):
+        self.base = base
+        self.delta: Optional[NumpyStore] = None
+        self.shadowed = frozenset()
+        self.live_offset = getattr(base, "live_offset", 0)
+
+    @property
+    def backend(self) -> str:
+        return self.base.backend if self.base is not None else "numpy"
+
+    @property
+    def version(self) -> str:
+        # CURRENT との比較に使うので base のバージョンのまま
+        return self.base.version if self.base is not None else "live"
+
+    @property
+    def delta_rows(self) -> int:
+        return len(self.delta) if self.delta is not None else 0
+
+    def __len__(self) -> int:
+        base = len(self.base) - len(self.shadowed) if self.base is not None else 0
+        return base + self.delta_rows
+
+    def missing_ids(self, ids: list) -> list:
+        missing = self.base.missing_ids(ids) if self.base is not None else list(ids)
+        return self.delta.missing_ids(missing) if self.delta is not None else missing
+
+    def upsert(self, ids: list, embeddings, documents: list, metadatas: Optional[list] = None):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        metadatas = metadatas or [{} for _ in ids]
+        if self.base is not None:
+            in_base = {str(row_id) for row_id in ids} - {str(row_id) for row_id in self.base.missing_ids(ids)}
+            if in_base:
+                self.shadowed = self.shadowed | in_base
+        if self.delta is None:
+            self.delta = NumpyStore("live", [str(row_id) for row_id in ids], list(documents),
+                                    EmbeddingMatrix(embeddings.copy()), list(metadatas))
+            return []
+        return self.delta.upsert(ids, embeddings, documents, metadatas)
+
+    def search(self, query_embedding, k: int, where: Optional[dict] = None) -> list:
+        return self.search_batch([query_embedding], k, where)[0]
+
+    def search_batch(self, query_embeddings, k: int, where: Optional[dict] = None) -> list:
+        shadowed, delta = self.shadowed, self.delta
+        results = [[] for _ in query_embeddings]
+        if self.base is not None:
+            overfetch = min(len(shadowed), LAYERED_OVERFETCH)
+            base_results = self.base.search_batch(query_embeddings, k + overfetch, where)
+            results = [
+                [c for c in candidates if str(c["id"]) not in shadowed][:k] if shadowed else candidates
+                for candidates in base_results
+            ]
+        if delta is not None and len(delta):
+            for i, candidates in enumerate(delta.search_batch(query_embeddings, k, where)):
+                results[i] = heapq.nlargest(k, results[i] + candidates, key=lambda c: c["similarity"])
+        return results
+
+
+_shard_pool = None
+
+
+def _get_shard_pool() -> ThreadPoolExecutor:
+    global _shard_pool
+    if _shard_pool is None:
+        _shard_pool = ThreadPoolExecutor(max_workers=SHARD_SEARCH_THREADS, thread_name_prefix="shard-search")
+    return _shard_pool
+
+
+class ShardedStore(VectorStore):
+    """
+    名前付きシャード (それぞれ独立した VectorStore) をまとめたもの。
+    検索は対象シャードへ並列に投げ、各シャードの上位 k 件を類似度でマージする。
+    シャードの差し替えは with_shard で新しい ShardedStore を作って行う。
+    """
+
+    backend = "sharded"
+
+    def __init__(self, shards: dict):
+        self.shards = dict(shards)
+
+    @property
+    def version(self) -> str:
+        return ",".join(f"{name}:{store.version}" for name, store in sorted(self.shards.items()))
+
+    def __len__(self) -> int:
+        return sum(len(store) for store in self.shards.values())
+
+    def with_shard(self, name: str, store: VectorStore) -> "ShardedStore":
+        shards = dict(self.shards)
+        shards[name] = store
+        return ShardedStore(shards)
+
+    def search(self, query_embedding, k: int, where: Optional[dict] = None,
+               shards: Optional[list] = None) -> list:
+        return self.search_batch([query_embedding], k, where, shards)[0]
+
+    def search_batch(self, query_embeddings, k: int, where: Optional[dict] = None,
+                     shards: Optional[list] = None) -> list:
+        targets = [(name, store) for name, store in self.shards.items() if not shards or name in shards]
+        if not targets:
+            return [[] for _ in query_embeddings]
+
+        if len(targets) == 1:
+            per_shard = [targets[0][1].search_batch(query_embeddings, k, where)]
+        else:
+            pool = _get_shard_pool()
+            futures = [pool.submit(store.search_batch, query_embeddings, k, where) for _, store in targets]
+            per_shard = [future.result() for future in futures]
+
+        results = []
+        for i in range(len(query_embeddings)):
+            merged = []
+            for (name, _), shard_results in zip(targets, per_shard):
+                for candidate in shard_results[i]:
+                    candidate["shard"] = name
+                    merged.append(candidate)
+            results.append(heapq.nlargest(k, merged, key=lambda c: c["similarity"]))
+        return results
+
+
+# ChromaDB のメタデータは str / int / float / bool しか受け付けないので、それ以外の値
+# (重複除去の sources / duplicates など) は JSON 文字列にし、そのキー名を "_json" に記録する
+_CHROMA_SCALARS = (str, int, float, bool)
+# 空のメタデータの代わりに保存する値 (読み出すときは {} に戻す)
+_CHROMA_EMPTY_METADATA = {"source": ""}
+
+
+def to_chroma_metadata(metadata: dict) -> dict:
+    """ChromaDB は空のメタデータを受け付けないので、空の場合は _CHROMA_EMPTY_METADATA を返す。"""
+    encoded = {}
+    json_keys = []
+    for key, value in (metadata or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, _CHROMA_SCALARS):
+            encoded[key] = value
+        else:
+            encoded[key] = json.dumps(value, ensure_ascii=False)
+            json_keys.append(key)
+    if json_keys:
+        encoded["_json"] = ",".join(json_keys)
+    return encoded or dict(_CHROMA_EMPTY_METADATA)
+
+
+def to_chroma_where(where: Optional[dict]) -> Optional[dict]:
+    """
+    VectorStore の where を ChromaDB の形式に変換する。
+    ChromaDB は 1 つの条件しか受け付けないので、複数キーは $and でまとめる。
+    """
+    if not where:
+        return None
+    if len(where) == 1:
+        return dict(where)
+    return {"$and": [{key: cond} for key, cond in where.items()]}
+
+
+def from_chroma_metadata(metadata: Optional[dict]) -> dict:
+    metadata = dict(metadata or {})
+    if metadata == _CHROMA_EMPTY_METADATA:
+        return {}
+    for key in filter(None, metadata.pop("_json", "").split(",")):
+        if key in metadata:
+            metadata[key] = json.loads(metadata[key])
+    return metadata
+
+
+class ChromaStore(VectorStore):
+    """
+    永続化された ChromaDB コレクションをバックエンドとするベクトルストア。
+    """
+
+    backend = "chroma"
+
+    def __init__(self, path: str = CHROMA_DIR, collection: str = CHROMA_COLLECTION):
+        import chromadb  # 起動を速くするため遅延インポート
+
+        self.client = chromadb.PersistentClient(path=path)
+        self.collection = self.client.get_or_create_collection(collection, metadata={"hnsw:space": "cosine"})
+        self.version = f"chroma:{collection}"
+
+    def __len__(self) -> int:
+        return self.collection.count()
+
+    def upsert(self, ids: list, embeddings, documents: list, metadatas: Optional[list] = None,
+               batch_size: int = UPSERT_BATCH_SIZE):
+        """バッチ単位でまとめて upsert する。"""
+        for i in range(0, len(ids), batch_size):
+            batch_metas = [to_chroma_metadata(m) for m in metadatas[i:i + batch_size]] if metadatas else None
+            # 行ごとのメタデータをそのまま渡す (空のものはプレースホルダーになる)
+            self.collection.upsert(
+                ids=[str(x) for x in ids[i:i + batch_size]],
+                embeddings=[list(map(float, e)) for e in embeddings[i:i + batch_size]],
+                documents=documents[i:i + batch_size],
+                metadatas=batch_metas,
+            )
+        return []
+
+    def search(self, query_embedding, k: int, where: Optional[dict] = None) -> list:
+        return self.search_batch([query_embedding], k, where)[0]
+
+    def search_batch(self, query_embeddings, k: int, where: Optional[dict] = None) -> list:
+        if k <= 0 or len(query_embeddings) == 0:
+            return [[] for _ in query_embeddings]
+        result = self.collection.query(
+            query_embeddings=[list(map(float, query_embedding)) for query_embedding in query_embeddings],
+            n_results=k,
+            where=to_chroma_where(where),
+            include=["documents", "metadatas", "distances"],
+        )
+        results = []
+        for ids, documents, metadatas, distances in zip(
+            result["ids"], result["documents"], result["metadatas"], result["distances"]
+        ):
+            results.append([
+                {
+                    "id": row_id,
+                    "document": document,
+                    "metadata": from_chroma_metadata(metadata),
+                    "similarity": 1 - distance,  # cosine 距離を類似度に変換
+                }
+                for row_id, document, metadata, distance in zip(ids, documents, metadatas, distances)
+            ])
+        return results
 
 
 def generate_embedding(text: str) -> list:
     """
     テキストを Ollama を用いて埋め込みベクトルに変換する。
+    同じテキストの埋め込みはキャッシュから返す。
     """
+    key = content_hash(text.encode("utf-8"), salt=EMBEDDING_MODEL)
+    cached = embedding_cache.get(key)
+    if cached is not None:
+        return cached
+
     try:
         response = requests.get(f"{OLLAMA_ENDPOINT}/api/version", timeout=2)
         response.raise_for_status()
@@ -63,13 +849,63 @@ def generate_embedding(text: str) -> list:
         response.raise_for_status()
 
         response_json = response.json()
-        return response_json.get("embeddings", [[]])[0]
+        embedding = response_json.get("embeddings", [[]])[0]
+        if embedding:
+            embedding_cache.put(key, embedding)
+        return embedding
 
     except Exception as e:
         logger.error(f"Embedding generation failed: {e}")
         sys.exit(1)
 
 
+def generate_embeddings(texts: list, timeout: float = 60) -> list:
+    """
+    複数のテキストをまとめて埋め込みベクトルに変換する (Ollama /api/embed に一括で渡す)。
+    キャッシュにあるものは再計算しない。失敗時は RuntimeError を送出する (呼び出し側で再試行できる)。
+    """
+    keys = [content_hash(text.encode("utf-8"), salt=EMBEDDING_MODEL) for text in texts]
+    embeddings = [embedding_cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if not missing:
+        return embeddings
+
+    try:
+        response = requests.post(
+            f"{OLLAMA_ENDPOINT}/api/embed",
+            headers={"Content-Type": "application/json"},
+            json={"model": EMBEDDING_MODEL, "input": [texts[i] for i in missing]},
+            timeout=timeout
+        )
+        response.raise_for_status()
+        computed = response.json().get("embeddings", [])
+    except Exception as e:
+        raise RuntimeError(f"Embedding generation failed: {e}") from e
+    if len(computed) != len(missing):
+        raise RuntimeError(f"Embedding generation returned {len(computed)} vectors for {len(missing)} texts")
+
+    for i, embedding in zip(missing, computed):
+        embeddings[i] = embedding
+        embedding_cache.put(keys[i], embedding)
+    return embeddings
+
+
+_query_batcher = MicroBatcher(
+    "embed", lambda texts: generate_embeddings(texts, timeout=30), EMBED_BATCH_WINDOW_MS, EMBED_BATCH_SIZE,
+)
+
+
+def embed_query(text: str) -> list:
+    """
+    検索クエリを埋め込む。キャッシュになければ、同時に来た他のリクエストのクエリと
+    まとめて 1 回の /api/embed で計算する。失敗時は RuntimeError を送出する。
+    """
+    cached = embedding_cache.get(content_hash(text.encode("utf-8"), salt=EMBEDDING_MODEL))
+    if cached is not None:
+        return cached
+    return _query_batcher.submit(text)
+
+
 def cosine_similarity(vec1: list, vec2: list) -> float:
     """
     コサイン類似度を計算する。
@@ -86,44 +922,47 @@ def cosine_similarity(vec1: list, vec2: list) -> float:
     return np.dot(vec1, vec2) / (norm1 * norm2)
 
 
-def search_vector_db(query_embedding: list, vector_db: list, top_n: int = TOP_N) -> list:
+def search_vector_db(query_embedding: list, vector_db, top_n: int = TOP_N, where: Optional[dict] = None,
+                     shards: Optional[list] = None) -> list:
     """
     ベクトルデータベースから、指定された埋め込みとコサイン類似度の高い上位 N * s 件の文書を返す。
     各候補に Dense Retrieval の類似度スコアを 'similarity' キーとして追加する。
+    vector_db は VectorStore か、従来の辞書のリスト。where でメタデータを、shards で検索対象のシャードを絞り込める。
+    """
+    if isinstance(vector_db, ShardedStore):
+        return vector_db.search(query_embedding, top_n * s, where=where, shards=shards)
+    if shards:
+        # シャードに分かれていないストアではメタデータの shard で絞り込む
+        where = {**(where or {}), "shard": {"$in": list(shards)}}
+    if isinstance(vector_db, VectorStore):
+        return vector_db.search(query_embedding, top_n * s, where=where)
+
+    logger.warning("FAISS index not built. Falling back to brute-force search.")
+
+    # 通常の類似度計算（遅い）
+    scored = []
+    for entry in vector_db:
+        if not match_metadata(entry.get("metadata") or {}, where):
+            continue
+        embedding = entry.get("embedding", [])
+        similarity = cosine_similarity(query_embedding, embedding)
+        candidate = entry.copy()
+        candidate["similarity"] = similarity
+        scored.append(candidate)
+    scored.sort(key=lambda x: x["similarity"], reverse=True)
+    return scored[:top_n * s]
+
+
+def search_vector_db_batch(query_embeddings: list, vector_db, top_n: int = TOP_N, where: Optional[dict] = None,
+                           shards: Optional[list] = None) -> list:
+    """
+    search_vector_db の複数クエリ版。クエリごとの上位 N * s 件のリストを返す。
+    VectorStore ではクエリ行列をまとめて検索する (FAISS では 1 回の search)。
     """
-    global faiss_index
-
-    if faiss_index is None:
-        logger.warning("FAISS index not built. Falling back to brute-force search.")
-
-        # 通常の類似度計算（遅い）
-        scored = []
-        for entry in vector_db:
-            embedding = entry.get("embedding", [])
-            similarity = cosine_similarity(query_embedding, embedding)
-            candidate = entry.copy()
-            candidate["similarity"] = similarity
-            scored.append(candidate)
-        scored.sort(key=lambda x: x["similarity"], reverse=True)
-        return scored[:top_n * s]
-
-    # FAISS を使用した高速検索
-    query_vec = np.array([query_embedding], dtype=np.float32)
-    distances, indices = faiss_index.search(query_vec, top_n * s)
-
-    results = []
-    for i in range(len(indices[0])):
-        idx = indices[0][i]
-        if idx < len(vector_db):
-            candidate = vector_db[idx].copy()
-            candidate["similarity"] = 1 - distances[0][i]  # FAISS の距離を類似度に変換
-            results.append(candidate)
-
-    return results
-
-
-def setup_chroma_collection():
-    client = chromadb.Client()
-    if "docs" in [col.name for col in client.list_collections()]:
-        client.delete_collection("docs")
-    return client.create_collection("docs")
\ No newline at end of file
+    if isinstance(vector_db, ShardedStore):
+        return vector_db.search_batch(query_embeddings, top_n * s, where=where, shards=shards)
+    if isinstance(vector_db, VectorStore):
+        if shards:
+            where = {**(where or {}), "shard": {"$in": list(shards)}}
+        return vector_db.search_batch(query_embeddings, top_n * s, where=where)
+    return [search_vector_db(query_embedding, vector_db, top_n, where, shards) for query_embedding in query_embeddings]
@@ -0,0 +1,63 @@
+# gen/tracing.py
+"""
+リクエスト単位の処理時間の記録。サーバーのミドルウェア (server/tracing.py) が
+リクエストごとに Trace を開始し、各段階は stage() で時間を加算する。
+asyncio.to_thread で実行した処理にもコンテキストが引き継がれる。
+Trace が無い (CLI から呼ばれた) 場合は何もしない。
+"""
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+
+class Trace:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}  # 段階名 -> 合計時間 (秒)
+        self.fields: Dict[str, object] = {}  # ログに含める付加情報 (モード・モデルなど)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def start_trace(request_id: str) -> Trace:
+    trace = Trace(request_id)
+    _current.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+def add_timing(name: str, seconds: float):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+def set_field(name: str, value):
+    trace = _current.get()
+    if trace is not None:
+        trace.fields[name] = value
+
+
+@contextmanager
+def stage(name: str):
+    """with stage("embed"): ... の間の時間を現在のリクエストの段階 name に加算する。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - start)
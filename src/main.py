@@ -1,28 +1,53 @@
+import time
+_import_start = time.perf_counter()
+
 import sys
 import os
 import socket
+import asyncio
+import argparse
 import psutil
 import uvicorn
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 
 from server.handler import app
-from gen.retriever import init_retriever
+from server.eval import feedback_writer
+from server.health import startup_metrics
+from gen.retriever import warm_up, is_ready, rebuild_index, ensure_index_snapshot
 from fastapi.staticfiles import StaticFiles
 
 load_dotenv()
 
+startup_metrics["import_seconds"] = round(time.perf_counter() - _import_start, 3)
+
 
 @asynccontextmanager
 async def lifespan(app):
     """
-    サーバー起動時にモデルのロードを実行し、シャットダウン時に後処理があれば実行する。
+    サーバー起動時にモデルのロードをバックグラウンドで開始し、シャットダウン時に後処理があれば実行する。
+    ソケットはモデルのロードを待たずに開き、ロード完了までは RAG なしで応答する。
     """
-    print("🔄 Initializing retriever models...")
-    init_retriever()  # モデルのロード
-    print("✅ Model initialization complete. Server is ready.")
+    print(f"📦 Imports finished in {startup_metrics['import_seconds']:.2f}s")
+    feedback_writer.start()
+
+    async def background_warm_up():
+        print("🔄 Initializing retriever models in background...")
+        start = time.perf_counter()
+        await asyncio.to_thread(warm_up)  # モデル・インデックスのロード
+        startup_metrics["warmup_seconds"] = round(time.perf_counter() - start, 3)
+        if is_ready():
+            print(f"✅ Retriever warm-up finished in {startup_metrics['warmup_seconds']:.2f}s. Server is ready.")
+        else:
+            print("⚠ Retriever warm-up failed. Answering without RAG (see /readyz).")
+
+    warm_up_task = asyncio.create_task(background_warm_up())
+    startup_metrics["startup_seconds"] = round(time.perf_counter() - _import_start, 3)
     yield  # ここでアプリの起動を待機
     print("🛑 Shutting down server...")
+    if not warm_up_task.done():
+        warm_up_task.cancel()
+    feedback_writer.stop()  # バッファ中の評価データを書き出す
 
 app.router.lifespan_context = lifespan
 
@@ -42,6 +67,34 @@ if serve_static:
     app.mount("/", StaticFiles(directory=serve_root, html=True), name="static")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Azzl サーバー")
+    parser.add_argument("-b", action="store_true", help="API のみ起動します (静的ファイルを配信しない)")
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=int(os.getenv("SERVE_WORKERS", 1)),
+        help="ワーカープロセス数 (省略時は .env の SERVE_WORKERS、デフォルト: 1)"
+    )
+    parser.add_argument(
+        "--build-index",
+        nargs="*",
+        metavar="FILE",
+        help="インデックスを作り直し、検証してから切り替えて終了します。\n"
+             "FILE を指定するとそのテキストファイルを埋め込み直します (省略時は VECTOR_DB から作成)。\n"
+             "稼働中のサーバーは CURRENT の変化を見て新しいインデックスに切り替わります。"
+    )
+    args = parser.parse_args()
+
+    if args.build_index is not None:
+        try:
+            result = rebuild_index(args.build_index or None)
+        except Exception as e:
+            print(f"❌ Index rebuild failed: {e}")
+            sys.exit(1)
+        for shard, version in result["versions"].items():
+            print(f"✅ Index snapshot: {shard}/{version} {result['validation'][shard]}")
+        sys.exit(0)
+
     hostname = socket.gethostname()
     try:
         ip_address = socket.gethostbyname(hostname)
@@ -52,4 +105,12 @@ if __name__ == "__main__":
     print(f"🚀 Serve at -> http://{get_local_ip()}:{port}/")
 
     # Uvicorn で FastAPI サーバーを起動
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    if args.workers > 1:
+        # 親プロセスで一度だけスナップショットを用意し、各ワーカーはそれを mmap して共有する
+        ensure_index_snapshot()
+        # 各ワーカーは共有 (mmap) できない FAISS インデックスを読まずに厳密検索する (gen/retriever.py)
+        os.environ["SERVE_WORKERS"] = str(args.workers)
+        print(f"👥 Workers: {args.workers}")
+        uvicorn.run("main:app", host="0.0.0.0", port=port, workers=args.workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
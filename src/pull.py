@@ -1,16 +1,19 @@
 import sys
 import os
 import argparse
-import json
 import time
 import dotenv
 import threading
+import logging
 from queue import Queue
 from rich.progress import track
 from rich.prompt import Confirm
 from rich.console import Console
-from gen.search import generate_embedding, setup_chroma_collection
-from gen.database import save_vector_db
+from gen.search import generate_embedding, VECTOR_STORE, ChromaStore, EMBEDDING_DTYPE, FAISS_INDEX_TYPE
+from gen.database import save_vector_db, load_vector_db, load_text_documents, read_snapshot_meta, shard_dir, shard_name
+from gen.retriever import build_index_snapshot
+from gen.ingest import Ingester, live_log_sizes, INGEST_DIR
+from gen.dedup import DEDUP_THRESHOLD, DEDUP_SCOPE, deduplicate, dedup_report, merge_duplicate_metadata
 
 # .envを読み込む
 dotenv.load_dotenv()
@@ -26,31 +29,36 @@ def load_documents_from_files(input_paths: list) -> list:
     """
     複数のTXTファイルからデータを読み込む。
     各行が1ドキュメントとなり、空行は無視します。
+    (ドキュメント, 読み込み元ファイル名, ファイル内の通し番号, 追加のメタデータ) のリストを返します。
     """
-    documents = []
-    for path in input_paths:
-        if not os.path.exists(path):
-            print(f"❌ エラー: データベースファイル '{path}' が見つかりません。")
-            sys.exit(1)
-        with open(path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    documents.append(line)
-    return documents
+    try:
+        return load_text_documents(input_paths)
+    except FileNotFoundError as e:
+        print(f"❌ エラー: {e}")
+        sys.exit(1)
 
 def worker(queue: Queue, results: list):
     """ワーカースレッド：キューからデータを取り出し、埋め込みを生成します。"""
     while not queue.empty():
-        i, doc = queue.get()
+        i, (doc, source, n, extra) = queue.get()
         embedding = generate_embedding(doc)
-        results[i] = {"id": str(i), "embedding": embedding, "document": doc}
+        shard = shard_name({"source": source})
+        # ID はシャード内で一意 (別のファイル群で作り直しても他のシャードの ID と衝突しない)
+        results[i] = {
+            "id": f"{shard}:{n}", "embedding": embedding, "document": doc,
+            "metadata": {"source": source, "shard": shard, **extra}
+        }
         queue.task_done()
 
-def create_vector_db(input_files: list, output_file: str, threads: int, force: bool = False, verbose: bool = False):
+def create_vector_db(input_files: list, output_file: str, threads: int, force: bool = False, verbose: bool = False,
+                     dtype: str = EMBEDDING_DTYPE, index_type: str = FAISS_INDEX_TYPE, build_index: bool = True,
+                     dedup_threshold: float = DEDUP_THRESHOLD, dedup_scope: str = DEDUP_SCOPE):
     """
     複数の入力ファイルからドキュメントを読み込み、並列処理で埋め込みを生成し、
     ベクトルDBを作成して出力ファイルに保存します。
+    出力ファイルに入力ファイル以外のシャードがあれば、そのまま残します。
+    dedup_threshold が 0 より大きければ、埋め込みの前に近似重複をまとめます。
+    build_index が有効なら、サーバーが読み込むインデックスのスナップショットも作成します。
     """
     start_time = time.time()
 
@@ -61,13 +69,21 @@ def create_vector_db(input_files: list, output_file: str, threads: int, force: b
             print("🛑 処理を中断しました。")
             sys.exit(1)
 
-    print("🔧 ChromaDB のセットアップ中...")
-    collection = setup_chroma_collection()
+    # 入力を読む前のライブログの位置 (これ以降に取り込まれた行はサーバーが追加で反映する)
+    live_offsets = live_log_sizes()
 
     # 複数ファイルからデータを読み込み
     print(f"📂 データを読み込み中: {', '.join(input_files)}")
     documents = load_documents_from_files(input_files)
 
+    # 近似重複をまとめる (代表だけを埋め込む)
+    duplicates = {}
+    if dedup_threshold > 0:
+        print(f"🧹 近似重複を検出中 (しきい値: {dedup_threshold}, 範囲: {dedup_scope})...")
+        total = len(documents)
+        documents, duplicates = deduplicate(documents, dedup_threshold, dedup_scope)
+        print_dedup_report(dedup_report(total, duplicates))
+
     # キューと結果リストの作成
     queue = Queue()
     results = [None] * len(documents)
@@ -92,15 +108,31 @@ def create_vector_db(input_files: list, output_file: str, threads: int, force: b
     for thread in workers:
         thread.join()
 
-    # ChromaDB にデータを追加
-    for item in results:
-        collection.add(
-            ids=[item["id"]],
-            embeddings=[item["embedding"]],
-            documents=[item["document"]]
-        )
+    for i, group in duplicates.items():
+        results[i]["metadata"] = merge_duplicate_metadata(results[i]["metadata"], group)
+
+    # 入力ファイルに対応しないシャードは既存のベクトルDBから引き継ぐ (rebuild_index と同じ)
+    rebuilt = {shard_name({"source": os.path.basename(path)}) for path in input_files}
+    kept = [entry for entry in load_vector_db(output_file) if shard_name(entry.get("metadata")) not in rebuilt]
+    save_vector_db_to_file(kept + results, output_file)
 
-    save_vector_db_to_file(results, output_file)
+    # バックエンドが ChromaDB の場合は永続コレクションにまとめて upsert
+    if VECTOR_STORE == "chroma":
+        print("🔧 ChromaDB に登録中...")
+        store = ChromaStore()
+        store.upsert(
+            ids=[item["id"] for item in results],
+            embeddings=[item["embedding"] for item in results],
+            documents=[item["document"] for item in results],
+            metadatas=[item["metadata"] for item in results],
+        )
+        print(f"📚 ChromaDB 登録件数: {len(store)}")
+    elif build_index:
+        print(f"🧮 インデックスを作成中 (埋め込み: {dtype}, FAISS: {index_type})...")
+        # 入力ファイルに対応するシャードだけが作り直され、他のシャードはそのまま残る
+        versions = build_index_snapshot(results, dtype=dtype, index_type=index_type, live_offsets=live_offsets)
+        for shard, version in versions.items():
+            print_index_report(read_snapshot_meta(version, shard_dir(shard)))
 
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -112,10 +144,30 @@ def create_vector_db(input_files: list, output_file: str, threads: int, force: b
         print(f"📦 DB サイズ: {db_size:.2f} MB")
         print(f"📄 ドキュメント数: {len(documents)}")
 
+def print_dedup_report(report: dict):
+    """重複除去の結果を表示します。"""
+    print(
+        f"   {report['documents']} 件 → {report['kept']} 件 "
+        f"({report['removed']} 件削除, {report['removed_ratio'] * 100:.1f}%, "
+        f"{report['clusters']} クラスタ, 最大 {report['largest_cluster']} 件)"
+    )
+
+def print_index_report(meta: dict):
+    """スナップショットのメモリ量と recall を表示します。"""
+    report = meta.get("report", {})
+    print(f"📦 インデックス: {meta.get('shard')}/{meta['version']} ({meta['count']} 件, {meta['dim']} 次元)")
+    print(f"   埋め込み (float32): {report.get('embeddings_float32_mb', 0):.2f} MB")
+    print(f"   埋め込み ({report.get('embedding_dtype')}): {report.get('embeddings_stored_mb', 0):.2f} MB")
+    faiss_size = meta.get("files", {}).get("faiss.index")
+    if faiss_size is not None:
+        print(f"   FAISS ({meta.get('index_type')}): {faiss_size / (1024 * 1024):.2f} MB")
+    for key in ("recall@10_embeddings", "recall@10_faiss", "recall@10_faiss_rescored"):
+        if key in report:
+            print(f"   {key}: {report[key]:.4f}")
+
 def save_vector_db_to_file(vector_db: list, output_path: str):
-    """ベクトルDBをJSON形式でファイルに保存します。"""
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(vector_db, f, ensure_ascii=False, indent=4)
+    """ベクトルDBをJSON形式でファイルに保存します (一時ファイル + rename で原子的に置き換え)。"""
+    save_vector_db(vector_db, output_path)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -148,8 +200,62 @@ def main():
         help="詳細情報を表示します (処理時間、DBサイズなど)。"
     )
 
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "float16", "int8"],
+        default=EMBEDDING_DTYPE,
+        help=f"インデックスに保存する埋め込みの形式 (デフォルト: {EMBEDDING_DTYPE})"
+    )
+    parser.add_argument(
+        "--index-type",
+        choices=["hnsw", "hnsw_sq", "ivf_pq"],
+        default=FAISS_INDEX_TYPE,
+        help=f"FAISS インデックスの種類 (デフォルト: {FAISS_INDEX_TYPE})"
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="インデックスのスナップショットを作成しません (ベクトルDBのみ出力)。"
+    )
+
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=DEDUP_THRESHOLD,
+        help=f"近似重複とみなす類似度 (MinHash による Jaccard 推定, デフォルト: {DEDUP_THRESHOLD})"
+    )
+    parser.add_argument(
+        "--dedup-scope",
+        choices=["shard", "all"],
+        default=DEDUP_SCOPE,
+        help=f"重複を探す範囲 (shard: 同じシャード内のみ / all: 全入力, デフォルト: {DEDUP_SCOPE})"
+    )
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="近似重複の除去を行いません。"
+    )
+
+    parser.add_argument(
+        "--watch",
+        nargs="?",
+        const=INGEST_DIR,
+        metavar="DIR",
+        help=f"DIR (省略時: {INGEST_DIR}) の *.db を監視し、追記された行を\n"
+             "稼働中のサーバーのインデックスに随時追加します (Ctrl+C で終了)。"
+    )
+
     args = parser.parse_args()
 
+    if args.watch:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+        print(f"👀 監視中: {args.watch}")
+        try:
+            Ingester(args.watch).run()
+        except KeyboardInterrupt:
+            print("🛑 監視を終了しました。")
+        return
+
     # 入力ファイルが指定されなかった場合は、デフォルトのファイルを使用
     input_files = args.input_files if args.input_files else [DEFAULT_DATABASE]
     output_path = args.output if args.output else DEFAULT_VECTOR_DB
@@ -158,7 +264,11 @@ def main():
     print(f"📌 出力ファイル: {output_path}")
     print(f"🔄 スレッド数: {args.threads}")
 
-    create_vector_db(input_files, output_path, args.threads, force=args.force, verbose=args.verbose)
+    create_vector_db(
+        input_files, output_path, args.threads, force=args.force, verbose=args.verbose,
+        dtype=args.dtype, index_type=args.index_type, build_index=not args.no_index,
+        dedup_threshold=0 if args.no_dedup else args.dedup_threshold, dedup_scope=args.dedup_scope
+    )
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,133 @@
+# server/admin.py
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from dotenv import load_dotenv
+from gen.retriever import rebuild_index, acquire_reindex_lock, read_reindex_job, write_reindex_job
+from gen.search import EMBEDDING_DTYPE, FAISS_INDEX_TYPE
+from gen.ingest import INGEST_DIR
+from server.auth import check_admin_token
+from server.tracing import PROFILE_DIR, PROFILE_MAX_SECONDS, profile_switch
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+admin_router = APIRouter()
+
+
+class ReindexRequest(BaseModel):
+    # 埋め込み直すテキストファイル (INGEST_DIR からの相対パスか、INGEST_DIR 以下の絶対パス)。
+    # 空なら VECTOR_DB 全体から作り直す
+    files: List[str] = []
+    dtype: str = EMBEDDING_DTYPE
+    index_type: str = FAISS_INDEX_TYPE
+
+
+class ProfileRequest(BaseModel):
+    requests: int = 10             # 保存するプロファイルの件数
+    slower_than_ms: float = 0      # 指定するとこれより遅いリクエストだけを保存する
+    max_seconds: float = PROFILE_MAX_SECONDS  # この時間が過ぎたら件数に達していなくても終了
+
+
+def resolve_input_files(files: List[str]) -> List[str]:
+    """
+    再構築の入力ファイルを INGEST_DIR 以下の実パスに解決する。
+    INGEST_DIR の外 (シンボリックリンク経由を含む) や存在しないファイルは 400 にする。
+    """
+    base = os.path.realpath(INGEST_DIR)
+    resolved = []
+    for path in files:
+        real = os.path.realpath(os.path.join(base, path))
+        if os.path.commonpath([base, real]) != base:
+            raise HTTPException(status_code=400, detail=f"File is outside INGEST_DIR: {path}")
+        if not os.path.isfile(real):
+            raise HTTPException(status_code=400, detail=f"File not found: {path}")
+        resolved.append(real)
+    return resolved
+
+
+def _run_reindex(job: dict, files: List[str], dtype: str, index_type: str, lock_file):
+    try:
+        result = rebuild_index(files or None, dtype=dtype, index_type=index_type)
+        write_reindex_job({**job, "state": "done", "finished_at": time.time(), **result})
+    except Exception as e:
+        logger.error(f"Reindex failed: {e}")
+        write_reindex_job({**job, "state": "failed", "finished_at": time.time(), "error": str(e)})
+    finally:
+        lock_file.close()  # ロックを解放する
+
+
+@admin_router.post("/admin/reindex")
+async def reindex(request: ReindexRequest, x_admin_token: Optional[str] = Header(None)):
+    """
+    インデックスの再構築をバックグラウンドで開始する (202)。
+    検証に通った場合だけ新しいバージョンに切り替わり、検索は止まらない。
+    どのワーカーであっても実行中なら 409 を返す。進捗は GET /api/admin/reindex で確認する。
+    """
+    check_admin_token(x_admin_token)
+    if request.dtype not in ("float32", "float16", "int8"):
+        raise HTTPException(status_code=400, detail=f"Unknown dtype: {request.dtype}")
+    if request.index_type not in ("hnsw", "hnsw_sq", "ivf_pq"):
+        raise HTTPException(status_code=400, detail=f"Unknown index type: {request.index_type}")
+    files = resolve_input_files(request.files)
+    lock_file = acquire_reindex_lock()
+    if lock_file is None:
+        raise HTTPException(status_code=409, detail="Reindex is already running")
+
+    job = {"state": "running", "started_at": time.time(), "pid": os.getpid(), "request": request.dict()}
+    write_reindex_job(job)
+    asyncio.get_running_loop().run_in_executor(
+        None, _run_reindex, job, files, request.dtype, request.index_type, lock_file,
+    )
+    return JSONResponse(status_code=202, content=job)
+
+
+@admin_router.get("/admin/reindex")
+async def reindex_status(x_admin_token: Optional[str] = Header(None)):
+    """
+    直近のインデックス再構築ジョブの状態 (idle / running / done / failed / interrupted) を返す。
+    状態は INDEX_DIR に保存されるので、どのワーカーに問い合わせても同じ結果になる。
+    """
+    check_admin_token(x_admin_token)
+    return JSONResponse(status_code=200, content=read_reindex_job())
+
+
+@admin_router.post("/admin/profile")
+async def start_profile(request: ProfileRequest, x_admin_token: Optional[str] = Header(None)):
+    """
+    このワーカーで、次の requests 件 (slower_than_ms を指定した場合はそれより遅いもの) の
+    リクエストのサンプリングプロファイル (全スレッドのコールツリー) を取り、PROFILE_DIR に保存する。
+    計測中は PROFILE_INTERVAL_MS (既定 5 ミリ秒) ごとに GIL を取って全スレッドのスタックをたどるため、
+    プロセス全体 (同時に処理中の他のリクエストも含む) が遅くなる。間隔を短くするほど、スレッドが多く
+    スタックが深いほど負荷は大きい。
+    """
+    check_admin_token(x_admin_token)
+    if request.requests <= 0 or request.max_seconds <= 0 or request.slower_than_ms < 0:
+        raise HTTPException(status_code=400, detail="requests and max_seconds must be positive, slower_than_ms non-negative")
+    profile_switch.enable(request.requests, request.slower_than_ms, request.max_seconds)
+    logger.info(f"Profiling enabled: {request.dict()}")
+    return JSONResponse(status_code=200, content={**profile_switch.status(), "directory": PROFILE_DIR})
+
+
+@admin_router.get("/admin/profile")
+async def profile_status(x_admin_token: Optional[str] = Header(None)):
+    """
+    プロファイル取得の状態と、保存済みのプロファイル (request_id・パス・所要時間・ファイル名) を返す。
+    """
+    check_admin_token(x_admin_token)
+    return JSONResponse(status_code=200, content={**profile_switch.status(), "directory": PROFILE_DIR})
+
+
+@admin_router.delete("/admin/profile")
+async def stop_profile(x_admin_token: Optional[str] = Header(None)):
+    """
+    プロファイル取得を終了する。
+    """
+    check_admin_token(x_admin_token)
+    profile_switch.disable()
+    return JSONResponse(status_code=200, content=profile_switch.status())
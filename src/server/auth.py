@@ -0,0 +1,19 @@
+# server/auth.py
+import os
+import hmac
+from typing import Optional
+from fastapi import HTTPException
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 管理 API (/api/admin/*, /api/eval/export) は X-Admin-Token ヘッダーにこの値を要求する。
+# 空の場合は管理 API そのものを無効にする (認証なしでは公開しない)。
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def check_admin_token(token: Optional[str]):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled (ADMIN_TOKEN is not set)")
+    if not token or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
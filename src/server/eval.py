@@ -1,10 +1,16 @@
 import os
 import json
+import time
+import queue
+import asyncio
+import threading
 from datetime import datetime
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
+from server.auth import check_admin_token
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,6 +19,19 @@ load_dotenv()
 eval_router = APIRouter()
 
 OUT_DIR = os.getenv("OUT_DIR", "../out")
+FEEDBACK_DIR = os.path.join(OUT_DIR, "feedback")
+
+# 書き込みバッチの設定
+EVAL_BATCH_SIZE = int(os.getenv("EVAL_BATCH_SIZE", 256))           # 1 回の書き込みで扱う最大件数
+EVAL_BATCH_WINDOW_MS = int(os.getenv("EVAL_BATCH_WINDOW_MS", 200))  # 最初の1件からまとめて待つ時間
+EVAL_QUEUE_MAX = int(os.getenv("EVAL_QUEUE_MAX", 10000))           # 未書き込みキューの上限
+EVAL_SEGMENT_MAX_MB = float(os.getenv("EVAL_SEGMENT_MAX_MB", 64))   # セグメントのローテーションサイズ
+# fsync ポリシー: "none" (OS 任せ) / "batch" (バッチごと) / "interval" (EVAL_FSYNC_INTERVAL 秒ごと。
+# 書き込みが途切れても、書き込みスレッドが待機中に起きて fsync する)
+EVAL_FSYNC = os.getenv("EVAL_FSYNC", "batch")
+EVAL_FSYNC_INTERVAL = float(os.getenv("EVAL_FSYNC_INTERVAL", 5))
+
+CATEGORIES = ("good", "bad", "report")
 
 class Evaluation(BaseModel):
     q: str  # 質問
@@ -22,28 +41,211 @@ class Evaluation(BaseModel):
     m: str  # モデル
     mode: str # モード (ask, code, doc, deep)
 
-def save_evaluation(evaluation: Evaluation, category: str):
+
+class FeedbackWriter:
     """
-    評価データを OUT_DIR 内の category フォルダに保存する
+    評価データをバッファし、バックグラウンドスレッドでまとめて
+    ローテーションする JSONL セグメントに追記する。
+    セグメント名は feedback-<開始時刻>-<pid>-<連番>.jsonl で、時刻範囲の絞り込みに使う。
+    ワーカーごとに別のセグメントに書くので、pid で書き手を区別する。
     """
-    directory = os.path.join(OUT_DIR, category)
-    os.makedirs(directory, exist_ok=True)
-    timestamp = evaluation.t.replace(":", "").replace("-", "").replace("T", "")
-    logger.info(f"time stamp -> {timestamp}")
-    filename = os.path.join(directory, f"{evaluation.i}_{timestamp}.json")
 
-    try:
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump({
-                "q": evaluation.q,
-                "a": evaluation.a,
-                "t": evaluation.t,
-                "i": evaluation.i,
-                "m": evaluation.m,
-                "mode": evaluation.mode
-            }, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    _SEGMENT_TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._queue: "queue.Queue" = queue.Queue(maxsize=EVAL_QUEUE_MAX)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._last_fsync = time.monotonic()
+        self._unsynced = False  # 最後の fsync 以降に書き込みがあるか
+        self.written = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="feedback-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """残りのバッファを書き出してからスレッドを終了する。"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, record: dict):
+        """イベントループから呼ばれる。ブロックせずキューに積む。"""
+        self.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            raise HTTPException(status_code=503, detail="Feedback queue is full")
+
+    def flush(self):
+        """キューに積まれている分がディスクへ書き出されるまで待つ。"""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            try:
+                item = self._queue.get(timeout=self._idle_timeout())
+            except queue.Empty:
+                self._sync()  # interval: 次の書き込みを待たずに fsync する
+                continue
+            batch, waiters = [], []
+            deadline = time.monotonic() + EVAL_BATCH_WINDOW_MS / 1000
+
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stop or waiters or len(batch) >= EVAL_BATCH_SIZE:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            # stop / flush の後ろに積まれた分も取りこぼさないよう吸い出す
+            if stop or waiters:
+                while True:
+                    try:
+                        extra = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if extra is None:
+                        stop = True
+                    elif isinstance(extra, threading.Event):
+                        waiters.append(extra)
+                    else:
+                        batch.append(extra)
+
+            if batch:
+                try:
+                    self._write_batch(batch, force_sync=bool(waiters) or stop)
+                except Exception as e:
+                    logger.error(f"Failed to write feedback batch ({len(batch)} records): {e}")
+            for waiter in waiters:
+                waiter.set()
+
+        self._close_segment()
+
+    def _idle_timeout(self) -> Optional[float]:
+        """キューを待つ最長時間。interval で未同期の書き込みがあれば、次の fsync の時刻まで。"""
+        if EVAL_FSYNC != "interval" or not self._unsynced:
+            return None
+        return max(0.0, self._last_fsync + EVAL_FSYNC_INTERVAL - time.monotonic())
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = False
+        self._last_fsync = time.monotonic()
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        if EVAL_FSYNC != "none":
+            self._sync()
+        self._file.close()
+        self._file = None
+
+    def _open_segment(self):
+        self._close_segment()
+        stamp = datetime.now().strftime(self._SEGMENT_TIME_FORMAT)
+        pid = os.getpid()
+        # 同じ秒に複数回ローテーションした場合は連番で区別する
+        seq = 0
+        path = os.path.join(self.directory, f"feedback-{stamp}-{pid}-{seq:03d}.jsonl")
+        while os.path.exists(path) and os.path.getsize(path) >= EVAL_SEGMENT_MAX_MB * 1024 * 1024:
+            seq += 1
+            path = os.path.join(self.directory, f"feedback-{stamp}-{pid}-{seq:03d}.jsonl")
+        self._file = open(path, "a", encoding="utf-8")
+        logger.info(f"Feedback segment opened: {path}")
+
+    def _write_batch(self, batch: list, force_sync: bool = False):
+        if self._file is None or self._file.tell() >= EVAL_SEGMENT_MAX_MB * 1024 * 1024:
+            self._open_segment()
+
+        self._file.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch))
+        self._file.flush()
+        self._unsynced = True
+
+        if EVAL_FSYNC == "batch" or (force_sync and EVAL_FSYNC != "none"):
+            self._sync()
+        elif EVAL_FSYNC == "interval" and time.monotonic() - self._last_fsync >= EVAL_FSYNC_INTERVAL:
+            self._sync()
+        self.written += len(batch)
+
+    def segments(self, since: Optional[float] = None, until: Optional[float] = None) -> list:
+        """
+        時刻範囲に重なりうるセグメントのパスを古い順に返す。
+        各セグメントは同じ書き手 (pid) の次のセグメントの開始時刻までのレコードを含む
+        (他のワーカーがまだ書き込み中のセグメントは、そのワーカーの最新のセグメントとして残る)。
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith("feedback-") and n.endswith(".jsonl"))
+        starts, writers = {}, {}
+        for name in names:
+            parts = name[len("feedback-"):-len(".jsonl")].split("-")
+            try:
+                starts[name] = datetime.strptime(parts[0], self._SEGMENT_TIME_FORMAT).timestamp()
+            except ValueError:
+                starts[name] = 0.0
+            # 旧形式 (feedback-<開始時刻>-<連番>.jsonl) は 1 つの書き手として扱う
+            writers.setdefault(parts[1] if len(parts) == 3 else "", []).append(name)
+
+        ends = {}
+        for segments in writers.values():
+            segments.sort(key=lambda name: (starts[name], name))
+            for name, following in zip(segments, segments[1:]):
+                # 開始時刻は秒単位で切り捨てているので 1 秒の余裕を持たせる
+                ends[name] = starts[following] + 1
+
+        selected = []
+        for name in names:
+            if until is not None and starts[name] > until:
+                continue
+            if since is not None and name in ends and ends[name] < since:
+                continue
+            selected.append(os.path.join(self.directory, name))
+        return selected
+
+
+feedback_writer = FeedbackWriter(FEEDBACK_DIR)
+
+
+def save_evaluation(evaluation: Evaluation, category: str):
+    """
+    評価データをフィードバックログのバッファに積む (書き込みはバックグラウンドで行う)
+    """
+    feedback_writer.submit({
+        "category": category,
+        "ts": round(time.time(), 3),
+        "q": evaluation.q,
+        "a": evaluation.a,
+        "t": evaluation.t,
+        "i": evaluation.i,
+        "m": evaluation.m,
+        "mode": evaluation.mode
+    })
 
 @eval_router.post("/eval/good")
 async def eval_good(evaluation: Evaluation):
@@ -68,3 +270,65 @@ async def eval_report(evaluation: Evaluation):
     """
     save_evaluation(evaluation, "report")
     return JSONResponse(status_code=200, content={"status": "success"})
+
+
+def _parse_time(value: Optional[str], name: str) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: {value}")
+
+
+@eval_router.get("/eval/export")
+async def eval_export(
+    category: Optional[str] = None,
+    mode: Optional[str] = None,
+    model: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    limit: int = 0,
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    評価データを NDJSON で書き出す。
+    category / mode / model / 時刻範囲 (since, until: ISO 8601) で絞り込める。
+    質問・回答をそのまま含むため、X-Admin-Token ヘッダーに ADMIN_TOKEN の値が必要。
+    """
+    check_admin_token(x_admin_token)
+    if category and category not in CATEGORIES:
+        raise HTTPException(status_code=400, detail=f"Unknown category: {category}")
+    since_ts = _parse_time(since, "since")
+    until_ts = _parse_time(until, "until")
+
+    # バッファ中のデータも結果に含める
+    await asyncio.to_thread(feedback_writer.flush)
+    paths = feedback_writer.segments(since_ts, until_ts)
+
+    def iter_records():
+        count = 0
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 書き込み途中の行は無視
+                    if category and record.get("category") != category:
+                        continue
+                    if mode and record.get("mode") != mode:
+                        continue
+                    if model and record.get("m") != model:
+                        continue
+                    ts = record.get("ts", 0.0)
+                    if since_ts is not None and ts < since_ts:
+                        continue
+                    if until_ts is not None and ts > until_ts:
+                        continue
+                    yield line if line.endswith("\n") else line + "\n"
+                    count += 1
+                    if limit and count >= limit:
+                        return
+
+    return StreamingResponse(iter_records(), media_type="application/x-ndjson")
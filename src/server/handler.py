@@ -1,18 +1,29 @@
 # server/handler.py
 import os
 import json
+import time
 import httpx
+import asyncio
 import tempfile
 import logging
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Form, File, UploadFile
+from fastapi import FastAPI, HTTPException, Form, File, UploadFile, Request
 from fastapi.responses import StreamingResponse
 from fastapi.responses import HTMLResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from server.eval import eval_router
+from server.health import health_router
+from server.admin import admin_router
+from server.metrics import metrics_router, metrics
+from server.retrieve import retrieve_router
+from server.tracing import TracingMiddleware
+from server.streaming import STREAM_FORMATS, coalesce, format_event, generation_stats
 from server.reader import read_uploaded_files
-from gen.prompting import generate_prompt
+from gen.prompting import generate_prompt, needs_context
+from gen.retriever import retrieve_context
+from gen.tracing import add_timing, current_trace, set_field
+from config import TOP_N
 
 load_dotenv()
 
@@ -28,21 +39,122 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Request-ID"],
 )
+# リクエストごとの段階別の時間 (Server-Timing ヘッダー・JSON ログ) とプロファイル
+app.add_middleware(TracingMiddleware)
 
 app.include_router(eval_router, prefix="/api")
+app.include_router(health_router)
+app.include_router(admin_router, prefix="/api")
+app.include_router(metrics_router)
+app.include_router(retrieve_router, prefix="/api")
 
 OLLAMA_ENDPOINT = os.getenv("OLLAMA_ENDPOINT", "http://127.0.0.1:11434")
 OLLAMA_GEN_URL = f"{OLLAMA_ENDPOINT.rstrip('/')}/api/generate"
 # OLLAMA_CHAT_URL = f"{OLLAMA_ENDPOINT.rstrip('/')}/api/chat" # TODO
 DEFAULT_MODEL = os.getenv("LLM_MODEL", "azzl:guava")
+DISCONNECT_POLL_INTERVAL = 0.5  # クライアントの切断を確認する間隔 (秒)
+# モデルをメモリに残しておく時間 (Ollama の keep_alive) と、同じモデルへの事前ロードを送る最短間隔 (秒)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "10m")
+MODEL_PRELOAD_INTERVAL = float(os.getenv("MODEL_PRELOAD_INTERVAL", 60))
+
+_last_preload = {}        # モデル名 -> 最後に事前ロードを送った時刻 (monotonic)
+_background_tasks = set()  # 実行中の事前ロード (参照を持っておかないと GC で消える)
+
+
+async def preload_model(model: str) -> float:
+    """
+    プロンプトなしの /api/generate でモデルをロードさせ、keep_alive を延ばす。
+    プロンプトの準備中にロードを済ませておく。かかった時間 (秒) を返す (送らなかった場合は 0)。
+    """
+    now = time.monotonic()
+    if now - _last_preload.get(model, float("-inf")) < MODEL_PRELOAD_INTERVAL:
+        return 0.0
+    _last_preload[model] = now
+    start = time.perf_counter()
+    try:
+        async with httpx.AsyncClient(timeout=None) as client:
+            resp = await client.post(OLLAMA_GEN_URL, json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE})
+            resp.raise_for_status()
+    except Exception as e:
+        _last_preload.pop(model, None)
+        logger.warning(f"Model preload failed ({model}): {e}")
+        return 0.0
+    metrics.inc("model_preloads")
+    return time.perf_counter() - start
+
+
+def start_preload(model: str) -> asyncio.Task:
+    task = asyncio.create_task(preload_model(model))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def timed(coro) -> tuple:
+    """(結果, かかった時間 (秒)) を返す。"""
+    start = time.perf_counter()
+    result = await coro
+    return result, time.perf_counter() - start
+
+
+def record_overlap(timings: dict, wall: float, preload: asyncio.Task) -> float:
+    """
+    並行に実行した段階の時間の合計と実際の経過時間の差 (直列に実行した場合との差) を記録する。
+    モデルのロードはプロンプトの準備と重なった分を含める (終わっていなければ準備時間の全体)。
+    """
+    saved = max(0.0, sum(timings.values()) - wall)
+    if preload.done():
+        timings["preload"] = preload.result()
+        saved += min(timings["preload"], wall)
+    else:
+        saved += wall
+    metrics.inc("ask_requests")
+    metrics.inc("ask_overlap_seconds_saved", saved)
+    metrics.set("ask_overlap_last_seconds_saved", round(saved, 4))
+    return saved
+
+
+
+async def close_on_disconnect(request: Request, upstream: httpx.Response, disconnected: asyncio.Event):
+    """
+    クライアントが切断したら Ollama へのストリームを閉じる。
+    接続が切れると Ollama は生成を中断する (プロンプト処理中でも止まる)。
+    """
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+    disconnected.set()
+    await upstream.aclose()
+
+
+def record_generation(mode: str, tokens: int, completed: bool):
+    """
+    生成の完了・キャンセルを記録する。
+    キャンセル時に節約できたトークン数は、同じモードで完了した生成の平均トークン数からの推定値。
+    """
+    if completed:
+        metrics.inc("generations_completed")
+        metrics.inc(f"generation_tokens.{mode}", tokens)
+        metrics.inc(f"generations_completed.{mode}")
+        return
+    completed_count = metrics.get(f"generations_completed.{mode}")
+    average = metrics.get(f"generation_tokens.{mode}") / completed_count if completed_count else 0
+    reclaimed = max(0, round(average - tokens))
+    metrics.inc("generations_cancelled")
+    metrics.inc("generation_tokens_before_cancel", tokens)
+    metrics.inc("generation_tokens_reclaimed", reclaimed)
+    logger.info(f"Generation cancelled by client (mode: {mode}, {tokens} tokens generated, ~{reclaimed} reclaimed)")
 
 @app.post("/api/ask")
 async def handle_ask(
+    request: Request,
     question: str = Form(...),
     language: str = Form(""),
     mode: str = Form("ask"),
     model: Optional[str] = Form(None),
+    shards: Optional[str] = Form(None),
+    stream: str = Form("raw"),
     files: List[UploadFile] = File([]),
 ):
     logger.info(f"Received request with mode: {mode}, model: {model}, files: {len(files)}")
@@ -53,21 +165,80 @@ async def handle_ask(
     if not model:
         model = DEFAULT_MODEL
 
-    # reader.py の関数を呼び出してファイルの内容を取得
-    combined_file_content = await read_uploaded_files(files)
+    # 応答の形式: raw (Ollama の NDJSON をそのまま) / ndjson / sse (トークンをまとめて送る)
+    if stream not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown stream format: {stream}")
+
+    # 検索対象のシャード (カンマ区切り, 省略時は全シャード)
+    shard_filter = [name.strip() for name in shards.split(",") if name.strip()] if shards else None
+
+    set_field("mode", mode)
+    set_field("model", model)
+    set_field("stream", stream)
+
+    # モデルのロードを先に始める (プロンプトの準備と並行)
+    preload = start_preload(model)
+    started = time.perf_counter()
+    timings = {}
+
+    # ファイルの変換と関連情報の検索 (埋め込み・検索・再ランキング) を並行に実行する
+    stages = {"files": timed(read_uploaded_files(files))}
+    if needs_context(mode, bool(files)):
+        stages["retrieve"] = timed(asyncio.to_thread(retrieve_context, question, TOP_N, shards=shard_filter))
+    results = dict(zip(stages, await asyncio.gather(*stages.values())))
+    timings.update({name: seconds for name, (_, seconds) in results.items()})
+    combined_file_content = results["files"][0]
+    context = results["retrieve"][0] if "retrieve" in results else None
 
     # prompting.py の関数を使ってプロンプトを生成
-    prompt = generate_prompt(question, language, mode, combined_file_content, reason=True)
+    # (添付ファイルが空だった場合はここで検索するので、イベントループを止めないようスレッドで実行)
+    prompt, timings["prompt"] = await timed(asyncio.to_thread(
+        generate_prompt, question, language, mode, combined_file_content, reason=True,
+        shards=shard_filter, context=context,
+    ))
 
+    wall = time.perf_counter() - started
+    saved = record_overlap(timings, wall, preload)
+    for name, seconds in timings.items():
+        add_timing(name, seconds)
+    set_field("overlap_saved_ms", round(saved * 1000, 1))
+    logger.info(
+        "Prepared prompt in %.3fs (%s, ~%.3fs saved by overlap)",
+        wall, ", ".join(f"{k}={v:.3f}s" for k, v in timings.items()), saved,
+    )
     logger.info(f"Constructed prompt (first 100 chars): {prompt[:100]}...")
 
     ollama_req = {
         "model": model,
-        "prompt": prompt
+        "prompt": prompt,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
     }
     headers = {"Content-Type": "application/json"}
 
+    trace = current_trace()
+
     async def stream_response():
+        tokens = 0
+        completed = failed = False
+        disconnected = asyncio.Event()
+        generate_start = time.perf_counter()
+        first_token = None
+
+        def read_line(line: str) -> dict:
+            nonlocal tokens, completed, first_token
+            if first_token is None:
+                first_token = time.perf_counter() - generate_start
+            try:
+                data = json.loads(line)
+            except ValueError:
+                return {}
+            if data.get("done"):
+                tokens = data.get("eval_count", tokens)
+                completed = True
+            elif "response" in data:
+                tokens += 1
+            return data
+
         async with httpx.AsyncClient(timeout=None) as client:
             try:
                 async with client.stream("POST", OLLAMA_GEN_URL, json=ollama_req, headers=headers) as resp:
@@ -75,11 +246,56 @@ async def handle_ask(
                         content = await resp.aread()
                         logger.error(f"Ollama API error: {resp.status_code} - {content.decode()}")
                         raise HTTPException(status_code=resp.status_code, detail=content.decode())
-                    async for chunk in resp.aiter_text():
-                        yield chunk
+                    watcher = asyncio.create_task(close_on_disconnect(request, resp, disconnected))
+                    try:
+                        if stream == "raw":
+                            # Ollama の応答は 1 行 1 トークンの NDJSON
+                            async for line in resp.aiter_lines():
+                                if line:
+                                    read_line(line)
+                                    yield line + "\n"
+                        else:
+                            # 一定時間内のトークンを 1 つのイベントにまとめて送る
+                            async for lines in coalesce((line async for line in resp.aiter_lines() if line)):
+                                text, frames = [], []
+                                for line in lines:
+                                    data = read_line(line)
+                                    if "error" in data:
+                                        frames.append(format_event(stream, "error", {"detail": data["error"]}))
+                                    elif data.get("done"):
+                                        if text:
+                                            frames.append(format_event(stream, "token", {"text": "".join(text)}))
+                                            text = []
+                                        stats = generation_stats(data)
+                                        if trace is not None:
+                                            stats["request_id"] = trace.request_id
+                                        frames.append(format_event(stream, "done", stats))
+                                    else:
+                                        text.append(data.get("response", ""))
+                                if text:
+                                    frames.append(format_event(stream, "token", {"text": "".join(text)}))
+                                if frames:
+                                    yield "".join(frames)
+                    finally:
+                        watcher.cancel()
             except Exception as e:
-                logger.error(f"Error streaming from Ollama: {str(e)}")
-                yield f"Error: {e}"
-
-    return StreamingResponse(stream_response(), media_type="application/json")
+                if not disconnected.is_set():
+                    failed = True
+                    logger.error(f"Error streaming from Ollama: {str(e)}")
+                    yield f"Error: {e}" if stream == "raw" else format_event(stream, "error", {"detail": str(e)})
+            finally:
+                # 完了もエラーもしていなければクライアントの切断による中断
+                # (Starlette がジェネレーターを止めた場合もここに来る)
+                if not failed:
+                    record_generation(mode, tokens, completed)
+                # ヘッダー送信後の段階なので JSON ログにだけ残る
+                if trace is not None:
+                    if first_token is not None:
+                        trace.add("ollama_first_token", first_token)
+                    trace.add("ollama", time.perf_counter() - generate_start)
+                    trace.fields["tokens"] = tokens
+                    trace.fields["completed"] = completed
 
+    # SSE はプロキシにバッファされないようにする
+    stream_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} if stream == "sse" else None
+    return StreamingResponse(stream_response(), media_type=STREAM_FORMATS[stream], headers=stream_headers)
@@ -0,0 +1,28 @@
+# server/health.py
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from gen.retriever import is_ready, warmup_status
+
+health_router = APIRouter()
+
+# main.py が起動時間 (インポート時間など) を書き込む
+startup_metrics = {}
+
+
+@health_router.get("/healthz")
+async def healthz():
+    """
+    プロセスが生きていれば 200 を返す (liveness)。
+    """
+    return JSONResponse(status_code=200, content={"status": "ok", **startup_metrics})
+
+
+@health_router.get("/readyz")
+async def readyz():
+    """
+    検索用のモデル・インデックスの読み込みが完了していれば 200、
+    ウォームアップ中・失敗時は 503 を返す (readiness)。
+    """
+    status = warmup_status()
+    status_code = 200 if is_ready() else 503
+    return JSONResponse(status_code=status_code, content={**status, **startup_metrics})
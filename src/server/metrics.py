@@ -0,0 +1,44 @@
+# server/metrics.py
+import threading
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from gen.batching import batcher_stats
+
+metrics_router = APIRouter()
+
+
+class Metrics:
+    """
+    ワーカー内のカウンター・ゲージ。スレッドからもイベントループからも更新できる。
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name: str, value):
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name: str, default=0):
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+
+metrics = Metrics()
+
+
+@metrics_router.get("/metrics")
+async def get_metrics():
+    """
+    このワーカーのカウンター (生成のキャンセル数など) と、マイクロバッチの統計を返す。
+    """
+    return JSONResponse(status_code=200, content={**metrics.snapshot(), **batcher_stats()})
@@ -1,12 +1,12 @@
 # reader.py
 import os
+import asyncio
 import tempfile
 import logging
 from typing import List
 from fastapi import HTTPException, UploadFile
 
-# MarkItDown のインポート（ライブラリに合わせて適宜インポート方法を変更してください）
-from markitdown import MarkItDown
+from gen.cache import upload_cache, content_hash
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +14,40 @@ logger = logging.getLogger(__name__)
 ALLOWED_EXTENSIONS = {".c", ".py", ".java", ".js", ".cpp", ".go", ".txt", ".md", ".html", ".php", ".tsx",".html", ".csv", ".json", ".xml"}
 MARKITDOWN_EXTENSIONS = {".pdf", ".docx", ".pptx", ".xlsx"}
 
-md_converter = MarkItDown()
+# MarkItDown は重いので最初の変換時にインポート・生成する
+md_converter = None
+
+
+def get_converter():
+    global md_converter
+    if md_converter is None:
+        from markitdown import MarkItDown
+        md_converter = MarkItDown()
+    return md_converter
+
+
+def convert_with_markitdown(data: bytes, ext: str) -> str:
+    """
+    MarkItDown でバイナリを Markdown テキストに変換する。
+    同じ内容のファイルは SHA-256 をキーにキャッシュから返し、変換をスキップする。
+    """
+    key = content_hash(data, salt=ext)
+    cached = upload_cache.get(key)
+    if cached is not None:
+        logger.info(f"Upload cache hit: {key[:12]}{ext}")
+        return cached
+
+    with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
+        tmp.write(data)
+        tmp_path = tmp.name
+    try:
+        result = get_converter().convert(tmp_path)
+    finally:
+        os.remove(tmp_path)
+
+    file_text = result.text_content or ""
+    upload_cache.put(key, file_text)
+    return file_text
 
 async def read_uploaded_files(files: List[UploadFile]) -> str:
     """
@@ -29,13 +62,10 @@ async def read_uploaded_files(files: List[UploadFile]) -> str:
 
         if ext in MARKITDOWN_EXTENSIONS:
             try:
-                with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
-                    tmp.write(await file.read())
-                    tmp_path = tmp.name
-                result = md_converter.convert(tmp_path)
-                file_text = result.text_content or ""
+                data = await file.read()
+                # 変換は重いのでイベントループを塞がないようスレッドで実行
+                file_text = await asyncio.to_thread(convert_with_markitdown, data, ext)
                 combined_content += f"\n\n--- Start of {filename} ---\n{file_text}\n--- End of {filename} ---\n"
-                os.remove(tmp_path)
             except Exception as e:
                 logger.error(f"Error converting {filename}: {str(e)}")
                 raise HTTPException(status_code=500, detail=f"Error converting {filename}: {str(e)}")
@@ -0,0 +1,62 @@
+# server/retrieve.py
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from dotenv import load_dotenv
+from gen.retriever import retrieve_batch, warmup_status
+from config import TOP_N
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+retrieve_router = APIRouter()
+
+# 1 回のリクエストで受け付ける質問数の上限
+RETRIEVE_MAX_QUESTIONS = int(os.getenv("RETRIEVE_MAX_QUESTIONS", 10000))
+
+
+class RetrieveRequest(BaseModel):
+    questions: List[str]
+    top_n: int = TOP_N
+    shards: Optional[List[str]] = None  # 検索対象のシャード (省略時は全シャード)
+    where: Optional[dict] = None        # メタデータの絞り込み条件 (例: {"source": "wiki.db"})
+
+
+@retrieve_router.post("/retrieve")
+async def retrieve(request: RetrieveRequest):
+    """
+    複数の質問について、回答を生成せずに検索結果だけを返す。
+    各文書には Dense 検索の類似度 (similarity) と再ランキングのスコア (rerank_score) が付く。
+    検索に渡した値が不正なとき (ValueError) は 400、ウォームアップ中は 503 を返す。
+    """
+    if not request.questions:
+        raise HTTPException(status_code=400, detail="questions is empty")
+    if len(request.questions) > RETRIEVE_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"Too many questions (max {RETRIEVE_MAX_QUESTIONS})")
+    if request.top_n <= 0:
+        raise HTTPException(status_code=400, detail="top_n must be positive")
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.to_thread(
+            retrieve_batch, request.questions, request.top_n, where=request.where, shards=request.shards,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        status_code = 503 if "warming up" in str(e) else 502
+        raise HTTPException(status_code=status_code, detail=str(e))
+
+    return JSONResponse(status_code=200, content={
+        "version": warmup_status().get("version"),
+        "elapsed_seconds": round(time.perf_counter() - start, 3),
+        "results": [
+            {"question": question, "documents": documents}
+            for question, documents in zip(request.questions, results)
+        ],
+    })
@@ -0,0 +1,95 @@
+# server/streaming.py
+import os
+import json
+import asyncio
+from typing import AsyncIterator, List
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# トークンをまとめて送る間隔 (ミリ秒) と、それより前に送り出すバッファサイズ (文字数)
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", 20))
+STREAM_COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", 2048))
+
+# /api/ask の stream パラメータと Content-Type
+#   raw    ... Ollama の NDJSON をそのまま 1 行ずつ転送 (従来どおり)
+#   ndjson ... {"type": "token", "text": ...} / {"type": "done", ...統計} の NDJSON
+#   sse    ... event: token / event: done の Server-Sent Events
+STREAM_FORMATS = {
+    "raw": "application/json",
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+# 最後のイベントに含める Ollama の統計 (時間はナノ秒)
+STATS_KEYS = (
+    "model", "eval_count", "eval_duration", "prompt_eval_count", "prompt_eval_duration",
+    "load_duration", "total_duration", "done_reason",
+)
+
+
+def format_event(stream_format: str, event: str, data: dict) -> str:
+    """イベントを SSE または NDJSON の 1 フレームにする。"""
+    payload = data if stream_format == "sse" else {"type": event, **data}
+    text = json.dumps(payload, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {text}\n\n"
+    return text + "\n"
+
+
+def generation_stats(final: dict) -> dict:
+    """Ollama の最終行 (done: true) から統計を取り出し、トークン/秒を加える。"""
+    stats = {key: final[key] for key in STATS_KEYS if key in final}
+    if final.get("eval_count") and final.get("eval_duration"):
+        stats["tokens_per_second"] = round(final["eval_count"] / (final["eval_duration"] / 1e9), 2)
+    return stats
+
+
+async def coalesce(source: AsyncIterator[str], window_ms: float = STREAM_COALESCE_MS,
+                   max_chars: int = STREAM_COALESCE_CHARS) -> AsyncIterator[List[str]]:
+    """
+    source の要素をまとめ、最初の要素から window_ms 経過するか max_chars を超えた時点で
+    リストとして返す。source が終わったら残りをすぐに返す。
+    読み取りは別タスクで行うので、待ち時間の打ち切りで source の読み取りが中断されることはない。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    end = object()
+
+    async def pump():
+        try:
+            async for item in source:
+                queue.put_nowait(item)
+        except Exception as e:
+            queue.put_nowait(e)
+        else:
+            queue.put_nowait(end)
+
+    task = asyncio.create_task(pump())
+    try:
+        batch, size, deadline = [], 0, None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield batch
+                batch, size, deadline = [], 0, None
+                continue
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                if batch:
+                    yield batch  # 受け取り済みの分を送ってからエラーにする
+                raise item
+            batch.append(item)
+            size += len(item)
+            if deadline is None:
+                deadline = loop.time() + window_ms / 1000
+            if size >= max_chars:
+                yield batch
+                batch, size, deadline = [], 0, None
+        if batch:
+            yield batch
+    finally:
+        task.cancel()
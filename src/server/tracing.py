@@ -0,0 +1,260 @@
+# server/tracing.py
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from dotenv import load_dotenv
+from gen.tracing import Trace, start_trace
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+# 1 リクエスト 1 行の JSON ログ (request_id・段階ごとの時間) を出すロガー
+request_logger = logging.getLogger("azzl.request")
+
+OUT_DIR = os.getenv("OUT_DIR", "../out")
+PROFILE_DIR = os.path.join(OUT_DIR, "profiles")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 600))  # プロファイル取得を有効にしておく最長時間
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))    # スタックを記録する間隔 (ミリ秒)
+PROFILE_MIN_PERCENT = 1.0  # コールツリーに表示する最小の割合 (スレッドごとのサンプル数に対する %)
+# このディレクトリ (src/) 以下のコードを含まないスタック (待機中のスレッドプールなど) は数えない
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# プロファイルの対象外 (管理 API・ヘルスチェック・メトリクス)
+PROFILE_EXCLUDE_PREFIXES = ("/api/admin", "/healthz", "/readyz", "/metrics")
+# クライアントが X-Request-ID で渡した ID は、この文字だけなら引き継ぐ (ヘッダーにそのまま返すため)
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def server_timing(trace: Trace) -> str:
+    """Server-Timing ヘッダーの値 (各段階と、ヘッダー送信までの合計, ミリ秒)。"""
+    items = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in trace.stages.items()]
+    items.append(f"total;dur={trace.elapsed() * 1000:.1f}")
+    return ", ".join(items)
+
+
+class SamplingProfiler:
+    """
+    sys._current_frames() で全スレッドのスタックを interval 秒ごとに記録し、
+    スレッドごとのコールツリーにまとめる。各サンプルは前回のサンプルからの実時間で重み付けする
+    (GIL を持ったままのスレッドがあると記録の間隔が interval より長くなるため)。
+    イベントループのスレッドだけでなく、asyncio.to_thread のワーカー (retrieve_context・
+    MarkItDown の変換) やマイクロバッチャーのスレッド (埋め込み・再ランキング) も含む。
+    プロセス全体を記録するので、同時に処理中の他のリクエストの分も含まれる。
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000, root: str = PROJECT_ROOT):
+        self.interval = interval
+        self.root = root
+        self.samples: Counter = Counter()  # (スレッド名, スタック) -> 秒
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            self.sample(now - last, exclude=own)
+            last = now
+
+    def sample(self, weight: float, exclude: int = None):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == exclude:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_name, code.co_firstlineno))
+                frame = frame.f_back
+            if not any(filename.startswith(self.root) for filename, _, _ in stack):
+                continue
+            self.samples[(names.get(ident, str(ident)), tuple(reversed(stack)))] += weight
+
+    def output_text(self) -> str:
+        """スレッドごとのコールツリー (割合・時間・関数名・ファイル:行) をテキストで返す。"""
+        trees = {}
+        for (thread, stack), seconds in self.samples.items():
+            node = trees.setdefault(thread, {"seconds": 0.0, "children": {}})
+            node["seconds"] += seconds
+            for frame in stack:
+                node = node["children"].setdefault(frame, {"seconds": 0.0, "children": {}})
+                node["seconds"] += seconds
+
+        lines = []
+
+        def render(frame, node, total, depth):
+            percent = node["seconds"] * 100 / total
+            if percent < PROFILE_MIN_PERCENT:
+                return
+            filename, name, line = frame
+            if filename.startswith(self.root):
+                filename = os.path.relpath(filename, self.root)
+            lines.append(
+                f"{'  ' * depth}{percent:5.1f}% {node['seconds'] * 1000:8.0f}ms  {name}  {filename}:{line}"
+            )
+            for child_frame, child in sorted(node["children"].items(), key=lambda x: -x[1]["seconds"]):
+                render(child_frame, child, total, depth + 1)
+
+        for thread, root in sorted(trees.items(), key=lambda x: -x[1]["seconds"]):
+            lines.append(f"[{thread}] {root['seconds'] * 1000:.0f}ms")
+            for frame, child in sorted(root["children"].items(), key=lambda x: -x[1]["seconds"]):
+                render(frame, child, root["seconds"], 1)
+            lines.append("")
+        return "\n".join(lines)
+
+
+class ProfileSwitch:
+    """
+    次の N 件のリクエスト、または slower_than_ms より遅いリクエストのサンプリングプロファイル
+    (SamplingProfiler のスレッドごとのコールツリー) を PROFILE_DIR にテキストで保存する。
+    slower_than_ms を指定した場合は有効な間すべてのリクエストを計測し、遅かったものだけを残す。
+    プロファイラーは同時に 1 つだけ動かす (計測中に来たリクエストは対象外)。
+    状態はワーカーごと (複数ワーカーでは各ワーカーで有効にする)。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.remaining = 0
+        self.slower_than_ms = 0.0
+        self.expires_at = 0.0
+        self.captured = []
+        self._running = False
+
+    def enable(self, requests: int, slower_than_ms: float = 0.0, max_seconds: float = PROFILE_MAX_SECONDS):
+        with self._lock:
+            self.remaining = requests
+            self.slower_than_ms = slower_than_ms
+            self.expires_at = time.monotonic() + max_seconds
+
+    def disable(self):
+        with self._lock:
+            self.remaining = 0
+
+    @property
+    def active(self) -> bool:
+        return self.remaining > 0 and time.monotonic() < self.expires_at
+
+    def status(self) -> dict:
+        return {
+            "active": self.active,
+            "remaining": self.remaining if self.active else 0,
+            "slower_than_ms": self.slower_than_ms,
+            "expires_in_seconds": round(max(0.0, self.expires_at - time.monotonic()), 1) if self.active else 0,
+            "captured": list(self.captured),
+        }
+
+    def start(self, path: str):
+        """対象のリクエストならプロファイラーを開始して返す。"""
+        if not self.active or path.startswith(PROFILE_EXCLUDE_PREFIXES):
+            return None
+        with self._lock:
+            if self._running or self.remaining <= 0:
+                return None
+            self._running = True
+            if not self.slower_than_ms:
+                self.remaining -= 1
+        profiler = SamplingProfiler()
+        try:
+            profiler.start()
+        except BaseException:
+            self._release()
+            raise
+        return profiler
+
+    def _release(self):
+        with self._lock:
+            self._running = False
+
+    def finish(self, profiler, trace: Trace, path: str, duration_ms: float):
+        try:
+            profiler.stop()
+        finally:
+            self._release()
+        if self.slower_than_ms:
+            with self._lock:
+                if duration_ms < self.slower_than_ms or self.remaining <= 0:
+                    return
+                self.remaining -= 1
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{trace.request_id}.txt"
+        with open(os.path.join(PROFILE_DIR, name), "w", encoding="utf-8") as f:
+            f.write(f"{trace.request_id} {path} {duration_ms:.0f}ms\n\n")
+            f.write(profiler.output_text())
+        self.captured.append({
+            "request_id": trace.request_id, "path": path, "duration_ms": round(duration_ms, 1), "file": name,
+        })
+        logger.info(f"Saved profile of {path} ({duration_ms:.0f} ms): {os.path.join(PROFILE_DIR, name)}")
+
+
+profile_switch = ProfileSwitch()
+
+
+class TracingMiddleware:
+    """
+    リクエストごとに Trace を開始し、
+      - 応答ヘッダーに X-Request-ID と Server-Timing (ヘッダー送信までに終わった段階) を付ける
+      - 応答の送信完了後 (ストリーミングでは最後のチャンクの後) に JSON のログを 1 行出す
+      - ProfileSwitch が有効ならプロファイルを取る
+    ストリーミング中の生成時間はヘッダーに載せられないため、ログにだけ含まれる。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")
+        if not _REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex[:16]
+        trace = start_trace(request_id)
+        path = scope.get("path", "")
+        status = {"code": 500}
+        profiler = profile_switch.start(path)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", request_id.encode("latin-1")),
+                    (b"server-timing", server_timing(trace).encode("latin-1")),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            duration_ms = trace.elapsed() * 1000
+            if profiler is not None:
+                try:
+                    profile_switch.finish(profiler, trace, path, duration_ms)
+                except Exception as e:
+                    logger.warning(f"Failed to save profile: {e}")
+            request_logger.info(json.dumps({
+                "request_id": request_id,
+                "method": scope.get("method"),
+                "path": path,
+                "status": status["code"],
+                "duration_ms": round(duration_ms, 1),
+                "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in trace.stages.items()},
+                **trace.fields,
+            }, ensure_ascii=False))
@@ -0,0 +1,6 @@
+# tests/conftest.py
+import os
+import sys
+
+# サーバーと同じく src/ をカレントとしてモジュールを読み込む (from gen.xxx import ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,112 @@
+# tests/test_admin.py
+import os
+import pytest
+
+import gen.database as database
+import gen.retriever as retriever
+from gen.database import read_current_version, save_vector_db
+from gen.search import ShardedStore
+
+
+def _unit(i: int, dim: int = 8) -> list:
+    return [1.0 if j == i % dim else 0.0 for j in range(dim)]
+
+
+@pytest.fixture
+def rebuild_env(tmp_path, monkeypatch):
+    index_dir = tmp_path / "index"
+    vector_db = str(tmp_path / "vector_database.json")
+    monkeypatch.setattr(retriever, "INDEX_DIR", str(index_dir))
+    monkeypatch.setattr(retriever, "shard_dir", lambda shard: str(index_dir / shard))
+    monkeypatch.setattr(retriever, "list_shards", lambda: sorted(
+        name for name in os.listdir(index_dir) if (index_dir / name).is_dir()
+    ) if index_dir.exists() else [])
+    monkeypatch.setattr(retriever, "VECTOR_DB_PATH", vector_db)
+    monkeypatch.setattr(retriever, "load_vector_db", lambda: database.load_vector_db(vector_db))
+    monkeypatch.setattr(retriever, "VECTOR_STORE", "numpy")
+    monkeypatch.setattr(retriever, "_active", ShardedStore({}))
+    save_vector_db([
+        {"id": f"wiki:{i}", "embedding": _unit(i), "document": f"doc {i}",
+         "metadata": {"source": "wiki.db", "shard": "wiki"}}
+        for i in range(4)
+    ], vector_db)
+    return index_dir
+
+
+def test_rebuild_index_validates_then_switches(rebuild_env):
+    result = retriever.rebuild_index(dtype="float32")
+    version = result["versions"]["wiki"]
+    assert result["validation"]["wiki"]["documents"] == 4
+    assert result["validation"]["wiki"]["self_recall"] == 1.0
+    assert read_current_version(str(rebuild_env / "wiki")) == version
+    [best] = retriever._active.search(_unit(2), 1)
+    assert best["document"] == "doc 2"
+
+
+def test_rebuild_index_keeps_current_when_validation_fails(rebuild_env, monkeypatch):
+    version = retriever.rebuild_index(dtype="float32")["versions"]["wiki"]
+    active = retriever._active
+
+    monkeypatch.setattr(retriever, "REINDEX_MIN_SELF_RECALL", 1.1)
+    with pytest.raises(ValueError, match="self-retrieval"):
+        retriever.rebuild_index(dtype="float32")
+    assert read_current_version(str(rebuild_env / "wiki")) == version
+    assert sorted(os.listdir(rebuild_env / "wiki")) == sorted(["CURRENT", version])
+    assert retriever._active is active
+
+
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(retriever, "INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(retriever, "REINDEX_STATE_FILE", str(tmp_path / ".reindex.json"))
+    monkeypatch.setattr(retriever, "REINDEX_LOCK_FILE", str(tmp_path / ".reindex.lock"))
+    return tmp_path
+
+
+def test_reindex_lock_is_exclusive_across_open_files(index_dir):
+    # ワーカーごとに別の open になるので、同じプロセス内でも別プロセスと同じく競合する
+    first = retriever.acquire_reindex_lock()
+    assert first is not None
+    assert retriever.acquire_reindex_lock() is None
+    first.close()
+    second = retriever.acquire_reindex_lock()
+    assert second is not None
+    second.close()
+
+
+def test_reindex_job_state_is_shared_and_detects_dead_runner(index_dir):
+    assert retriever.read_reindex_job() == {"state": "idle"}
+
+    lock_file = retriever.acquire_reindex_lock()
+    retriever.write_reindex_job({"state": "running", "pid": os.getpid()})
+    assert retriever.read_reindex_job()["state"] == "running"
+
+    # 実行していたワーカーが落ちてロックが外れた
+    lock_file.close()
+    assert retriever.read_reindex_job()["state"] == "interrupted"
+
+
+def test_admin_routes_refuse_without_token_and_outside_ingest_dir(tmp_path, monkeypatch):
+    pytest.importorskip("fastapi")
+    from fastapi import HTTPException
+    import server.auth as auth
+    import server.admin as admin
+
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "")
+    with pytest.raises(HTTPException) as e:
+        auth.check_admin_token("anything")
+    assert e.value.status_code == 403
+
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+    with pytest.raises(HTTPException) as e:
+        auth.check_admin_token("wrong")
+    assert e.value.status_code == 401
+    auth.check_admin_token("secret")
+
+    (tmp_path / "wiki.db").write_text("line\n", encoding="utf-8")
+    monkeypatch.setattr(admin, "INGEST_DIR", str(tmp_path))
+    assert admin.resolve_input_files(["wiki.db"]) == [os.path.realpath(tmp_path / "wiki.db")]
+    for path in ("/etc/passwd", "../etc/passwd", str(tmp_path / ".." / "x.db")):
+        with pytest.raises(HTTPException) as e:
+            admin.resolve_input_files([path])
+        assert e.value.status_code == 400
@@ -0,0 +1,60 @@
+# tests/test_batching.py
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import gen.batching as batching
+from gen.batching import MicroBatcher
+
+
+@pytest.fixture
+def make_batcher():
+    created = []
+
+    def make(fn, window_ms=100, max_batch=64):
+        batcher = MicroBatcher("test", fn, window_ms, max_batch)
+        created.append(batcher)
+        return batcher
+
+    yield make
+    for batcher in created:
+        batching._batchers.remove(batcher)
+
+
+def test_concurrent_submits_share_one_batch(make_batcher):
+    calls = []
+    batcher = make_batcher(lambda items: calls.append(list(items)) or [item * 10 for item in items])
+    start = threading.Barrier(4)
+
+    def submit(i):
+        start.wait()
+        return batcher.submit_many([i, i + 100])
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(submit, range(4)))
+
+    assert results == [[i * 10, (i + 100) * 10] for i in range(4)]
+    assert len(calls) == 1 and sorted(calls[0]) == sorted([0, 1, 2, 3, 100, 101, 102, 103])
+    assert batcher.stats() == {"batches": 1, "items": 8, "max_batch": 8, "average_batch": 8.0}
+    assert batching.batcher_stats()["batch.test.items"] == 8
+
+
+def test_batch_size_is_capped(make_batcher):
+    calls = []
+    batcher = make_batcher(lambda items: calls.append(len(items)) or items, window_ms=10_000, max_batch=3)
+    assert batcher.submit_many(list(range(6))) == list(range(6))
+    assert calls == [3, 3]
+
+
+def test_failed_batch_raises_in_every_waiter(make_batcher):
+    def fail(items):
+        raise RuntimeError("embedding failed")
+
+    batcher = make_batcher(fail)
+    with pytest.raises(RuntimeError, match="embedding failed"):
+        batcher.submit_many(["a", "b"])
+
+    batcher = make_batcher(lambda items: items[:1])
+    with pytest.raises(RuntimeError, match="1 results for 2 items"):
+        batcher.submit_many(["a", "b"])
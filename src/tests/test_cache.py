@@ -0,0 +1,30 @@
+# tests/test_cache.py
+from gen.cache import ContentCache, content_hash
+
+
+def test_content_hash_is_salted():
+    assert content_hash(b"data") == content_hash(b"data")
+    assert content_hash(b"data", salt=".pdf") != content_hash(b"data", salt=".docx")
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = ContentCache("test", max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # a を最近使ったので b が追い出される
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 1
+
+
+def test_disk_cache_survives_restart_and_is_size_capped(tmp_path):
+    cache = ContentCache("test", max_entries=1, disk_dir=str(tmp_path))
+    cache.put(content_hash(b"x"), {"text": "x"})
+    # 別プロセス (新しいインスタンス) からも読める
+    assert ContentCache("test", max_entries=1, disk_dir=str(tmp_path)).get(content_hash(b"x")) == {"text": "x"}
+
+    capped = ContentCache("capped", max_entries=1, disk_dir=str(tmp_path / "capped"), max_disk_bytes=100)
+    for i in range(10):
+        capped.put(content_hash(str(i).encode()), "v" * 30)
+    assert capped.stats()["disk_bytes"] <= 100
@@ -0,0 +1,68 @@
+# tests/test_crawl.py
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+# rag/ のスクリプト群は単体で実行される前提なので、そのディレクトリを直接読み込む
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "rag"))
+
+import crawl  # noqa: E402
+
+
+def test_read_url_list_skips_comments_and_duplicates(tmp_path):
+    path = tmp_path / "urls.txt"
+    path.write_text("# コメント\nhttps://a/1\n\nhttps://a/2\n  https://a/1  \n", encoding="utf-8")
+    assert crawl.read_url_list(str(path)) == ["https://a/1", "https://a/2"]
+
+
+def test_fetch_with_retry_retries_retryable_status():
+    calls = []
+
+    def handler(request):
+        calls.append(str(request.url))
+        if len(calls) < 3:
+            return httpx.Response(503, headers={"Retry-After": "0"})
+        return httpx.Response(200, text="ok")
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await crawl.fetch_with_retry(client, "https://a/x", crawl.HostRateLimiter(0))
+
+    assert asyncio.run(run()).text == "ok"
+    assert len(calls) == 3
+
+
+def test_fetch_with_retry_gives_up_on_client_errors():
+    calls = []
+
+    def handler(request):
+        calls.append(str(request.url))
+        return httpx.Response(404)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await crawl.fetch_with_retry(client, "https://a/x", crawl.HostRateLimiter(0))
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_crawl_serializes_writes_and_counts_results():
+    written = []
+
+    async def process(client, url, limiter):
+        await asyncio.sleep(0)
+        if url.endswith("skip"):
+            return None
+        if url.endswith("fail"):
+            raise RuntimeError("boom")
+        return url
+
+    urls = [f"https://a/{i}" for i in range(10)] + ["https://a/skip", "https://a/fail"]
+    stats = asyncio.run(crawl.crawl(urls, process, written.append, concurrency=3, host_rate=0))
+    assert stats == {"ok": 10, "failed": 1, "skipped": 1}
+    assert sorted(written) == sorted(urls[:10])
@@ -0,0 +1,88 @@
+# tests/test_crawl_state.py
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "rag"))
+
+from crawl_state import CrawlStore  # noqa: E402
+
+
+def test_record_reports_new_changed_and_unchanged(tmp_path):
+    store = CrawlStore(str(tmp_path / "state.sqlite"), "wiki", str(tmp_path / "wiki.db"))
+    assert store.record("https://a/1", "A", "本文", etag='"v1"') == "new"
+    assert store.conditional_headers("https://a/1") == {"If-None-Match": '"v1"'}
+    assert store.record("https://a/1", "A", "本文", etag='"v2"') == "unchanged"
+    assert store.conditional_headers("https://a/1") == {"If-None-Match": '"v2"'}
+    assert store.record("https://a/1", "A", "新しい本文") == "changed"
+    assert store.conditional_headers("https://a/2") == {}
+    store.close()
+
+
+def test_export_replaces_updated_pages(tmp_path):
+    db_file = tmp_path / "wiki.db"
+    store = CrawlStore(str(tmp_path / "state.sqlite"), "wiki", str(db_file))
+    store.record("https://a/1", "A", "one")
+    store.record("https://a/2", "B", "two")
+    store.record("https://a/1", "A", "one v2")
+    store.export()
+    assert db_file.read_text(encoding="utf-8") == "one v2\ntwo\n"
+    store.close()
+
+
+def test_migrates_log_and_keeps_legacy_until_superseded(tmp_path):
+    log_file = tmp_path / "wiki.log"
+    db_file = tmp_path / "wiki.db"
+    log_file.write_text("[2024-01-01T00:00:00] https://a/1 A\n[2024-01-01T00:00:01] https://a/2 B\n", encoding="utf-8")
+    db_file.write_text("old one\nold two\n", encoding="utf-8")
+    store = CrawlStore(str(tmp_path / "state.sqlite"), "wiki", str(db_file), str(log_file))
+    assert store.urls() == ["https://a/1", "https://a/2"]
+    assert store.is_crawled("https://a/2")
+
+    store.record("https://a/1", "A", "new one")
+    assert not store.drop_legacy_if_superseded()
+    store.record("https://a/2", "B", "new two")
+    assert store.drop_legacy_if_superseded()
+    store.export()
+    assert db_file.read_text(encoding="utf-8") == "new one\nnew two\n"
+    store.close()
+
+
+def test_partial_refetch_replaces_only_that_urls_legacy_line(tmp_path):
+    log_file = tmp_path / "wiki.log"
+    db_file = tmp_path / "wiki.db"
+    log_file.write_text("".join(f"[2024-01-01T00:00:0{i}] https://a/{i} T{i}\n" for i in range(1, 4)), encoding="utf-8")
+    db_file.write_text("old one\nold two\nold three\n", encoding="utf-8")
+    store = CrawlStore(str(tmp_path / "state.sqlite"), "wiki", str(db_file), str(log_file), legacy_line_per_url=True)
+
+    assert store.record("https://a/2", "T2", "new two") == "changed"
+    assert store.drop_legacy_if_superseded()
+    store.export()
+    # 取り直した URL の旧本文は重複せず、その位置で置き換わる
+    assert db_file.read_text(encoding="utf-8") == "old one\nnew two\nold three\n"
+    store.close()
+
+
+def test_unsplit_legacy_skips_blocks_of_refetched_pdfs(tmp_path):
+    log_file = tmp_path / "pdf.log"
+    db_file = tmp_path / "pdf.db"
+    log_file.write_text("[2024-01-01T00:00:00] https://a/1.pdf 1.pdf\n[2024-01-01T00:00:01] https://a/2.pdf 2.pdf\n",
+                        encoding="utf-8")
+    db_file.write_text("one a\none b\ntwo a\n", encoding="utf-8")
+    store = CrawlStore(str(tmp_path / "state.sqlite"), "pdf", str(db_file), str(log_file))
+
+    store.record("https://a/1.pdf", "1.pdf", "<!-- page: 1 -->\none a\n<!-- page: 2 -->\none b")
+    assert not store.drop_legacy_if_superseded()
+    store.export()
+    assert db_file.read_text(encoding="utf-8") == "two a\n<!-- page: 1 -->\none a\n<!-- page: 2 -->\none b\n"
+    store.close()
+
+
+def test_record_parts_reports_empty_pages(tmp_path):
+    store = CrawlStore(str(tmp_path / "state.sqlite"), "pdf", str(tmp_path / "pdf.db"))
+    store.record("https://a/doc.pdf", "doc.pdf", "one\nthree")
+    store.record_parts("https://a/doc.pdf", [(1, "one"), (2, None), (3, "three"), (4, None)])
+    assert store.empty_parts("https://a/doc.pdf") == [2, 4]
+    store.record_parts("https://a/doc.pdf", [(1, "one"), (2, "two")])
+    assert store.empty_parts("https://a/doc.pdf") == []
+    assert store.empty_parts("https://a/other.pdf") == []
+    store.close()
@@ -0,0 +1,75 @@
+# tests/test_dedup.py
+import pytest
+
+from gen.dedup import dedup_report, deduplicate, find_near_duplicates, merge_duplicate_metadata
+from gen.search import from_chroma_metadata, to_chroma_metadata
+
+BOILERPLATE = "Copyright 2024 Example Corp. All rights reserved. 無断転載を禁じます。ページ 1 / 20"
+DOCUMENTS = [
+    ("東京都は日本の首都であり、人口は約1400万人である。", "wiki.db", 0, {}),
+    (BOILERPLATE, "pdf.db", 0, {"page": 1}),
+    ("富士山は日本で最も高い山で、標高は3776メートルである。", "wiki.db", 1, {}),
+    (BOILERPLATE.replace("1 / 20", "2 / 20"), "pdf.db", 1, {"page": 2}),
+    (BOILERPLATE, "wiki.db", 2, {}),
+]
+
+
+def dedup_entries(scope: str = "all") -> list:
+    kept, duplicates = deduplicate(DOCUMENTS, threshold=0.8, scope=scope)
+    entries = []
+    for i, (doc, source, n, extra) in enumerate(kept):
+        metadata = {"source": source, "shard": source[:-3], **extra}
+        if i in duplicates:
+            metadata = merge_duplicate_metadata(metadata, duplicates[i])
+        entries.append({"id": f"{source[:-3]}:{n}", "document": doc, "metadata": metadata})
+    return entries
+
+
+def test_find_near_duplicates_ignores_case_width_and_spaces():
+    texts = ["ＡＢＣ　ｄｅｆ  ghi jkl", "abc def ghi jkl", "まったく別の文章です。", "abc def ghi jkl"]
+    assert find_near_duplicates(texts, ["a", "a", "a", "b"], threshold=0.8) == [[0, 1]]
+
+
+def test_near_duplicates_are_merged_into_one_representative():
+    entries = dedup_entries()
+    assert [e["id"] for e in entries] == ["wiki:0", "pdf:0", "wiki:1"]
+    representative = entries[1]
+    assert representative["metadata"]["sources"] == ["pdf.db", "wiki.db"]
+    assert representative["metadata"]["page"] == 1
+    assert {(d["id"], d.get("page")) for d in representative["metadata"]["duplicates"]} == {("pdf:1", 2), ("wiki:2", None)}
+
+    # shard の範囲では別ファイルの行はまとめない
+    assert len(dedup_entries(scope="shard")) == 4
+
+
+def test_dedup_report_counts_clusters():
+    kept, duplicates = deduplicate(DOCUMENTS, threshold=0.8, scope="all")
+    assert dedup_report(len(DOCUMENTS), duplicates) == {
+        "documents": 5, "kept": 3, "removed": 2, "clusters": 1, "largest_cluster": 3, "removed_ratio": 0.4,
+    }
+    assert deduplicate(DOCUMENTS, threshold=0) == (DOCUMENTS, {})
+
+
+def test_dedup_metadata_is_stored_as_chroma_scalars():
+    metadata = next(e["metadata"] for e in dedup_entries() if "duplicates" in e["metadata"])
+    encoded = to_chroma_metadata(metadata)
+    assert all(isinstance(value, (str, int, float, bool)) for value in encoded.values())
+    assert from_chroma_metadata(encoded) == metadata
+
+
+def test_chroma_upsert_with_duplicates(tmp_path):
+    pytest.importorskip("chromadb")
+    from gen.search import ChromaStore
+
+    entries = dedup_entries()
+    store = ChromaStore(path=str(tmp_path), collection="dedup")
+    embeddings = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+    store.upsert(
+        ids=[e["id"] for e in entries], embeddings=embeddings,
+        documents=[e["document"] for e in entries], metadatas=[e["metadata"] for e in entries],
+    )
+    assert len(store) == 3
+    results = store.search_batch(embeddings, 1)
+    by_id = {e["id"]: e for e in entries}
+    for (candidate,) in results:
+        assert candidate["metadata"] == by_id[candidate["id"]]["metadata"]
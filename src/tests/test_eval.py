@@ -0,0 +1,108 @@
+# tests/test_eval.py
+import os
+import json
+import time
+import threading
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import server.auth as auth
+import server.eval as eval_module
+
+
+def test_writer_batches_records_and_rotates_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(eval_module, "EVAL_SEGMENT_MAX_MB", 200 / (1024 * 1024))  # 200 バイトでローテーション
+    writer = eval_module.FeedbackWriter(str(tmp_path))
+    for i in range(20):
+        writer.submit({"category": "good", "ts": time.time(), "q": f"質問 {i}"})
+        writer.flush()  # 1 件ずつ書き込み、セグメントを切り替えさせる
+    writer.stop()
+
+    assert writer.written == 20
+    records = []
+    for path in writer.segments():
+        with open(path, "r", encoding="utf-8") as f:
+            records += [json.loads(line) for line in f]
+    assert [r["q"] for r in records] == [f"質問 {i}" for i in range(20)]
+    assert len(os.listdir(tmp_path)) > 1
+
+
+def test_export_filters_by_category_and_time(tmp_path, monkeypatch):
+    writer = eval_module.FeedbackWriter(str(tmp_path))
+    monkeypatch.setattr(eval_module, "feedback_writer", writer)
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+    app = FastAPI()
+    app.include_router(eval_module.eval_router, prefix="/api")
+    client = TestClient(app)
+    admin = {"X-Admin-Token": "secret"}
+
+    evaluation = {"q": "質問", "a": "回答", "t": "2026-01-01", "i": "1", "m": "model", "mode": "ask"}
+    assert client.post("/api/eval/good", json=evaluation).status_code == 200
+    assert client.post("/api/eval/bad", json={**evaluation, "i": "2"}).status_code == 200
+
+    lines = client.get("/api/eval/export", params={"category": "bad"}, headers=admin).text.splitlines()
+    assert [json.loads(line)["i"] for line in lines] == ["2"]
+    assert client.get("/api/eval/export", params={"since": "2999-01-01T00:00:00"}, headers=admin).text == ""
+    assert client.get("/api/eval/export", params={"category": "other"}, headers=admin).status_code == 400
+    writer.stop()
+
+
+def test_interval_fsync_runs_while_idle(tmp_path, monkeypatch):
+    monkeypatch.setattr(eval_module, "EVAL_FSYNC", "interval")
+    monkeypatch.setattr(eval_module, "EVAL_FSYNC_INTERVAL", 0.2)
+    monkeypatch.setattr(eval_module, "EVAL_BATCH_WINDOW_MS", 0)
+    synced = threading.Event()
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        real_fsync(fd)
+        synced.set()
+
+    monkeypatch.setattr(eval_module.os, "fsync", fsync)
+    writer = eval_module.FeedbackWriter(str(tmp_path))
+    writer.start()
+    writer._last_fsync = time.monotonic()
+    writer.submit({"category": "good", "ts": time.time()})
+
+    # 後続の書き込みが無くても interval の経過後に fsync される
+    assert synced.wait(2)
+    assert writer.written == 1
+    writer.stop()
+
+
+def test_export_requires_admin_token(tmp_path, monkeypatch):
+    monkeypatch.setattr(eval_module, "feedback_writer", eval_module.FeedbackWriter(str(tmp_path)))
+    app = FastAPI()
+    app.include_router(eval_module.eval_router, prefix="/api")
+    client = TestClient(app)
+
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "")
+    assert client.get("/api/eval/export").status_code == 403
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", "secret")
+    assert client.get("/api/eval/export").status_code == 401
+    assert client.get("/api/eval/export", headers={"X-Admin-Token": "secret"}).status_code == 200
+
+
+def test_segments_keep_other_workers_open_segment(tmp_path):
+    writer = eval_module.FeedbackWriter(str(tmp_path))
+    for name in (
+        "feedback-20260101T000000-100-000.jsonl",  # ワーカー 100 がまだ書き込み中
+        "feedback-20260101T000010-200-000.jsonl",
+        "feedback-20260101T000020-200-000.jsonl",
+    ):
+        (tmp_path / name).write_text("", encoding="utf-8")
+    since = eval_module.datetime(2026, 1, 1, 0, 0, 30).timestamp()
+
+    names = [os.path.basename(path) for path in writer.segments(since=since)]
+    assert names == ["feedback-20260101T000000-100-000.jsonl", "feedback-20260101T000020-200-000.jsonl"]
+
+
+def test_segment_name_contains_pid(tmp_path):
+    writer = eval_module.FeedbackWriter(str(tmp_path))
+    writer._open_segment()
+    writer._close_segment()
+    [name] = os.listdir(tmp_path)
+    assert f"-{os.getpid()}-000.jsonl" in name
@@ -0,0 +1,137 @@
+# tests/test_handler.py
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+pytest.importorskip("multipart")  # FastAPI のフォーム処理に必要
+
+import server.handler as handler  # noqa: E402
+from server.metrics import Metrics  # noqa: E402
+
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    metrics = Metrics()
+    monkeypatch.setattr(handler, "metrics", metrics)
+    return metrics
+
+
+def test_record_generation_estimates_reclaimed_tokens(fresh_metrics):
+    handler.record_generation("ask", 100, completed=True)
+    handler.record_generation("ask", 60, completed=True)
+    handler.record_generation("ask", 30, completed=False)
+    handler.record_generation("other", 5, completed=False)  # 完了した生成が無いモードは推定しない
+    assert fresh_metrics.get("generations_completed") == 2
+    assert fresh_metrics.get("generations_cancelled") == 2
+    assert fresh_metrics.get("generation_tokens_before_cancel") == 35
+    assert fresh_metrics.get("generation_tokens_reclaimed") == 50
+
+
+def test_close_on_disconnect_closes_upstream(monkeypatch):
+    monkeypatch.setattr(handler, "DISCONNECT_POLL_INTERVAL", 0)
+
+    class FakeRequest:
+        polls = 0
+
+        async def is_disconnected(self):
+            self.polls += 1
+            return self.polls >= 3
+
+    class FakeUpstream:
+        closed = False
+
+        async def aclose(self):
+            self.closed = True
+
+    async def run():
+        request, upstream, disconnected = FakeRequest(), FakeUpstream(), asyncio.Event()
+        await handler.close_on_disconnect(request, upstream, disconnected)
+        return request, upstream, disconnected
+
+    request, upstream, disconnected = asyncio.run(run())
+    assert (request.polls, upstream.closed, disconnected.is_set()) == (3, True, True)
+
+
+def test_ask_forwards_ndjson_and_counts_completed_generation(fresh_metrics, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    lines = [{"response": "a"}, {"response": "b"}, {"response": "", "done": True, "eval_count": 7}]
+
+    def upstream(request):
+        return httpx.Response(200, text="".join(json.dumps(line) + "\n" for line in lines))
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(handler.httpx, "AsyncClient",
+                        lambda **kwargs: real_client(transport=httpx.MockTransport(upstream), **kwargs))
+    monkeypatch.setattr(handler, "generate_prompt", lambda question, *args, **kwargs: question)
+
+    response = TestClient(handler.app).post("/api/ask", data={"question": "q"})
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.text.splitlines()] == lines
+    assert fresh_metrics.get("generations_completed") == 1
+    assert fresh_metrics.get("generation_tokens.ask") == 7
+    assert fresh_metrics.get("generations_cancelled") == 0
+
+
+def test_preload_model_is_throttled_per_model(fresh_metrics, monkeypatch):
+    requests = []
+
+    def upstream(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={"done": True})
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(handler.httpx, "AsyncClient",
+                        lambda **kwargs: real_client(transport=httpx.MockTransport(upstream), **kwargs))
+    monkeypatch.setattr(handler, "_last_preload", {})
+    monkeypatch.setattr(handler, "MODEL_PRELOAD_INTERVAL", 60)
+
+    async def run():
+        await handler.preload_model("a")
+        await handler.preload_model("a")
+        await handler.preload_model("b")
+
+    asyncio.run(run())
+    assert [r["model"] for r in requests] == ["a", "b"]
+    assert "prompt" not in requests[0] and requests[0]["keep_alive"] == handler.OLLAMA_KEEP_ALIVE
+    assert fresh_metrics.get("model_preloads") == 2
+
+
+def test_ask_reads_files_and_retrieves_concurrently(fresh_metrics, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    generated = []
+
+    def upstream(request):
+        body = json.loads(request.content)
+        if "prompt" in body:
+            generated.append(body)
+        return httpx.Response(200, text=json.dumps({"response": "", "done": True, "eval_count": 0}) + "\n")
+
+    async def read_uploaded_files(files):
+        await asyncio.sleep(0.3)
+        return ""
+
+    def retrieve_context(question, top_n, shards=None):
+        time.sleep(0.3)
+        return "関連情報"
+
+    def generate_prompt(question, language, mode, file_content, reason, shards=None, context=None):
+        return f"{question}|{context}"
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(handler.httpx, "AsyncClient",
+                        lambda **kwargs: real_client(transport=httpx.MockTransport(upstream), **kwargs))
+    monkeypatch.setattr(handler, "read_uploaded_files", read_uploaded_files)
+    monkeypatch.setattr(handler, "retrieve_context", retrieve_context)
+    monkeypatch.setattr(handler, "generate_prompt", generate_prompt)
+
+    response = TestClient(handler.app).post("/api/ask", data={"question": "q", "model": "m"})
+    assert response.status_code == 200
+    [body] = generated
+    assert (body["prompt"], body["keep_alive"]) == ("q|関連情報", handler.OLLAMA_KEEP_ALIVE)
+    # 直列なら 0.6 秒かかる 2 つの段階が重なった
+    assert fresh_metrics.get("ask_overlap_last_seconds_saved") >= 0.2
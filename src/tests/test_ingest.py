@@ -0,0 +1,141 @@
+# tests/test_ingest.py
+import json
+import os
+
+import pytest
+
+import gen.ingest as ingest
+import gen.retriever as retriever
+from gen.database import load_text_documents
+from gen.search import NumpyStore, ShardedStore
+
+
+def _unit(i: int, dim: int = 8) -> list:
+    return [1.0 if j == i % dim else 0.0 for j in range(dim)]
+
+
+@pytest.fixture
+def live_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "LIVE_DIR", str(tmp_path / ".live"))
+    monkeypatch.setattr(ingest, "STATE_FILE", str(tmp_path / ".live" / "state.json"))
+    monkeypatch.setattr(ingest, "generate_embeddings", lambda texts: [_unit(len(text)) for text in texts])
+    return tmp_path
+
+
+def _ingester(directory) -> ingest.Ingester:
+    ingester = ingest.Ingester(directory=str(directory), pattern="*.db")
+    ingester._indexed_counts = {}
+    return ingester
+
+
+def test_ingester_appends_complete_lines_and_resumes(live_dir):
+    path = live_dir / "wiki.db"
+    path.write_text("one\n\ntwo\nthr", encoding="utf-8")
+    assert _ingester(live_dir).poll() == 2
+
+    records, offset = ingest.read_live_log("wiki", 0)
+    assert [(r["id"], r["document"], r["metadata"]["shard"]) for r in records] == [
+        ("wiki:0", "one", "wiki"), ("wiki:1", "two", "wiki"),
+    ]
+    assert offset == os.path.getsize(ingest.live_log_path("wiki"))
+
+    # 再起動しても state.json の位置から続け、書き込み途中だった行を取り込む
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("ee\n")
+    restarted = _ingester(live_dir)
+    assert restarted.poll() == 1
+    records, _ = ingest.read_live_log("wiki", offset)
+    assert [(r["id"], r["document"]) for r in records] == [("wiki:2", "three")]
+    assert restarted.poll() == 0
+
+
+def test_read_live_log_leaves_partial_record_for_next_read(live_dir):
+    os.makedirs(ingest.LIVE_DIR)
+    record = json.dumps({"id": "wiki:0", "document": "one", "metadata": {}, "embedding": _unit(0)})
+    with open(ingest.live_log_path("wiki"), "w", encoding="utf-8") as f:
+        f.write(record + "\n" + record[:10])
+    records, offset = ingest.read_live_log("wiki", 0)
+    assert [r["id"] for r in records] == ["wiki:0"]
+    assert offset == len(record) + 1
+    assert ingest.read_live_log("wiki", offset) == ([], offset)
+
+
+def test_live_updates_are_applied_once_and_become_searchable(live_dir, monkeypatch):
+    monkeypatch.setattr(retriever, "VECTOR_STORE", "numpy")
+    (live_dir / "wiki.db").write_text("one\ntwo\n", encoding="utf-8")
+    (live_dir / "pdf.db").write_text("pdf one\n", encoding="utf-8")
+    _ingester(live_dir).poll()
+
+    wiki = NumpyStore.from_vector_db([
+        {"id": "wiki:0", "embedding": _unit(3), "document": "one", "metadata": {"source": "wiki.db", "shard": "wiki"}},
+    ])
+    active = retriever._apply_live_updates(ShardedStore({"wiki": wiki}))
+    assert len(active) == 3
+    assert {c["document"] for c in active.search(_unit(3), 2)} == {"one", "two"}
+    assert [c["document"] for c in active.search(_unit(7), 1)] == ["pdf one"]
+
+    # 反映済みの位置は各シャードに記録され、もう一度呼んでも重複しない
+    assert len(retriever._apply_live_updates(active)) == 3
+
+
+# 全角スペースだけの行は load_text_documents では空行として数えない
+LINES = ["一行目\n", "　\n", "二行目\n", "三行目\n"]
+
+
+def _write(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+def test_start_position_counts_lines_like_load_text_documents(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "LIVE_DIR", str(tmp_path / ".live"))
+    monkeypatch.setattr(ingest, "STATE_FILE", str(tmp_path / ".live" / "state.json"))
+    path = tmp_path / "test.db"
+    _write(path, LINES)
+    assert [(doc, n) for doc, _, n, _ in load_text_documents([str(path)])] == [("一行目", 0), ("二行目", 1), ("三行目", 2)]
+
+    ingester = ingest.Ingester.__new__(ingest.Ingester)
+    ingester.state = {}
+    ingester._indexed_counts = {"test.db": 2}  # スナップショットには 一行目・二行目 が入っている
+    docs = ingester._read_new_lines(str(path))
+    assert [(doc["document"], doc["id"]) for doc in docs] == [("三行目", "test:2")]
+
+
+def test_rewritten_file_counts_lines_like_load_text_documents(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "LIVE_DIR", str(tmp_path / ".live"))
+    monkeypatch.setattr(ingest, "STATE_FILE", str(tmp_path / ".live" / "state.json"))
+    path = tmp_path / "test.db"
+    _write(path, LINES)
+
+    ingester = ingest.Ingester.__new__(ingest.Ingester)
+    ingester.state = {str(path): {"offset": 0, "lines": 0, "inode": -1}}
+    assert ingester._read_new_lines(str(path)) == []
+    assert ingester.state[str(path)]["lines"] == 3
+    assert ingester.state[str(path)]["offset"] == os.path.getsize(path)
+
+
+def test_page_markers_become_metadata_and_are_not_counted(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "LIVE_DIR", str(tmp_path / ".live"))
+    monkeypatch.setattr(ingest, "STATE_FILE", str(tmp_path / ".live" / "state.json"))
+    path = tmp_path / "pdf.db"
+    _write(path, ["序文\n", "<!-- page: 1 -->\n", "一ページ目\n", "<!-- page: 3 -->\n", "三ページ目\n", "続き\n"])
+    assert [(doc, n, extra) for doc, _, n, extra in load_text_documents([str(path)])] == [
+        ("序文", 0, {}), ("一ページ目", 1, {"page": 1}), ("三ページ目", 2, {"page": 3}), ("続き", 3, {"page": 3}),
+    ]
+
+    # スナップショットに 3 件入っている場合も、続きの行は直前のページ番号を引き継ぐ
+    ingester = ingest.Ingester.__new__(ingest.Ingester)
+    ingester.state = {}
+    ingester._indexed_counts = {"pdf.db": 3}
+    [doc] = ingester._read_new_lines(str(path))
+    assert (doc["id"], doc["metadata"]["page"]) == ("pdf:3", 3)
+
+    # ページ番号の行だけが追記されても次の行に引き継がれる
+    ingester.state[str(path)].update(offset=doc["offset"], lines=doc["lines"], extra=doc["extra"])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("<!-- page: 4 -->\n")
+    assert ingester._read_new_lines(str(path)) == []
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("四ページ目\n")
+    [doc] = ingester._read_new_lines(str(path))
+    assert (doc["id"], doc["metadata"]["page"]) == ("pdf:4", 4)
@@ -0,0 +1,24 @@
+# tests/test_pull.py
+import pytest
+
+pytest.importorskip("rich")
+
+import pull
+from gen.database import load_vector_db, save_vector_db
+
+
+def test_create_vector_db_keeps_other_shards(tmp_path, monkeypatch):
+    output = str(tmp_path / "vec.db")
+    save_vector_db([
+        {"id": "wiki:0", "embedding": [1.0, 0.0], "document": "古い wiki", "metadata": {"source": "wiki.db", "shard": "wiki"}},
+        {"id": "pdf:0", "embedding": [0.0, 1.0], "document": "古い pdf", "metadata": {"source": "pdf.db", "shard": "pdf"}},
+    ], output)
+    pdf = tmp_path / "pdf.db"
+    pdf.write_text("新しい pdf\n", encoding="utf-8")
+    monkeypatch.setattr(pull, "generate_embedding", lambda text: [0.5, 0.5])
+    monkeypatch.setattr(pull, "VECTOR_STORE", "numpy")
+
+    pull.create_vector_db([str(pdf)], output, threads=1, force=True, build_index=False, dedup_threshold=0)
+
+    entries = {entry["id"]: entry["document"] for entry in load_vector_db(output)}
+    assert entries == {"wiki:0": "古い wiki", "pdf:0": "新しい pdf"}
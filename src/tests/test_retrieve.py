@@ -0,0 +1,78 @@
+# tests/test_retrieve.py
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import gen.retriever as retriever
+import server.retrieve as retrieve
+from gen.search import NumpyStore, ShardedStore
+
+
+def _unit(i: int, dim: int = 8) -> list:
+    return [1.0 if j == i % dim else 0.0 for j in range(dim)]
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(retrieve.retrieve_router, prefix="/api")
+    return TestClient(app)
+
+
+def test_retrieve_batch_searches_every_question(monkeypatch):
+    store = NumpyStore.from_vector_db([
+        {"id": f"wiki:{i}", "embedding": _unit(i), "document": f"doc {i}", "metadata": {"source": "wiki.db"}}
+        for i in range(4)
+    ])
+    embedded = []
+    monkeypatch.setattr(retriever, "_ready", True)
+    monkeypatch.setattr(retriever, "_active", ShardedStore({"wiki": store}))
+    monkeypatch.setattr(retriever, "_model", None)
+    monkeypatch.setattr(retriever, "maybe_reload_index", lambda: None)
+    monkeypatch.setattr(retriever, "RETRIEVE_EMBED_CHUNK", 2)
+    monkeypatch.setattr(retriever, "generate_embeddings",
+                        lambda texts: embedded.append(len(texts)) or [_unit(int(text)) for text in texts])
+
+    results = retriever.retrieve_batch(["1", "3", "2"], top_n=1)
+    assert [[c["document"] for c in candidates] for candidates in results] == [["doc 1"], ["doc 3"], ["doc 2"]]
+    assert embedded == [2, 1]
+    assert "embedding" not in results[0][0] and results[0][0]["shard"] == "wiki"
+
+    monkeypatch.setattr(retriever, "_ready", False)
+    with pytest.raises(RuntimeError, match="warming up"):
+        retriever.retrieve_batch(["1"])
+
+
+def test_retrieve_endpoint_returns_documents_per_question(client, monkeypatch):
+    calls = []
+
+    def retrieve_batch(questions, top_n, where=None, shards=None):
+        calls.append((questions, top_n, where, shards))
+        return [[{"id": f"d:{q}", "document": q, "similarity": 0.5}] for q in questions]
+
+    monkeypatch.setattr(retrieve, "retrieve_batch", retrieve_batch)
+    monkeypatch.setattr(retrieve, "warmup_status", lambda: {"version": "v1"})
+    response = client.post("/api/retrieve", json={"questions": ["a", "b"], "top_n": 3, "shards": ["wiki"]})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["version"] == "v1"
+    assert [(r["question"], [d["id"] for d in r["documents"]]) for r in body["results"]] == [("a", ["d:a"]), ("b", ["d:b"])]
+    assert calls == [(["a", "b"], 3, None, ["wiki"])]
+
+
+def test_retrieve_endpoint_rejects_bad_requests_and_reports_backend_errors(client, monkeypatch):
+    assert client.post("/api/retrieve", json={"questions": []}).status_code == 400
+    assert client.post("/api/retrieve", json={"questions": ["a"], "top_n": 0}).status_code == 400
+
+    def fail(message, error=RuntimeError):
+        def retrieve_batch(*args, **kwargs):
+            raise error(message)
+        return retrieve_batch
+
+    monkeypatch.setattr(retrieve, "retrieve_batch", fail("Retriever is still warming up"))
+    assert client.post("/api/retrieve", json={"questions": ["a"]}).status_code == 503
+    monkeypatch.setattr(retrieve, "retrieve_batch", fail("Embedding generation failed"))
+    assert client.post("/api/retrieve", json={"questions": ["a"]}).status_code == 502
+    monkeypatch.setattr(retrieve, "retrieve_batch", fail("Embedding dimension mismatch: 4 != 8", ValueError))
+    response = client.post("/api/retrieve", json={"questions": ["a"]})
+    assert (response.status_code, response.json()["detail"]) == (400, "Embedding dimension mismatch: 4 != 8")
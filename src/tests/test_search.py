@@ -0,0 +1,157 @@
+# tests/test_search.py
+import numpy as np
+import pytest
+
+from gen.search import EmbeddingMatrix, LayeredStore, NumpyStore, ShardedStore
+
+
+def make_store(n: int = 8, dim: int = 8) -> NumpyStore:
+    embeddings = np.eye(n, dim, dtype=np.float32)
+    return NumpyStore(
+        "v1", [f"s:{i}" for i in range(n)], [f"doc {i}" for i in range(n)],
+        EmbeddingMatrix(embeddings), [{"source": "s.db"} for _ in range(n)],
+    )
+
+
+def unit(i: int, dim: int = 8) -> list:
+    vector = np.zeros(dim, dtype=np.float32)
+    vector[i] = 1
+    return vector.tolist()
+
+
+def test_live_rows_go_to_delta_without_touching_base():
+    base = make_store()
+    base_state = base._state
+    store = LayeredStore(base)
+
+    store.upsert(["s:100"], [unit(3)], ["live doc"], [{"source": "s.db"}])
+    store.upsert(["s:101"], [unit(5)], ["live doc 2"], [{"source": "s.db"}])
+
+    assert base._state is base_state  # スナップショットはコピー・再構築されない
+    assert store.delta_rows == 2
+    assert len(store) == 10
+    assert store.version == "v1"
+    assert store.missing_ids(["s:0", "s:100", "s:999"]) == ["s:999"]
+
+    top = store.search(unit(3), 2)
+    assert {candidate["id"] for candidate in top} == {"s:3", "s:100"}
+
+
+def test_upserting_a_base_id_shadows_the_base_row():
+    store = LayeredStore(make_store())
+    store.upsert(["s:2"], [unit(6)], ["replaced"], [{}])
+
+    assert len(store) == 8
+    ids = [candidate["id"] for candidate in store.search(unit(2), 8)]
+    assert ids.count("s:2") == 1
+    # 置き換えた行は新しい埋め込み・文書で delta から返る
+    by_id = {candidate["id"]: candidate for candidate in store.search(unit(6), 2)}
+    assert set(by_id) == {"s:2", "s:6"}
+    assert (by_id["s:2"]["document"], by_id["s:2"]["similarity"]) == ("replaced", pytest.approx(1.0))
+    assert all(c["document"] != "doc 2" for c in store.search(unit(2), 8))
+
+
+def test_live_only_shard_and_batch_search_through_shards():
+    live = LayeredStore()
+    live.upsert(["live:0", "live:1"], [unit(0), unit(1)], ["a", "b"], [{}, {}])
+    sharded = ShardedStore({"s": LayeredStore(make_store()), "live": live})
+
+    results = sharded.search_batch([unit(0), unit(1)], 2)
+    assert {c["id"] for c in results[0]} == {"s:0", "live:0"}
+    assert {c["shard"] for c in results[1]} == {"s", "live"}
+    assert live.version == "live"
+
+
+def exact_cosine(embeddings: np.ndarray, query: np.ndarray) -> np.ndarray:
+    return embeddings @ query / np.linalg.norm(embeddings, axis=1) / np.linalg.norm(query)
+
+
+def test_faiss_base_and_delta_are_merged_on_the_same_cosine_scale():
+    pytest.importorskip("faiss")
+    from gen.search import FaissStore
+
+    # 正規化していない埋め込みでは L2 距離からの換算はコサイン類似度と一致しない
+    rng = np.random.default_rng(0)
+    embeddings = (rng.normal(size=(50, 16)) * 3).astype(np.float32)
+    base = FaissStore("v1", [f"s:{i}" for i in range(50)], [f"doc {i}" for i in range(50)],
+                      EmbeddingMatrix(embeddings), [{} for _ in range(50)], index_type="hnsw")
+    store = LayeredStore(base)
+    query = embeddings[7]
+    live = query * 0.5 + rng.normal(size=16).astype(np.float32) * 0.3
+    store.upsert(["live:0"], [live], ["live doc"], [{}])
+
+    results = store.search(query, 5)
+    expected = {f"s:{i}": score for i, score in enumerate(exact_cosine(embeddings, query))}
+    expected["live:0"] = float(exact_cosine(live[None, :], query)[0])
+    assert [c["id"] for c in results[:2]] == ["s:7", "live:0"]
+    assert [c["similarity"] for c in results] == sorted((c["similarity"] for c in results), reverse=True)
+    for candidate in results:
+        assert candidate["similarity"] == pytest.approx(expected[candidate["id"]], abs=1e-5)
+
+
+def test_faiss_store_records_the_index_type_actually_built():
+    pytest.importorskip("faiss")
+    from gen.search import FaissStore
+
+    # IVF-PQ を学習できない件数では HNSW になり、追加のたびに作り直さない
+    embeddings = np.random.default_rng(0).normal(size=(20, 8)).astype(np.float32)
+    store = FaissStore("live", [str(i) for i in range(20)], ["d"] * 20, EmbeddingMatrix(embeddings),
+                       [{} for _ in range(20)], index_type="ivf_pq")
+    assert store.index_type == "hnsw"
+    index = store.faiss_index
+    store.upsert(["new"], embeddings[:1], ["d"], [{}])
+    assert store.faiss_index is not index and store.faiss_index.ntotal == 21
+
+
+def test_hnsw_index_is_mmapped_instead_of_copied(tmp_path, monkeypatch):
+    import pytest
+
+    faiss = pytest.importorskip("faiss")
+    if not hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        pytest.skip("faiss without IO_FLAG_MMAP_IFC")
+    from gen.search import load_faiss_index, save_faiss_index
+    from gen.retriever import process_memory
+
+    embeddings = np.random.default_rng(0).random((20000, 256), dtype=np.float32)
+    index = faiss.IndexHNSWFlat(256, 32)
+    index.add(embeddings)
+    path = str(tmp_path / "faiss.index")
+    save_faiss_index(index, path)
+    size_mb = (tmp_path / "faiss.index").stat().st_size / (1024 * 1024)
+    del index
+
+    before = process_memory().get("anonymous_mb")
+    if before is None:
+        pytest.skip("/proc/self/smaps_rollup is not available")
+    loaded = load_faiss_index(path, require_shared=True)
+    loaded.search(embeddings[:10], 5)
+    # ファイル上のページを使うので、インデックスの大きさ分のヒープは増えない
+    assert process_memory()["anonymous_mb"] - before < size_mb / 4
+
+    # IO_FLAG_MMAP しか使えなければ HNSW は共有できない
+    monkeypatch.delattr(faiss, "IO_FLAG_MMAP_IFC")
+    assert load_faiss_index(path, require_shared=True) is None
+    assert load_faiss_index(path).ntotal == 20000
+
+
+def test_base_overfetch_for_shadowed_rows_is_capped(monkeypatch):
+    import gen.search as search
+
+    monkeypatch.setattr(search, "LAYERED_OVERFETCH", 2)
+    base = make_store()
+    fetched = []
+    search_batch = base.search_batch
+
+    def spy(queries, k, where=None):
+        fetched.append(k)
+        return search_batch(queries, k, where)
+
+    monkeypatch.setattr(base, "search_batch", spy)
+    store = LayeredStore(base)
+    store.upsert([f"s:{i}" for i in range(6)], [unit(7)] * 6, [f"new {i}" for i in range(6)], [{}] * 6)
+
+    # 置き換えた 6 行に関係なく、base からは k + 2 件しか取らない
+    results = store.search(unit(6), 3)
+    assert fetched == [5]
+    assert results[0]["id"] == "s:6"
+    assert all(c["document"] != f"doc {i}" for c in results for i in range(6))
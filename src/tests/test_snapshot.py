@@ -0,0 +1,43 @@
+# tests/test_snapshot.py
+import os
+import numpy as np
+
+from gen.database import (
+    StringTable, prune_index_versions, read_current_version, read_snapshot_meta, set_current_version,
+    write_index_snapshot,
+)
+
+
+def test_string_table_round_trip(tmp_path):
+    values = ["東京", "", "富士山 3776m", "a" * 1000]
+    StringTable.write(str(tmp_path), "documents", values)
+    table = StringTable(str(tmp_path), "documents")
+    assert len(table) == 4
+    assert [table[i] for i in range(len(table))] == values
+
+    StringTable.write(str(tmp_path), "empty", [""])
+    assert StringTable(str(tmp_path), "empty")[0] == ""
+
+
+def test_snapshot_is_published_through_current(tmp_path):
+    index_dir = str(tmp_path)
+    assert read_current_version(index_dir) is None
+    vector_db = [{"id": f"d{i}", "embedding": [float(i), 1.0], "document": f"doc {i}"} for i in range(3)]
+
+    versions = []
+    for _ in range(4):
+        version = write_index_snapshot(vector_db, index_dir)
+        set_current_version(version, index_dir)
+        versions.append(version)
+    assert read_current_version(index_dir) == versions[-1]
+    meta = read_snapshot_meta(versions[-1], index_dir)
+    assert (meta["count"], meta["dim"]) == (3, 2)
+
+    embeddings = np.load(os.path.join(index_dir, versions[-1], "embeddings.npy"), mmap_mode="r")
+    assert embeddings.shape == (3, 2) and embeddings[2, 0] == 2.0
+    assert StringTable(os.path.join(index_dir, versions[-1]), "ids")[1] == "d1"
+
+    # CURRENT が指すバージョンは消さずに、古いものだけを削除する
+    prune_index_versions(index_dir, keep=1)
+    remaining = sorted(name for name in os.listdir(index_dir) if name.startswith("v"))
+    assert versions[-1] in remaining and versions[0] not in remaining
@@ -0,0 +1,207 @@
+# tests/test_store.py
+import numpy as np
+import pytest
+
+from gen.database import shard_name
+from gen.search import (
+    EmbeddingMatrix, NumpyStore, ShardedStore, evaluate_recall, exact_top_k, search_vector_db, search_vector_db_batch,
+)
+
+
+def unit(i: int, dim: int = 8) -> list:
+    v = np.zeros(dim, dtype=np.float32)
+    v[i % dim] = 1.0
+    return v.tolist()
+
+
+def numpy_store() -> NumpyStore:
+    return NumpyStore.from_vector_db([
+        {"id": f"d{i}", "embedding": unit(i), "document": f"doc {i}",
+         "metadata": {"source": "wiki.db" if i % 2 == 0 else "pdf.db"}}
+        for i in range(6)
+    ])
+
+
+def test_numpy_store_search_and_metadata_filter():
+    store = numpy_store()
+    [best] = store.search(unit(3), 1)
+    assert (best["id"], best["document"], best["similarity"]) == ("d3", "doc 3", pytest.approx(1.0))
+    assert {c["id"] for c in store.search(unit(3), 6, where={"source": "wiki.db"})} == {"d0", "d2", "d4"}
+    assert {c["id"] for c in store.search(unit(3), 6, where={"source": {"$in": ["pdf.db"]}})} == {"d1", "d3", "d5"}
+
+
+def test_numpy_store_upsert_replaces_and_appends():
+    store = numpy_store()
+    store.upsert(["d0", "new"], [unit(5), unit(6)], ["replaced", "appended"], [{"source": "wiki.db"}, {}])
+    assert len(store) == 7
+    assert [c["document"] for c in store.search(unit(6), 1)] == ["appended"]
+    assert {c["document"] for c in store.search(unit(5), 2)} == {"replaced", "doc 5"}
+
+
+def test_chroma_store_round_trip(tmp_path):
+    pytest.importorskip("chromadb")
+    from gen.search import ChromaStore
+
+    store = ChromaStore(path=str(tmp_path), collection="test")
+    store.upsert([f"d{i}" for i in range(4)], [unit(i) for i in range(4)], [f"doc {i}" for i in range(4)],
+                 [{"source": "wiki.db" if i % 2 == 0 else "pdf.db"} for i in range(4)])
+    assert len(store) == 4
+    [best] = store.search(unit(2), 1)
+    assert (best["id"], best["similarity"]) == ("d2", pytest.approx(1.0, abs=1e-5))
+    assert {c["id"] for c in store.search(unit(1), 4, where={"source": "wiki.db"})} == {"d0", "d2"}
+    # 永続化されていて、開き直しても残っている
+    assert len(ChromaStore(path=str(tmp_path), collection="test")) == 4
+
+
+def random_embeddings(n: int = 500, dim: int = 32) -> np.ndarray:
+    return np.random.default_rng(0).normal(size=(n, dim)).astype(np.float32)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_matrix_scores_close_to_float32(tmp_path, dtype):
+    embeddings = random_embeddings()
+    matrix = EmbeddingMatrix.quantize(embeddings, dtype)
+    assert matrix.dtype == dtype and matrix.nbytes < embeddings.nbytes
+    query = embeddings[0]
+    np.testing.assert_allclose(matrix.scores(query), embeddings @ query, rtol=0.05, atol=0.5)
+    np.testing.assert_allclose(matrix.norms(), np.linalg.norm(embeddings, axis=1), rtol=0.02)
+
+    matrix.save(str(tmp_path / "embeddings.q.npy"))
+    loaded = EmbeddingMatrix.load(str(tmp_path / "embeddings.q.npy"))
+    np.testing.assert_array_equal(loaded.scores(query), matrix.scores(query))
+
+
+def test_int8_store_rescores_with_float32_vectors():
+    embeddings = random_embeddings()
+    store = NumpyStore("v", [str(i) for i in range(len(embeddings))], ["d"] * len(embeddings),
+                       EmbeddingMatrix.quantize(embeddings, "int8"), full_embeddings=embeddings)
+    [best] = store.search(embeddings[7], 1)
+    assert (best["id"], best["similarity"]) == ("7", pytest.approx(1.0, abs=1e-4))  # 再スコアリング後は float32 の値
+
+
+def test_evaluate_recall_of_exact_search_is_one():
+    embeddings = random_embeddings()
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1)[:, None]
+
+    def exact(queries, k):
+        return np.argsort(-(queries @ normalized.T), axis=1)[:, :k]
+
+    assert evaluate_recall(embeddings, exact, k=5, samples=20) == 1.0
+    assert evaluate_recall(embeddings, lambda queries, k: np.zeros((len(queries), k), dtype=int), k=5) < 0.1
+
+
+def test_exact_top_k_in_row_chunks_matches_full_sort(monkeypatch):
+    import gen.search as search
+
+    embeddings = random_embeddings() * np.random.default_rng(1).uniform(0.5, 3, size=(500, 1)).astype(np.float32)
+    norms = np.linalg.norm(embeddings, axis=1)
+    queries = embeddings[:7]
+    expected = np.argsort(-(queries @ (embeddings / norms[:, None]).T), axis=1)[:, :10]
+    monkeypatch.setattr(search, "SCORE_CHUNK_ROWS", 64)  # 行を 64 件ずつ計算する
+    for given_norms in (None, norms):
+        found = exact_top_k(embeddings, queries, 10, given_norms)
+        assert [sorted(row) for row in found.tolist()] == [sorted(row) for row in expected.tolist()]
+
+
+@pytest.mark.parametrize("index_type", ["hnsw_sq", "ivf_pq"])
+def test_compressed_faiss_indexes_find_the_query_vector(index_type):
+    pytest.importorskip("faiss")
+    from gen.search import FaissStore
+
+    embeddings = random_embeddings(n=3000)
+    store = FaissStore("v", [str(i) for i in range(len(embeddings))], ["d"] * len(embeddings),
+                       EmbeddingMatrix(embeddings), index_type=index_type)
+    assert [c["id"] for c in store.search(embeddings[42], 1)] == ["42"]
+
+
+def test_shard_name_from_metadata():
+    assert shard_name({"source": "wiki.db"}) == "wiki"
+    assert shard_name({"source": "../rag/database/pdf 2024.db"}) == "pdf_2024"
+    assert shard_name({"source": "wiki.db", "shard": "custom"}) == "custom"
+    assert shard_name({}) == shard_name(None) == "default"
+
+
+def test_sharded_store_merges_shards_by_similarity():
+    wiki = NumpyStore.from_vector_db([{"id": f"wiki:{i}", "embedding": unit(i), "document": f"wiki {i}"} for i in range(4)])
+    pdf = NumpyStore.from_vector_db([{"id": f"pdf:{i}", "embedding": unit(i + 4), "document": f"pdf {i}"} for i in range(4)])
+    sharded = ShardedStore({"wiki": wiki, "pdf": pdf})
+    assert len(sharded) == 8
+
+    query = (np.array(unit(1)) + 0.5 * np.array(unit(5))).tolist()
+    results = sharded.search(query, 2)
+    assert [(c["id"], c["shard"]) for c in results] == [("wiki:1", "wiki"), ("pdf:1", "pdf")]
+    assert [c["id"] for c in sharded.search(query, 2, shards=["pdf"])][0] == "pdf:1"
+
+    # 片方のシャードだけを差し替えても他方は同じオブジェクトのまま
+    replaced = sharded.with_shard("pdf", NumpyStore.from_vector_db([]))
+    assert replaced.shards["wiki"] is wiki and len(replaced) == 4
+
+
+def test_sharded_store_merges_faiss_and_numpy_shards_by_cosine():
+    pytest.importorskip("faiss")
+    from gen.search import FaissStore
+
+    def direction(cosine: float, other: int) -> np.ndarray:
+        return np.array(unit(0)) * cosine + np.array(unit(other)) * np.sqrt(1 - cosine ** 2)
+
+    # 正規化していないベクトル: FAISS の L2 距離から換算した値はコサイン類似度と比べられない
+    faiss_rows = np.array([6 * direction(0.95, 1), 5 * np.array(unit(3)), 4 * np.array(unit(4))], dtype=np.float32)
+    faiss_shard = FaissStore("v", ["f:0", "f:1", "f:2"], ["near", "x", "y"], EmbeddingMatrix(faiss_rows),
+                             index_type="hnsw")
+    numpy_shard = NumpyStore.from_vector_db([
+        {"id": "n:0", "embedding": direction(0.9, 2).tolist(), "document": "nearer in L2"},
+        {"id": "n:1", "embedding": unit(5), "document": "z"},
+    ])
+    sharded = ShardedStore({"faiss": faiss_shard, "numpy": numpy_shard})
+
+    query = [3 * value for value in unit(0)]
+    for results in (sharded.search(query, 2), sharded.search_batch([query, query], 2)[1]):
+        assert [(c["id"], c["shard"]) for c in results] == [("f:0", "faiss"), ("n:0", "numpy")]
+        assert [c["similarity"] for c in results] == [pytest.approx(0.95, abs=1e-5), pytest.approx(0.9, abs=1e-5)]
+
+
+def test_unsharded_store_filters_by_shard_metadata():
+    store = NumpyStore.from_vector_db([
+        {"id": f"d{i}", "embedding": unit(i), "document": f"doc {i}", "metadata": {"shard": "a" if i < 2 else "b"}}
+        for i in range(4)
+    ])
+    assert {c["id"] for c in search_vector_db(unit(0), store, top_n=4, shards=["b"])} == {"d2", "d3"}
+
+
+def test_search_batch_matches_exact_ranking_per_query(monkeypatch):
+    import gen.search as search
+
+    embeddings = random_embeddings()
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1)[:, None]
+    queries = random_embeddings(n=5)[:, ::-1].copy()
+    expected = np.argsort(-(queries @ normalized.T), axis=1)[:, :10]
+    monkeypatch.setattr(search, "SCORE_BLOCK_ELEMENTS", 2 * len(embeddings))  # 2 クエリずつの行列積
+
+    entries = [{"id": str(i), "embedding": e.tolist(), "document": f"doc {i}"} for i, e in enumerate(embeddings)]
+    store = NumpyStore.from_vector_db(entries)
+    sharded = ShardedStore({"a": NumpyStore.from_vector_db(entries[:200]), "b": NumpyStore.from_vector_db(entries[200:])})
+    for backend in (store, sharded):
+        results = backend.search_batch(queries, 10)
+        assert [[int(c["id"]) for c in candidates] for candidates in results] == expected.tolist()
+        cosine = queries[0] @ normalized[expected[0][0]] / np.linalg.norm(queries[0])
+        assert results[0][0]["similarity"] == pytest.approx(float(cosine), abs=1e-5)
+
+
+def test_chroma_store_mixed_metadata_and_multi_key_where(tmp_path):
+    pytest.importorskip("chromadb")
+    from gen.search import ChromaStore
+
+    store = ChromaStore(path=str(tmp_path), collection="test")
+    # 空のメタデータが混ざっても他の行のメタデータは保存される
+    store.upsert([f"d{i}" for i in range(4)], [unit(i) for i in range(4)], [f"doc {i}" for i in range(4)],
+                 [{"source": "wiki.db", "shard": "wiki"}, {}, {"source": "wiki.db", "shard": "wiki"},
+                  {"source": "pdf.db", "shard": "pdf"}])
+    by_id = {c["id"]: c["metadata"] for c in store.search(unit(0), 4)}
+    assert by_id == {"d0": {"source": "wiki.db", "shard": "wiki"}, "d1": {},
+                     "d2": {"source": "wiki.db", "shard": "wiki"}, "d3": {"source": "pdf.db", "shard": "pdf"}}
+
+    where = {"source": "wiki.db", "shard": "wiki"}
+    assert {c["id"] for c in store.search(unit(0), 4, where=where)} == {"d0", "d2"}
+    # shards 指定で where に shard の $in が足されても検索できる
+    results = search_vector_db_batch([unit(3)], store, top_n=4, where={"source": "pdf.db"}, shards=["pdf"])
+    assert [c["id"] for c in results[0]] == ["d3"]
@@ -0,0 +1,85 @@
+# tests/test_streaming.py
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from server.streaming import coalesce, format_event, generation_stats
+
+
+def test_format_event_frames_ndjson_and_sse():
+    assert format_event("ndjson", "token", {"text": "あ"}) == '{"type": "token", "text": "あ"}\n'
+    assert format_event("sse", "token", {"text": "あ"}) == 'event: token\ndata: {"text": "あ"}\n\n'
+
+
+def test_generation_stats_adds_tokens_per_second():
+    final = {"done": True, "response": "", "eval_count": 50, "eval_duration": 2_000_000_000, "context": [1, 2]}
+    assert generation_stats(final) == {"eval_count": 50, "eval_duration": 2_000_000_000, "tokens_per_second": 25.0}
+
+
+async def _collect(source, **kwargs) -> list:
+    return [batch async for batch in coalesce(source, **kwargs)]
+
+
+def test_coalesce_groups_items_within_the_window():
+    async def source():
+        for item in ["a", "b", "c"]:
+            yield item
+        await asyncio.sleep(0.2)
+        yield "d"
+
+    assert asyncio.run(_collect(source(), window_ms=50)) == [["a", "b", "c"], ["d"]]
+
+
+def test_coalesce_flushes_early_at_max_chars():
+    async def source():
+        for item in ["aa", "bb", "cc", "d"]:
+            yield item
+
+    assert asyncio.run(_collect(source(), window_ms=10_000, max_chars=4)) == [["aa", "bb"], ["cc", "d"]]
+
+
+def test_coalesce_sends_received_items_before_raising():
+    batches = []
+
+    async def source():
+        yield "a"
+        raise httpx.ReadError("upstream closed")
+
+    async def run():
+        async for batch in coalesce(source(), window_ms=10_000):
+            batches.append(batch)
+
+    with pytest.raises(httpx.ReadError):
+        asyncio.run(run())
+    assert batches == [["a"]]
+
+
+def test_ask_streams_coalesced_sse_events(monkeypatch):
+    pytest.importorskip("multipart")
+    from fastapi.testclient import TestClient
+    import server.handler as handler
+
+    lines = [{"response": "こん"}, {"response": "にちは"}, {"response": "", "done": True, "eval_count": 2}]
+
+    def upstream(request):
+        return httpx.Response(200, text="".join(json.dumps(line) + "\n" for line in lines))
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(handler.httpx, "AsyncClient",
+                        lambda **kwargs: real_client(transport=httpx.MockTransport(upstream), **kwargs))
+    monkeypatch.setattr(handler, "generate_prompt", lambda question, *args, **kwargs: question)
+
+    response = TestClient(handler.app).post("/api/ask", data={"question": "q", "stream": "sse"},
+                                            headers={"X-Request-ID": "req-1"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.headers["x-accel-buffering"] == "no"
+    assert response.text == (
+        'event: token\ndata: {"text": "こんにちは"}\n\n'
+        'event: done\ndata: {"eval_count": 2, "request_id": "req-1"}\n\n'
+    )
+
+    response = TestClient(handler.app).post("/api/ask", data={"question": "q", "stream": "xml"})
+    assert response.status_code == 400
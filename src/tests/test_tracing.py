@@ -0,0 +1,117 @@
+# tests/test_tracing.py
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from gen.tracing import current_trace, set_field, stage, start_trace
+import server.tracing as tracing
+from server.tracing import ProfileSwitch, SamplingProfiler, TracingMiddleware, server_timing
+
+
+def test_stages_are_recorded_across_to_thread():
+    def embed():
+        with stage("embed"):
+            pass
+        return current_trace()
+
+    async def handler():
+        trace = start_trace("req-1")
+        with stage("search"):
+            pass
+        assert await asyncio.to_thread(embed) is trace
+        with stage("search"):
+            pass
+        return trace
+
+    trace = asyncio.run(handler())
+    assert sorted(trace.stages) == ["embed", "search"]
+    assert server_timing(trace).startswith("search;dur=")
+    assert ", embed;dur=" in server_timing(trace) and ", total;dur=" in server_timing(trace)
+
+    # Trace の無いコンテキスト (CLI) では何もしない
+    assert asyncio.run(asyncio.to_thread(embed)) is None
+
+
+def test_middleware_adds_headers_and_logs_one_line(caplog):
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/work")
+    async def work():
+        with stage("retrieve"):
+            set_field("mode", "ask")
+        return {"ok": True}
+
+    client = TestClient(app)
+    with caplog.at_level(logging.INFO, logger="azzl.request"):
+        response = client.get("/work", headers={"X-Request-ID": "abc-123"})
+        invalid = client.get("/work", headers={"X-Request-ID": "bad id\r\n"})
+
+    assert response.headers["x-request-id"] == "abc-123"
+    assert response.headers["server-timing"].startswith("retrieve;dur=")
+    assert invalid.headers["x-request-id"] != "bad id" and len(invalid.headers["x-request-id"]) == 16
+
+    records = [json.loads(r.getMessage()) for r in caplog.records if r.name == "azzl.request"]
+    assert [r["request_id"] for r in records] == ["abc-123", invalid.headers["x-request-id"]]
+    assert (records[0]["path"], records[0]["status"], records[0]["mode"]) == ("/work", 200, "ask")
+    assert list(records[0]["stages_ms"]) == ["retrieve"]
+
+
+def busy_in_worker_thread(seconds: float = 0.2):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profile_includes_to_thread_work():
+    # イベントループは await to_thread(...) で待つだけなので、ワーカースレッドのフレームが記録されること
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+
+    async def handler():
+        await asyncio.to_thread(busy_in_worker_thread)
+
+    asyncio.run(handler())
+    profiler.stop()
+
+    text = profiler.output_text()
+    assert "busy_in_worker_thread" in text
+    assert "tests/test_tracing.py" in text
+
+
+def test_profile_includes_named_background_threads():
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    thread = threading.Thread(target=busy_in_worker_thread, name="batcher-embed")
+    thread.start()
+    thread.join()
+    profiler.stop()
+
+    text = profiler.output_text()
+    assert "[batcher-embed]" in text
+    assert "busy_in_worker_thread" in text
+    assert "sampling-profiler" not in text
+
+
+def test_profile_switch_is_released_when_the_profiler_fails_to_start(monkeypatch):
+    switch = ProfileSwitch()
+    switch.enable(2)
+
+    def fail(self):
+        raise RuntimeError("can't start new thread")
+
+    monkeypatch.setattr(tracing.SamplingProfiler, "start", fail)
+    with pytest.raises(RuntimeError):
+        switch.start("/api/ask")
+    monkeypatch.undo()
+    # 開始に失敗しても実行中のままにならず、次のリクエストで計測できる
+    profiler = switch.start("/api/ask")
+    assert profiler is not None
+    profiler.stop()
+    switch._release()
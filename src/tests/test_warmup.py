@@ -0,0 +1,48 @@
+# tests/test_warmup.py
+import os
+import sys
+import subprocess
+import pytest
+
+import gen.retriever as retriever
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_the_retriever_does_not_load_heavy_dependencies():
+    code = (
+        "import sys, gen.retriever\n"
+        "print(sorted(m for m in ('torch', 'transformers', 'faiss', 'chromadb', 'markitdown') if m in sys.modules))"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
+
+
+def test_failed_warm_up_is_reported_and_answers_without_rag(monkeypatch):
+    def fail():
+        raise RuntimeError("model not found")
+
+    monkeypatch.setattr(retriever, "init_retriever", fail)
+    monkeypatch.setattr(retriever, "_ready", False)
+    monkeypatch.setattr(retriever, "_warmup_status", {"state": "pending"})
+    retriever.warm_up()
+    assert retriever.warmup_status()["state"] == "failed"
+    assert "model not found" in retriever.warmup_status()["error"]
+    assert not retriever.is_ready()
+    assert retriever.retrieve_context("質問") == ""
+
+
+def test_readyz_is_unavailable_until_warm_up_finishes(monkeypatch):
+    pytest.importorskip("fastapi")
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    import server.health as health
+
+    monkeypatch.setattr(health, "is_ready", lambda: False)
+    app = FastAPI()
+    app.include_router(health.health_router)
+    client = TestClient(app)
+    assert client.get("/healthz").status_code == 200
+    assert client.get("/readyz").status_code == 503
+    monkeypatch.setattr(health, "is_ready", lambda: True)
+    assert client.get("/readyz").status_code == 200